@@ -11,6 +11,7 @@ from __future__ import absolute_import
 import argparse
 import sys
 
+from penelope.collation_keys import get_collation_key_function
 from penelope.command_line import COMMAND_LINE_PARAMETERS
 from penelope.command_line import DESCRIPTION
 from penelope.command_line import EPILOG
@@ -87,58 +88,67 @@ def main():
         sys.exit(8)
     print_info(u"Reading input file(s)... done")
 
-    # apply custom input parser, if specified
-    if arguments.input_parser is not None:
-        input_parser = load_input_parser(arguments.input_parser)
-        if input_parser is not None:
-            print_info(u"Applying the specified input parser...")
-            dictionary = input_parser.parse(dictionary, arguments)
-            print_info(u"Applying the specified input parser... done")
-
-    # sort dictionary before, if requested
-    if arguments.sort_before:
-        print_info(u"Sorting before...")
-        dictionary.sort(
-            arguments.sort_by_headword,
-            arguments.sort_by_definition,
-            arguments.sort_reverse,
-            arguments.sort_ignore_case
-        )
-        print_info(u"Sorting before... done")
-
-    # merge definitions, if requested
-    if arguments.merge_definitions:
-        print_info(u"Merging...")
-        dictionary.merge_definitions(merge_separator=arguments.merge_separator)
-        print_info(u"Merging... done")
-
-    # flatten synonyms, if requested
-    if arguments.flatten_synonyms:
-        print_info(u"Flattening synonyms...")
-        dictionary.flatten_synonyms()
-        print_info(u"Flattening synonyms... done")
-
-    # sort dictionary after, if requested
-    if arguments.sort_after:
-        print_info(u"Sorting after...")
-        dictionary.sort(
-            arguments.sort_by_headword,
-            arguments.sort_by_definition,
-            arguments.sort_reverse,
-            arguments.sort_ignore_case
-        )
-        print_info(u"Sorting after... done")
-
-    # output dictionary
-    print_info(u"Writing output file(s)...")
-    output_paths = write_dictionary(dictionary, arguments)
-    if output_paths is None:
-        print_error("Unable to write the output file(s)")
-        sys.exit(16)
-    print_info(u"Writing output file(s)... done")
-    print_info(u"The following file(s) have been created:")
-    for op in output_paths:
-        print_info(u"  %s" % op)
+    try:
+        # apply custom input parser, if specified
+        if arguments.input_parser is not None:
+            input_parser = load_input_parser(arguments.input_parser)
+            if input_parser is not None:
+                print_info(u"Applying the specified input parser...")
+                dictionary = input_parser.parse(dictionary, arguments)
+                print_info(u"Applying the specified input parser... done")
+
+        # sort dictionary before, if requested
+        if arguments.sort_before:
+            print_info(u"Sorting before...")
+            dictionary.sort(
+                arguments.sort_by_headword,
+                arguments.sort_by_definition,
+                arguments.sort_reverse,
+                arguments.sort_ignore_case,
+                get_collation_key_function(arguments.sort_collation)
+            )
+            print_info(u"Sorting before... done")
+
+        # merge definitions, if requested
+        if arguments.merge_definitions:
+            print_info(u"Merging...")
+            dictionary.merge_definitions(
+                merge_separator=arguments.merge_separator,
+                preserve_sort=arguments.merge_preserve_sort
+            )
+            print_info(u"Merging... done")
+
+        # flatten synonyms, if requested
+        if arguments.flatten_synonyms:
+            print_info(u"Flattening synonyms...")
+            dictionary.flatten_synonyms()
+            print_info(u"Flattening synonyms... done")
+
+        # sort dictionary after, if requested
+        if arguments.sort_after:
+            print_info(u"Sorting after...")
+            dictionary.sort(
+                arguments.sort_by_headword,
+                arguments.sort_by_definition,
+                arguments.sort_reverse,
+                arguments.sort_ignore_case,
+                get_collation_key_function(arguments.sort_collation)
+            )
+            print_info(u"Sorting after... done")
+
+        # output dictionary
+        print_info(u"Writing output file(s)...")
+        output_paths = write_dictionary(dictionary, arguments)
+        if output_paths is None:
+            print_error("Unable to write the output file(s)")
+            sys.exit(16)
+        print_info(u"Writing output file(s)... done")
+        print_info(u"The following file(s) have been created:")
+        for op in output_paths:
+            print_info(u"  %s" % op)
+    finally:
+        # close the sources of lazy entries, like the input files read with --sd-lazy-definitions
+        dictionary.close()
 
     sys.exit(0)
 
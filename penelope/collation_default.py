@@ -17,6 +17,19 @@ __email__ = "alberto@albertopettarin.it"
 __status__ = "Production"
 
 
+def sort_key(string):
+    """
+    Return the sort key of the given string
+    for the default IcuNoCase collation,
+    that is, its lowercased UTF-8 encoded version.
+
+    :param string: the string
+    :type  string: unicode
+    :rtype: byte string
+    """
+    return utf_lower(string, encoding="utf-8", lower=True)
+
+
 def collate_function(string1, string2):
     """
     Implement default IcuNoCase collation,
@@ -28,6 +28,28 @@ if PY2:
     REPLACEMENTS = [(r.encode("utf-8"), s.encode("utf-8")) for (r, s) in REPLACEMENTS]
 
 
+def sort_key(string):
+    """
+    Return the sort key of the given string
+    for IcuNoCase collation for German,
+    such that comparing the keys of two strings
+    is equivalent to calling collate_function() on them.
+
+    :param string: the string
+    :type  string: unicode
+    :rtype: tuple of byte strings
+    """
+    b = string.lower()
+    for (r, s) in REPLACEMENTS:
+        b = b.replace(r, s)
+    b = utf_lower(b, encoding="utf-8", lower=True)
+    c = utf_lower(string, encoding="utf-8", lower=True)
+    return (
+        utf_lower(b, encoding="utf-16", lower=False),
+        utf_lower(c, encoding="utf-16", lower=False)
+    )
+
+
 def collate_function(string1, string2):
     """
     Implement IcuNoCase collation for German.
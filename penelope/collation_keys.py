@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Collation key functions for sorting a Dictionary.
+
+A collation key function maps a string to its sort key,
+and it can be passed to Dictionary.sort() as key_function.
+"""
+
+from __future__ import absolute_import
+import unicodedata
+
+from penelope.collation_german import sort_key as german_sort_key
+from penelope.utilities import PY2
+
+__author__ = "Alberto Pettarin"
+__copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__version__ = "3.1.3"
+__email__ = "alberto@albertopettarin.it"
+__status__ = "Production"
+
+
+def casefold_key(string):
+    """
+    Return the case-folded string
+    (lowercased on Python 2, which lacks casefold()).
+
+    :param string: the string
+    :type  string: unicode
+    :rtype: unicode
+    """
+    if PY2:
+        return string.lower()
+    return string.casefold()
+
+
+def unaccent_key(string):
+    """
+    Return a key sorting strings ignoring accents and case,
+    ties being broken by case-folded and then original strings.
+
+    :param string: the string
+    :type  string: unicode
+    :rtype: tuple of unicode
+    """
+    folded = casefold_key(string)
+    unaccented = u"".join([c for c in unicodedata.normalize("NFKD", folded) if not unicodedata.combining(c)])
+    return (unaccented, folded, string)
+
+
+COLLATION_KEY_FUNCTIONS = {
+    "casefold": casefold_key,
+    "german": german_sort_key,
+    "unaccent": unaccent_key,
+}
+
+
+def get_collation_key_function(name):
+    """
+    Return the collation key function with the given name,
+    or None if name is None.
+
+    :param name: the name of the collation
+    :type  name: str
+    :rtype: function
+    """
+    if name is None:
+        return None
+    return COLLATION_KEY_FUNCTIONS[name]
+
+
+class MemoizedCollation(object):
+    """
+    Compare strings by their sort keys,
+    computing the key of each string only once.
+
+    The collate_function method can be installed
+    as a SQLite collation, in place of a comparator
+    converting both strings at every comparison.
+    """
+    def __init__(self, sort_key):
+        self.sort_key = sort_key
+        self.keys = {}
+
+    def get_key(self, string):
+        """
+        Return the (memoized) sort key of the given string.
+
+        :param string: the string
+        :type  string: unicode
+        :rtype: object
+        """
+        try:
+            return self.keys[string]
+        except KeyError:
+            key = self.sort_key(string)
+            self.keys[string] = key
+            return key
+
+    def collate_function(self, string1, string2):
+        key1 = self.get_key(string1)
+        key2 = self.get_key(string2)
+        if key1 == key2:
+            return 0
+        if key1 < key2:
+            return -1
+        return 1
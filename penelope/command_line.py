@@ -9,6 +9,7 @@ from __future__ import absolute_import
 import datetime
 import sys
 
+from penelope.utilities import get_cpu_count
 from penelope.utilities import get_uuid
 from penelope.utilities import print_error
 
@@ -27,6 +28,18 @@ INPUT_FORMATS = [
     "xml"
 ]
 
+DICTIONARY_BACKENDS = [
+    "compact",
+    "memory",
+    "sqlite"
+]
+
+SORT_COLLATIONS = [
+    "casefold",
+    "german",
+    "unaccent"
+]
+
 OUTPUT_FORMATS = [
     "bookeen",
     "csv",
@@ -190,10 +203,16 @@ COMMAND_LINE_PARAMETERS = [
         "help": "CSV line separator (default: '\\n')",
         "action": "store"
     },
+    {
+        "short": None,
+        "long": "--dictionary-backend",
+        "help": "store the dictionary using the given backend: %s (default: memory)" % ("|".join(DICTIONARY_BACKENDS)),
+        "action": "store"
+    },
     {
         "short": None,
         "long": "--dictzip-path",
-        "help": "path to dictzip executable",
+        "help": "path to dictzip executable (default: search $PATH, then use the built-in dictzip compressor)",
         "action": "store"
     },
     {
@@ -232,6 +251,12 @@ COMMAND_LINE_PARAMETERS = [
         "help": "merge headword groups even when the first character changes (default: False)",
         "action": "store_true"
     },
+    {
+        "short": None,
+        "long": "--group-by-prefix-merge-min-bytes",
+        "help": "merge headword groups until the given minimum number of bytes of headwords and definitions is reached (default: 0, meaning no merge will take place)",
+        "action": "store"
+    },
     {
         "short": None,
         "long": "--group-by-prefix-merge-min-size",
@@ -268,6 +293,12 @@ COMMAND_LINE_PARAMETERS = [
         "help": "use the specified parser function after reading the raw contents of input file(s)",
         "action": "store"
     },
+    {
+        "short": None,
+        "long": "--jobs",
+        "help": "number of threads compressing and decompressing the members of zip and dictzip files (default: number of CPUs)",
+        "action": "store"
+    },
     {
         "short": None,
         "long": "--kindlegen-path",
@@ -277,13 +308,13 @@ COMMAND_LINE_PARAMETERS = [
     {
         "short": None,
         "long": "--marisa-bin-path",
-        "help": "path to MARISA bin directory",
+        "help": "path to MARISA bin directory, used if marisa_trie is not installed (default: search $PATH, then use the built-in MARISA reader/writer)",
         "action": "store"
     },
     {
         "short": None,
         "long": "--marisa-index-size",
-        "help": "maximum size of the MARISA index (default: 1000000)",
+        "help": "maximum size of the MARISA index read with marisa-reverse-lookup (default: 1000000)",
         "action": "store"
     },
     {
@@ -292,6 +323,12 @@ COMMAND_LINE_PARAMETERS = [
         "help": "merge definitions for the same headword (default: False)",
         "action": "store_true"
     },
+    {
+        "short": None,
+        "long": "--merge-preserve-sort",
+        "help": "when merging definitions, keep the current sort order, e.g. the one given by --sort-before (default: False)",
+        "action": "store_true"
+    },
     {
         "short": None,
         "long": "--merge-separator",
@@ -310,12 +347,30 @@ COMMAND_LINE_PARAMETERS = [
         "help": "do not output definitions for EPUB and MOBI formats (default: False)",
         "action": "store_true"
     },
+    {
+        "short": None,
+        "long": "--read-jobs",
+        "help": "number of processes reading multiple input files in parallel (default: 1, read them sequentially)",
+        "action": "store"
+    },
+    {
+        "short": None,
+        "long": "--sd-gzip-index",
+        "help": "compress the .idx and .syn files in StarDict files with gzip (default: False)",
+        "action": "store_true"
+    },
     {
         "short": None,
         "long": "--sd-ignore-sametypesequence",
         "help": "ignore the value of sametypesequence in StarDict .ifo files (default: False)",
         "action": "store_true"
     },
+    {
+        "short": None,
+        "long": "--sd-lazy-definitions",
+        "help": "read definitions from the StarDict .dict file only when needed, instead of loading them in memory (default: False)",
+        "action": "store_true"
+    },
     {
         "short": None,
         "long": "--sd-no-dictzip",
@@ -346,12 +401,24 @@ COMMAND_LINE_PARAMETERS = [
         "help": "sort by headword (default: False)",
         "action": "store_true"
     },
+    {
+        "short": None,
+        "long": "--sort-collation",
+        "help": "sort using the given collation: %s (default: None, overrides --sort-ignore-case)" % ("|".join(SORT_COLLATIONS)),
+        "action": "store"
+    },
     {
         "short": None,
         "long": "--sort-ignore-case",
         "help": "ignore case when sorting (default: False)",
         "action": "store_true"
     },
+    {
+        "short": None,
+        "long": "--sort-memory-budget",
+        "help": "when sorting, hold at most this number of MB of sort keys in memory, spilling the rest to temp files (default: no limit)",
+        "action": "store"
+    },
     {
         "short": None,
         "long": "--sort-reverse",
@@ -468,6 +535,14 @@ def check_arguments(args):
         print_error("Format '%s' is not a valid output format" % args.output_format)
         print_error("Valid output formats: %s" % OUTPUT_FORMATS)
         sys.exit(4)
+    if ("dictionary_backend" in args) and (args.dictionary_backend not in DICTIONARY_BACKENDS):
+        print_error("Backend '%s' is not a valid dictionary backend" % args.dictionary_backend)
+        print_error("Valid dictionary backends: %s" % DICTIONARY_BACKENDS)
+        sys.exit(4)
+    if ("sort_collation" in args) and (args.sort_collation is not None) and (args.sort_collation not in SORT_COLLATIONS):
+        print_error("Collation '%s' is not a valid sort collation" % args.sort_collation)
+        print_error("Valid sort collations: %s" % SORT_COLLATIONS)
+        sys.exit(4)
 
 
 def set_default_values(args):
@@ -481,6 +556,7 @@ def set_default_values(args):
     set_default_value("csv_ignore_first_line", False)
     set_default_value("csv_ls", "\n")
     set_default_value("debug", False)
+    set_default_value("dictionary_backend", "memory")
     set_default_value("dictzip_path", None)
     set_default_value("epub_no_compress", False)
     set_default_value("escape_strings", False)
@@ -488,27 +564,35 @@ def set_default_values(args):
     set_default_value("group_by_prefix_length", 2)
     set_default_value("group_by_prefix_function", None)
     set_default_value("group_by_prefix_merge_across_first", False)
+    set_default_value("group_by_prefix_merge_min_bytes", 0)
     set_default_value("group_by_prefix_merge_min_size", 0)
     set_default_value("ignore_case", False)
     set_default_value("ignore_synonyms", False)
     set_default_value("include_index_page", False)
     set_default_value("input_file_encoding", "utf-8")
     set_default_value("input_parser", None)
+    set_default_value("jobs", get_cpu_count())
     set_default_value("keep", False)
     set_default_value("kindlegen_path", None)
     set_default_value("marisa_bin_path", None)
     set_default_value("marisa_index_size", 1000000)
     set_default_value("merge_definitions", False)
+    set_default_value("merge_preserve_sort", False)
     set_default_value("merge_separator", " | ")
     set_default_value("mobi_no_kindlegen", False)
     set_default_value("no_definitions", False)
+    set_default_value("read_jobs", 1)
+    set_default_value("sd_gzip_index", False)
     set_default_value("sd_ignore_sametypesequence", False)
+    set_default_value("sd_lazy_definitions", False)
     set_default_value("sd_no_dictzip", False)
     set_default_value("sort_after", False)
     set_default_value("sort_before", False)
     set_default_value("sort_by_definition", False)
     set_default_value("sort_by_headword", False)
+    set_default_value("sort_collation", None)
     set_default_value("sort_ignore_case", False)
+    set_default_value("sort_memory_budget", None)
     set_default_value("sort_reverse", False)
     set_default_value("version", False)
     set_default_value("author", u"Penelope")
@@ -15,12 +15,25 @@ one for each synonym, with the definition of the original entry).
 """
 
 from __future__ import absolute_import
+import array
 import imp
+import importlib
+import io
+import multiprocessing
 import os
+import pickle
 
+from penelope.external_sort import external_sort
+from penelope.external_sort import get_index
+from penelope.external_sort import get_index_record
+from penelope.external_sort import get_sortable_component
 from penelope.prefix_default import get_prefix as get_prefix_default
+from penelope.utilities import create_temp_file
+from penelope.utilities import delete_file
 from penelope.utilities import get_uuid
+from penelope.utilities import print_debug
 from penelope.utilities import print_error
+from penelope.utilities import print_info
 
 __author__ = "Alberto Pettarin"
 __copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
@@ -30,6 +43,21 @@ __email__ = "alberto@albertopettarin.it"
 __status__ = "Production"
 
 
+# entries sent at once by the worker processes reading input files, see read_input_file()
+READ_BATCH_SIZE = 10000
+
+# sort key of the strings not used for sorting
+EMPTY_SORTABLE_COMPONENT = get_sortable_component(u"")
+
+
+def identity_sort_key(string):
+    return string
+
+
+def lower_sort_key(string):
+    return string.lower()
+
+
 def read_dictionary(args):
     """
     Read the input dictionary from the input files specified
@@ -50,7 +78,7 @@ def read_dictionary(args):
         language_to=args.language_to,
         description_string=args.description
     )
-    dictionary = Dictionary(metadata=metadata)
+    dictionary = create_dictionary(args, metadata=metadata)
     input_format = args.input_format
     if input_format == "bookeen":
         # NOTE
@@ -65,28 +93,149 @@ def read_dictionary(args):
         if input_file_paths is None:
             return None
         import penelope.format_csv
-        return penelope.format_csv.read(dictionary, args, input_file_paths)
+        return read_input_files(penelope.format_csv, dictionary, args, input_file_paths)
     elif input_format == "kobo":
         input_file_paths = prepare_file_paths(args.input_file, ".zip")
         if input_file_paths is None:
             return None
         import penelope.format_kobo
-        return penelope.format_kobo.read(dictionary, args, input_file_paths)
+        return read_input_files(penelope.format_kobo, dictionary, args, input_file_paths)
     elif input_format == "stardict":
         input_file_paths = prepare_file_paths(args.input_file, ".zip")
         if input_file_paths is None:
             return None
         import penelope.format_stardict
-        return penelope.format_stardict.read(dictionary, args, input_file_paths)
+        return read_input_files(penelope.format_stardict, dictionary, args, input_file_paths)
     elif input_format == "xml":
         input_file_paths = prepare_file_paths(args.input_file, ".xml")
         if input_file_paths is None:
             return None
         import penelope.format_xml
-        return penelope.format_xml.read(dictionary, args, input_file_paths)
+        return read_input_files(penelope.format_xml, dictionary, args, input_file_paths)
+    return dictionary
+
+
+def create_dictionary(args, metadata=None):
+    """
+    Create an empty dictionary,
+    using the backend specified in the given arguments.
+
+    Return a Dictionary.
+    """
+    if args.dictionary_backend == "compact":
+        import penelope.dictionary_compact
+        dictionary = penelope.dictionary_compact.CompactDictionary(metadata=metadata)
+    elif args.dictionary_backend == "sqlite":
+        import penelope.dictionary_sqlite
+        dictionary = penelope.dictionary_sqlite.SQLiteDictionary(metadata=metadata)
+    else:
+        dictionary = Dictionary(metadata=metadata)
+    if args.sort_memory_budget is not None:
+        dictionary.sort_memory_budget = int(args.sort_memory_budget) * 1024 * 1024
     return dictionary
 
 
+def read_input_files(format_module, dictionary, args, input_file_paths):
+    """
+    Read the given input files into the dictionary,
+    using the read() function of the given format module.
+
+    If more than one job is requested (with --read-jobs)
+    and there are several input files,
+    each file is parsed in a worker process,
+    with the same dictionary backend,
+    and the entries are added to the dictionary in input order,
+    in batches (see read_input_file()).
+    Files are read sequentially if definitions must be read lazily,
+    as the worker processes cannot share their temp files.
+
+    If reading fails, the dictionary is closed (see Dictionary.close()).
+
+    Return the Dictionary, or None if failed.
+    """
+    jobs = min(int(args.read_jobs), len(input_file_paths))
+    if (jobs > 1) and args.sd_lazy_definitions:
+        print_info("Reading input files sequentially, as --sd-lazy-definitions was specified")
+        jobs = 1
+    if jobs <= 1:
+        result = None
+        try:
+            result = format_module.read(dictionary, args, input_file_paths)
+        finally:
+            if result is None:
+                # close the input files already read with lazy definitions
+                dictionary.close()
+        return result
+    print_debug("Reading %d files with %d jobs..." % (len(input_file_paths), jobs), args.debug)
+    tasks = [(format_module.__name__, args, input_file_path) for input_file_path in input_file_paths]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # imap returns the results in input order, as soon as they are available
+        for input_file_path, batches_file_path in zip(input_file_paths, pool.imap(read_input_file, tasks)):
+            if batches_file_path is None:
+                print_error("Reading from file '%s'... failed" % (input_file_path))
+                return None
+            batches_file_obj = io.open(batches_file_path, "rb")
+            try:
+                while True:
+                    try:
+                        batch = pickle.load(batches_file_obj)
+                    except EOFError:
+                        break
+                    for headword, definition, synonyms in batch:
+                        index = len(dictionary)
+                        dictionary.add_entry(headword=headword, definition=definition)
+                        for synonym in synonyms:
+                            dictionary.add_synonym(synonym=synonym, headword_index=index)
+            finally:
+                batches_file_obj.close()
+                delete_file(None, batches_file_path)
+    finally:
+        pool.terminate()
+        pool.join()
+    print_debug("Reading %d files with %d jobs... done" % (len(input_file_paths), jobs), args.debug)
+    return dictionary
+
+
+def read_input_file(task):
+    """
+    Read a single input file, in a worker process,
+    into a dictionary with the backend specified in args.
+
+    The task is a (format module name, args, input file path) triple.
+
+    The entries are written to a temp file,
+    as pickled lists of at most READ_BATCH_SIZE
+    (headword, definition, list of synonyms) triples,
+    so that neither the worker nor the main process
+    holds all of them in memory at once.
+
+    Return the path of the temp file, or None if failed.
+    """
+    module_name, args, input_file_path = task
+    format_module = importlib.import_module(module_name)
+    dictionary = create_dictionary(args)
+    try:
+        if format_module.read(dictionary, args, [input_file_path]) is None:
+            return None
+        tmp_handler, tmp_path = create_temp_file()
+        os.close(tmp_handler)
+        tmp_file_obj = io.open(tmp_path, "wb")
+        batch = []
+        for entry in dictionary.entries:
+            batch.append((entry.headword, entry.definition, entry.get_synonyms()))
+            if len(batch) >= READ_BATCH_SIZE:
+                pickle.dump(batch, tmp_file_obj, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if len(batch) > 0:
+            pickle.dump(batch, tmp_file_obj, pickle.HIGHEST_PROTOCOL)
+        tmp_file_obj.close()
+        return tmp_path
+    finally:
+        # worker processes do not run atexit functions
+        dictionary.close()
+
+
 def write_dictionary(dictionary, args):
     """
     Write the dictionary to file.
@@ -160,6 +309,9 @@ def prepare_file_paths(string, extension):
 
 
 class DictionaryEntry(object):
+    # dictionaries hold many entries, do not create a __dict__ for each
+    __slots__ = ["headword", "definition", "synonyms"]
+
     def __init__(
             self,
             headword,
@@ -194,6 +346,146 @@ class DictionaryEntry(object):
         return self.headword[0:prefix_length]
 
 
+class LazyDictionaryEntry(DictionaryEntry):
+    """
+    A dictionary entry whose definition is not held in memory,
+    but it is read from the (offset, size) slice of a source
+    (an object with a read(offset, size) method returning bytes)
+    and decoded every time it is accessed.
+
+    Assigning a definition replaces the lazy one.
+    """
+    __slots__ = ["source", "offset", "size", "encoding", "_definition"]
+
+    def __init__(
+            self,
+            headword,
+            source,
+            offset,
+            size,
+            encoding="utf-8"
+    ):
+        self.source = source
+        self.offset = offset
+        self.size = size
+        self.encoding = encoding
+        DictionaryEntry.__init__(self, headword, None)
+
+    @property
+    def definition(self):
+        if self._definition is not None:
+            return self._definition
+        return self.source.read(self.offset, self.size).decode(self.encoding)
+
+    @definition.setter
+    def definition(self, value):
+        self._definition = value
+
+
+class AliasDictionaryEntry(DictionaryEntry):
+    """
+    A dictionary entry created by flattening a synonym:
+    its definition is the one of the source entry,
+    read every time it is accessed,
+    hence it is neither copied nor, for lazy entries, loaded.
+
+    Assigning a definition replaces the aliased one.
+    """
+    __slots__ = ["source", "_definition"]
+
+    def __init__(
+            self,
+            headword,
+            source
+    ):
+        self.source = source
+        DictionaryEntry.__init__(self, headword, None)
+
+    @property
+    def definition(self):
+        if self._definition is not None:
+            return self._definition
+        return self.source.definition
+
+    @definition.setter
+    def definition(self, value):
+        self._definition = value
+
+    def clear_synonyms(self):
+        # aliases rarely get synonyms, create the list only when needed
+        self.synonyms = ()
+
+    def add_synonym(self, synonym):
+        if len(self.synonyms) == 0:
+            self.synonyms = []
+        self.synonyms.append(synonym)
+
+
+class DictionaryGroup(object):
+    """
+    A group of entries of a Dictionary,
+    stored as a list of [start, end) ranges of positions
+    in the sort order of the entries,
+    hence without creating a list of the entries.
+
+    Iterating over it yields the entries, one range after the other.
+    """
+    def __init__(
+            self,
+            entries,
+            sorted_indices
+    ):
+        self.entries = entries
+        self.sorted_indices = sorted_indices
+        self.ranges = []
+        self.length = 0
+        # number of bytes of the entries, if computed by Dictionary.group()
+        self.size = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            for entry in self.get_range(start, end):
+                yield entry
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if (index < 0) or (index >= self.length):
+            raise IndexError("entry index out of range")
+        for start, end in self.ranges:
+            if index < end - start:
+                return self.entries[self.sorted_indices[start + index]]
+            index -= end - start
+
+    def get_range(self, start, end):
+        """
+        Yield the entries at the positions in [start, end)
+        of the sort order.
+        """
+        for position in range(start, end):
+            yield self.entries[self.sorted_indices[position]]
+
+    def add_range(self, start, end):
+        if (len(self.ranges) > 0) and (self.ranges[-1][1] == start):
+            self.ranges[-1][1] = end
+        else:
+            self.ranges.append([start, end])
+        self.length += end - start
+
+    def extend(self, other):
+        for start, end in other.ranges:
+            self.add_range(start, end)
+        self.size += other.size
+
+    def copy(self):
+        group = self.__class__(self.entries, self.sorted_indices)
+        group.extend(self)
+        return group
+
+
 class DictionaryMetadata(object):
     def __init__(
             self,
@@ -277,6 +569,12 @@ class Dictionary(object):
         # list of indices (unsorted or sorted by headword and/or definition)
         self.entries_index_sorted = []
         self.has_synonyms = False
+        # if not None, sort() holds at most this number of bytes of sort keys in memory
+        self.sort_memory_budget = None
+        # (key function, headwords, encoded sort keys) of the last sort, see get_headword_sort_keys()
+        self.sort_key_cache = None
+        # functions closing the sources of the lazy entries, see add_source()
+        self.source_close_functions = []
 
     def __str__(self):
         return """Dictionary
@@ -293,6 +591,27 @@ Has synonyms:               %s
         self.entries_index = {}
         self.entries_index_sorted = []
         self.has_synonyms = False
+        self.sort_key_cache = None
+
+    def add_source(self, close_function):
+        """
+        Register the function closing a source of lazy entries
+        (for example, an input file and its temp directory),
+        which is called by close().
+
+        :param close_function: the function closing the source
+        :type  close_function: function
+        """
+        self.source_close_functions.append(close_function)
+
+    def close(self):
+        """
+        Close the sources of lazy entries, in reverse order,
+        after which their definitions cannot be read anymore.
+        Calling close() again has no effect.
+        """
+        while len(self.source_close_functions) > 0:
+            self.source_close_functions.pop()()
 
     @property
     def unique_headwords(self):
@@ -338,34 +657,121 @@ Has synonyms:               %s
                     syn_with_index.append([synonym, index])
         return syn_with_index
 
-    def sort(self, by_headword=True, by_definition=False, reverse=False, ignore_case=False):
+    def sort(self, by_headword=True, by_definition=False, reverse=False, ignore_case=False, key_function=None):
+        """
+        Sort the entries by headword and/or definition.
+
+        If key_function is not None, it must map a string
+        to its sort key, and it is used instead of lowercasing
+        the strings when ignore_case is True.
+        Keys are computed once per entry, and
+        the keys of the headwords are cached until
+        sort() is called with a different key function.
+
+        If the current order already satisfies the request,
+        the entries are not sorted again.
+
+        The keys are encoded into compact byte strings, and
+        if they exceed self.sort_memory_budget bytes,
+        they are sorted in runs spilled to temp files, and merged.
+        """
         if (not by_headword) and (not by_definition):
-            self.entries_index_sorted = range(len(self.entries))
+            self.entries_index_sorted = self.create_sorted_index(range(len(self.entries)))
             return
-        tmp = []
-        i = 0
-        for entry in self.entries:
-            first = entry.headword if by_headword else u""
+        if key_function is None:
             if ignore_case:
-                first = first.lower()
-            second = entry.definition if by_definition else u""
-            if ignore_case:
-                second = second.lower()
-            tmp.append([
-                first,
-                second,
-                i
-            ])
-            i += 1
-        tmp = sorted(tmp, reverse=reverse)
-        self.entries_index_sorted = []
-        for t in tmp:
-            self.entries_index_sorted.append(t[2])
+                key_function = lower_sort_key
+            else:
+                key_function = identity_sort_key
+
+        if by_headword:
+            get_first = self.get_headword_sort_keys(key_function)
+        else:
+            get_first = lambda index, entry: EMPTY_SORTABLE_COMPONENT
+
+        def get_record(index, entry):
+            second = get_sortable_component(key_function(entry.definition)) if by_definition else EMPTY_SORTABLE_COMPONENT
+            return get_index_record(get_first(index, entry) + second, index, reverse)
+
+        if self.is_sorted_by(get_record):
+            return
+
+        def get_records():
+            index = 0
+            for entry in self.entries:
+                yield get_record(index, entry)
+                index += 1
+
+        self.entries_index_sorted = self.create_sorted_index()
+        append = self.entries_index_sorted.append
+        for record in external_sort(get_records(), self.sort_memory_budget):
+            append(get_index(record, reverse))
+
+    def get_headword_sort_keys(self, key_function):
+        """
+        Return a function mapping (index, entry)
+        to the encoded sort key of the headword of the entry.
+
+        Unless a memory budget is set, the keys are cached,
+        for the given key function only, replacing
+        the keys cached for a different one:
+        a cached key is used only if the headword of the entry
+        is still the same string object it was computed from,
+        hence changing the headword invalidates it.
+
+        :param key_function: the key function
+        :type  key_function: function
+        :rtype: function
+        """
+        if self.sort_memory_budget is not None:
+            return lambda index, entry: get_sortable_component(key_function(entry.headword))
+        if (self.sort_key_cache is None) or (self.sort_key_cache[0] != key_function):
+            self.sort_key_cache = (key_function, [], [])
+        headwords, keys = self.sort_key_cache[1:]
+        missing = len(self.entries) - len(headwords)
+        if missing > 0:
+            headwords.extend([None] * missing)
+            keys.extend([None] * missing)
+
+        def get_key(index, entry):
+            headword = entry.headword
+            key = keys[index]
+            if (key is None) or (headwords[index] is not headword):
+                key = get_sortable_component(key_function(headword))
+                headwords[index] = headword
+                keys[index] = key
+            return key
+        return get_key
+
+    def is_sorted_by(self, get_record):
+        """
+        Return True if entries_index_sorted lists all the entries
+        in increasing order of the given record function.
+        Stop at the first entry out of order.
+        """
+        if len(self.entries_index_sorted) != len(self.entries):
+            return False
+        previous = None
+        for index in self.entries_index_sorted:
+            record = get_record(index, self.entries[index])
+            if (previous is not None) and (record <= previous):
+                return False
+            previous = record
+        return True
+
+    def create_sorted_index(self, indices=()):
+        """
+        Return a new list of entry indices,
+        to be used as entries_index_sorted.
+        """
+        return list(indices)
 
     def flatten_synonyms(self):
         """
         Add a new entry for each synonym,
         using the definition of the original headword.
+        The new entries are aliases of the original ones,
+        so their definitions are not copied.
         At the end, reset the current sort order.
         (You will need to sort it later, if interested in having
         the dictionary sorted by headword and/or definition.)
@@ -374,21 +780,28 @@ Has synonyms:               %s
             # nothing to do
             return
 
-        for entry in self.entries:
+        for index in range(len(self.entries)):
+            entry = self.entries[index]
             for synonym in entry.get_synonyms():
-                self.add_entry(headword=synonym, definition=entry.definition)
+                self.add_entry(entry=AliasDictionaryEntry(synonym, entry))
 
         self.sort(False, False, False, False)
 
-    def merge_definitions(self, merge_function=None, merge_separator=None):
+    def merge_definitions(self, merge_function=None, merge_separator=None, preserve_sort=False):
         """
         Merge definitions of entries with the same headword,
         using merge_function or merge_separator to create the merged definition.
 
-        Note that this function destroys the current dictionary,
-        and re-populate its entries (with the new "merged" entries).
+        Only headwords with more than one entry are touched:
+        their first entry gets the merged definition
+        and the synonyms of the other entries,
+        which are then removed.
+        Hence, the remaining entries keep the order
+        in which their headwords first appeared.
 
-        As a consequence, it resets the current sort order.
+        If preserve_sort is True, the current sort order is kept,
+        each merged entry keeping its own position.
+        Otherwise, the current sort order is reset.
         (You will need to sort it later, if interested in having
         the dictionary sorted by headword and/or definition.)
         """
@@ -409,27 +822,84 @@ Has synonyms:               %s
             # use the default merge function, joining using the merge_separator string
             merge_function = default_merge_function
 
-        # copy previous data
-        original_entries = self.entries
-        original_entries_index = self.entries_index
-        # delete all
-        self.clear()
-        # for all (unique) headwords
-        for headword in original_entries_index:
-            original_entries_index_headword = original_entries_index[headword]
-            definitions_to_be_merged = [original_entries[i].definition for i in original_entries_index_headword]
+        # flags of the entries to be removed
+        removed = bytearray(len(self.entries))
+        for headword in self.get_duplicated_headwords():
+            indices = self.entries_index[headword]
+            definitions_to_be_merged = [self.entries[i].definition for i in indices]
             merged_definition = merge_function(headword, definitions_to_be_merged)
-            self.add_entry(headword=headword, definition=merged_definition)
-            new_headword_index = len(self) - 1
-            # add synonyms to this new entry, by adding all synonyms of the original entries
-            # merged into this new entry (with index new_headword_index in self.entries)
-            for i in original_entries_index_headword:
-                original_entry_synonyms = original_entries[i].get_synonyms()
-                for synonym in original_entry_synonyms:
-                    self.add_synonym(synonym=synonym, headword_index=new_headword_index)
-
-        # not needed, since we called self.clear()
-        # self.sort(False, False, False, False)
+            self.merge_entries(indices, merged_definition)
+            for i in indices[1:]:
+                removed[i] = 1
+        self.remove_entries(removed, preserve_sort=preserve_sort)
+
+    def get_duplicated_headwords(self):
+        """
+        Return the list of the headwords having more than one entry.
+        """
+        return [headword for headword in self.entries_index if len(self.entries_index[headword]) > 1]
+
+    def merge_entries(self, indices, definition):
+        """
+        Set the definition of the first of the given entries,
+        and append the synonyms of the other entries to its own.
+        """
+        first_entry = self.entries[indices[0]]
+        first_entry.definition = definition
+        for i in indices[1:]:
+            for synonym in self.entries[i].get_synonyms():
+                first_entry.add_synonym(synonym)
+
+    def remove_entries(self, removed, preserve_sort=False):
+        """
+        Remove the entries whose flag is set in removed,
+        which must be the only entries of their headwords
+        after the first one.
+        The other entries keep their relative order,
+        and their indices are shifted accordingly.
+
+        :param removed: the flags of the entries to be removed
+        :type  removed: bytearray
+        :param preserve_sort: if True, keep the current sort order
+        :type  preserve_sort: bool
+        """
+        first_removed = removed.find(b"\x01")
+        if first_removed == -1:
+            return
+        for i in range(first_removed, len(removed)):
+            if removed[i]:
+                headword = self.entries[i].headword
+                self.entries_index[headword] = self.entries_index[headword][0:1]
+        kept = array.array("I", [i for i in range(len(removed)) if not removed[i]])
+        self.keep_entries(kept)
+        # only the indices of the entries after the first removed one change
+        for new_index in range(first_removed, len(kept)):
+            self.entries_index[self.entries[new_index].headword] = [new_index]
+        # cached sort keys are stored by index as well
+        if self.sort_key_cache is not None:
+            headwords, keys = self.sort_key_cache[1:]
+            missing = len(removed) - len(headwords)
+            if missing > 0:
+                headwords.extend([None] * missing)
+                keys.extend([None] * missing)
+            headwords[:] = [headwords[i] for i in kept]
+            keys[:] = [keys[i] for i in kept]
+        if preserve_sort:
+            new_indices = array.array("I", [0]) * len(removed)
+            for new_index, i in enumerate(kept):
+                new_indices[i] = new_index
+            self.entries_index_sorted = self.create_sorted_index(
+                [new_indices[i] for i in self.entries_index_sorted if not removed[i]]
+            )
+        else:
+            self.entries_index_sorted = self.create_sorted_index(range(len(kept)))
+
+    def keep_entries(self, kept):
+        """
+        Keep only the entries with the given (increasing) indices.
+        """
+        entries = self.entries
+        self.entries = [entries[i] for i in kept]
 
     def group(
             self,
@@ -437,12 +907,18 @@ Has synonyms:               %s
             prefix_function_path=None,
             prefix_length=2,
             merge_min_size=0,
-            merge_across_first=False
+            merge_across_first=False,
+            merge_min_bytes=0
     ):
         """
         Group headwords by prefix, returning a dictionary containing
         the prefixes as keys (possibly, with a "SPECIAL" key) and
-        the dictionary entries as elements of the list associated with a key.
+        a DictionaryGroup of the dictionary entries associated with a key.
+
+        The entries are read once, in the current sort order,
+        and each group stores the ranges of positions of its entries
+        in the sort order, which are few if the entries are sorted
+        by headword. No list of entries is created.
 
         :param prefix_function_path: the path to a source file containing
                                 a get_prefix function, mapping a headword
@@ -461,13 +937,17 @@ Has synonyms:               %s
         :param merge_across_first: if True, merge groups even when
                              the first character changes
         :type  merge_across_first: False
-        :rtype: (list, list, dict)
+        :param merge_min_bytes: merge headword groups until the given minimum
+                                number of bytes of UTF-8 encoded headwords
+                                and definitions is reached; if 0, does not merge
+        :type  merge_min_bytes: int
+        :rtype: (DictionaryGroup, list, dict)
         """
         def return_triple(groups):
             """
-            Return a (list_special, list, dict),
+            Return a (group_special, list, dict),
             where the list contains the sorted keys of dict,
-            and list_special contains the list of SPECIAL entries.
+            and group_special contains the SPECIAL entries.
             """
             spec = None
             if u"SPECIAL" in groups:
@@ -476,27 +956,50 @@ Has synonyms:               %s
             keys = sorted(groups.keys())
             return (spec, keys, groups)
 
+        def is_complete(group):
+            if (merge_min_size > 0) and (len(group) >= merge_min_size):
+                return True
+            if (merge_min_bytes > 0) and (group.size >= merge_min_bytes):
+                return True
+            return False
+
         # load the prefix function
         get_prefix = get_prefix_default
         if prefix_function is not None:
             get_prefix = prefix_function
         elif prefix_function_path is not None:
             try:
-                get_prefix = imp.load_source("", prefix_function).get_prefix
+                get_prefix = imp.load_source("", prefix_function_path).get_prefix
             except:
                 pass
 
-        # create groups
+        # create groups, in a single pass over the sorted entries,
+        # adding a range to a group when the prefix changes
+        sorted_indices = self.get_sorted_indices()
         raw_groups = {}
+        group = None
+        previous_prefix = None
+        start = 0
+        position = 0
         for index in self.entries_index_sorted:
             entry = self.entries[index]
             prefix = get_prefix(entry.headword, prefix_length)
-            if prefix not in raw_groups:
-                raw_groups[prefix] = []
-            raw_groups[prefix].append(self.entries[index])
+            if (group is None) or (prefix != previous_prefix):
+                if group is not None:
+                    group.add_range(start, position)
+                if prefix not in raw_groups:
+                    raw_groups[prefix] = self.create_group(sorted_indices)
+                group = raw_groups[prefix]
+                previous_prefix = prefix
+                start = position
+            if merge_min_bytes > 0:
+                group.size += len(entry.headword.encode("utf-8")) + len(entry.definition.encode("utf-8"))
+            position += 1
+        if group is not None:
+            group.add_range(start, position)
 
         # if no merge is requested, return
-        if merge_min_size == 0:
+        if (merge_min_size == 0) and (merge_min_bytes == 0):
             return return_triple(raw_groups)
 
         # merge small groups
@@ -506,17 +1009,37 @@ Has synonyms:               %s
             merged_groups[u"SPECIAL"] = raw_groups[u"SPECIAL"]
             del raw_groups[u"SPECIAL"]
         keys = sorted(raw_groups.keys())
+        if len(keys) == 0:
+            return return_triple(merged_groups)
         accumulator_key = keys[0]
         accumulator = raw_groups[accumulator_key]
         for key in keys[1:]:
             if (
-                    (len(accumulator) >= merge_min_size) or
+                    is_complete(accumulator) or
                     ((not merge_across_first) and (key[0] != accumulator_key[0]))
             ):
                 merged_groups[accumulator_key] = accumulator
                 accumulator_key = key
                 accumulator = raw_groups[accumulator_key]
             else:
-                accumulator += raw_groups[key]
+                if accumulator is raw_groups[accumulator_key]:
+                    # do not modify the raw group
+                    accumulator = accumulator.copy()
+                accumulator.extend(raw_groups[key])
         merged_groups[accumulator_key] = accumulator
         return return_triple(merged_groups)
+
+    def get_sorted_indices(self):
+        """
+        Return entries_index_sorted, or an equivalent sequence
+        of the entry indices in the current sort order
+        supporting fast access by position.
+        """
+        return self.entries_index_sorted
+
+    def create_group(self, sorted_indices):
+        """
+        Return a new, empty DictionaryGroup of the entries,
+        whose positions refer to the given sorted indices.
+        """
+        return DictionaryGroup(self.entries, sorted_indices)
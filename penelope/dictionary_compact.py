@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+The CompactDictionary class is a Dictionary
+storing its entries in a compact, columnar form.
+
+Headwords and definitions are kept in two parallel lists,
+synonyms are kept in arrays shared by all the entries,
+and DictionaryEntry-like views are created only when accessed.
+"""
+
+from __future__ import absolute_import
+import array
+
+from penelope.dictionary import Dictionary
+
+__author__ = "Alberto Pettarin"
+__copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__version__ = "3.1.3"
+__email__ = "alberto@albertopettarin.it"
+__status__ = "Production"
+
+# marks a synonym removed by clear_synonyms()
+REMOVED_SYNONYM = 0xFFFFFFFF
+
+
+class CompactDictionaryEntry(object):
+    """
+    A view on the i-th entry of a CompactEntries object,
+    with the same interface of DictionaryEntry.
+    """
+    __slots__ = ["entries", "index"]
+
+    def __init__(self, entries, index):
+        self.entries = entries
+        self.index = index
+
+    @property
+    def headword(self):
+        return self.entries.headwords[self.index]
+
+    @headword.setter
+    def headword(self, value):
+        self.entries.headwords[self.index] = value
+
+    @property
+    def definition(self):
+        return self.entries.definitions[self.index]
+
+    @definition.setter
+    def definition(self, value):
+        self.entries.definitions[self.index] = value
+
+    def clear_synonyms(self):
+        self.entries.clear_synonyms(self.index)
+
+    def add_synonym(self, synonym):
+        self.entries.add_synonym(synonym, self.index)
+
+    def get_synonyms(self):
+        return self.entries.get_synonyms(self.index)
+
+    def __len__(self):
+        if self.headword is None:
+            return 0
+        return len(self.headword)
+
+    def __str__(self):
+        return u"""DictionaryEntry
+    Headword: '%s'
+    Definition: '%s'""" % (self.headword, self.definition)
+
+    def prefix(self, prefix_length):
+        if len(self) < prefix_length:
+            return self.headword
+        return self.headword[0:prefix_length]
+
+
+class CompactEntries(object):
+    """
+    The entries of a CompactDictionary.
+
+    Synonyms are appended to a list of strings,
+    together with the index of their entry in an array.
+    When the synonyms of an entry are requested,
+    they are located through a compressed sparse row (CSR) table,
+    built from the arrays and kept until a synonym is added or removed.
+    """
+    def __init__(self):
+        self.headwords = []
+        self.definitions = []
+        self.synonyms = []
+        self.synonym_entries = array.array("I")
+        self.csr_offsets = None
+        self.csr_synonyms = None
+
+    def __len__(self):
+        return len(self.headwords)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.headwords)
+        if (index < 0) or (index >= len(self.headwords)):
+            raise IndexError("entry index out of range")
+        return CompactDictionaryEntry(self, index)
+
+    def __iter__(self):
+        # the length is checked at each step, as entries might be added meanwhile
+        index = 0
+        while index < len(self.headwords):
+            yield CompactDictionaryEntry(self, index)
+            index += 1
+
+    def append(self, headword, definition):
+        self.headwords.append(headword)
+        self.definitions.append(definition)
+
+    def add_synonym(self, synonym, index):
+        self.synonyms.append(synonym)
+        self.synonym_entries.append(index)
+        self.csr_offsets = None
+
+    def clear_synonyms(self, index):
+        for position, synonym_entry in enumerate(self.synonym_entries):
+            if synonym_entry == index:
+                self.synonym_entries[position] = REMOVED_SYNONYM
+        self.csr_offsets = None
+
+    def build_csr(self):
+        """
+        Build the CSR table of the synonyms:
+        the synonyms of the i-th entry are the ones
+        at positions csr_synonyms[csr_offsets[i]:csr_offsets[i+1]],
+        in the order they were added.
+        """
+        length = len(self.headwords)
+        offsets = array.array("I", [0]) * (length + 1)
+        for synonym_entry in self.synonym_entries:
+            if synonym_entry != REMOVED_SYNONYM:
+                offsets[synonym_entry + 1] += 1
+        for index in range(length):
+            offsets[index + 1] += offsets[index]
+        positions = array.array("I", offsets[0:length])
+        csr_synonyms = array.array("I", [0]) * offsets[length]
+        for synonym_position, synonym_entry in enumerate(self.synonym_entries):
+            if synonym_entry != REMOVED_SYNONYM:
+                csr_synonyms[positions[synonym_entry]] = synonym_position
+                positions[synonym_entry] += 1
+        self.csr_offsets = offsets
+        self.csr_synonyms = csr_synonyms
+
+    def merge(self, indices, definition):
+        """
+        Set the definition of the first of the given entries,
+        and append the synonyms of the other entries to its own,
+        removing them from the other entries.
+
+        The CSR table is not invalidated, as it stays valid
+        for the entries not merged yet:
+        call keep() when done merging.
+        """
+        first = indices[0]
+        self.definitions[first] = definition
+        if len(self.synonyms) == 0:
+            return
+        if (self.csr_offsets is None) or (len(self.csr_offsets) <= len(self.headwords)):
+            self.build_csr()
+        for index in indices[1:]:
+            for position in self.csr_synonyms[self.csr_offsets[index]:self.csr_offsets[index + 1]]:
+                self.synonyms.append(self.synonyms[position])
+                self.synonym_entries.append(first)
+                self.synonym_entries[position] = REMOVED_SYNONYM
+
+    def keep(self, kept):
+        """
+        Keep only the entries with the given (increasing) indices,
+        dropping the removed synonyms.
+        """
+        new_indices = array.array("I", [REMOVED_SYNONYM]) * len(self.headwords)
+        for new_index, index in enumerate(kept):
+            new_indices[index] = new_index
+        self.headwords = [self.headwords[index] for index in kept]
+        self.definitions = [self.definitions[index] for index in kept]
+        synonyms = []
+        synonym_entries = array.array("I")
+        for position, synonym_entry in enumerate(self.synonym_entries):
+            if (synonym_entry != REMOVED_SYNONYM) and (new_indices[synonym_entry] != REMOVED_SYNONYM):
+                synonyms.append(self.synonyms[position])
+                synonym_entries.append(new_indices[synonym_entry])
+        self.synonyms = synonyms
+        self.synonym_entries = synonym_entries
+        self.csr_offsets = None
+        self.csr_synonyms = None
+
+    def get_synonyms(self, index):
+        if len(self.synonyms) == 0:
+            return []
+        if self.csr_offsets is None:
+            self.build_csr()
+        if index + 1 >= len(self.csr_offsets):
+            # entry added after the CSR table was built, hence without synonyms
+            return []
+        return [self.synonyms[position] for position in self.csr_synonyms[self.csr_offsets[index]:self.csr_offsets[index + 1]]]
+
+
+class CompactEntriesIndex(object):
+    """
+    Map each headword to the list of the indices of its entries,
+    like the entries_index dict of Dictionary.
+
+    The index of the first entry of each headword is stored in a dict,
+    and only duplicated headwords have an array of further indices.
+    Lists are created only when accessed.
+    """
+    def __init__(self):
+        self.first = {}
+        self.others = {}
+
+    def __len__(self):
+        return len(self.first)
+
+    def __contains__(self, headword):
+        return headword in self.first
+
+    def __iter__(self):
+        return iter(self.first)
+
+    def __getitem__(self, headword):
+        indices = [self.first[headword]]
+        if headword in self.others:
+            indices.extend(self.others[headword])
+        return indices
+
+    def __setitem__(self, headword, indices):
+        self.first[headword] = indices[0]
+        if len(indices) > 1:
+            self.others[headword] = array.array("I", indices[1:])
+        else:
+            self.others.pop(headword, None)
+
+    def keys(self):
+        return self.first.keys()
+
+    def get(self, headword, default=None):
+        if headword not in self.first:
+            return default
+        return self[headword]
+
+    def add(self, headword, index):
+        if headword not in self.first:
+            self.first[headword] = index
+        elif headword not in self.others:
+            self.others[headword] = array.array("I", [index])
+        else:
+            self.others[headword].append(index)
+
+
+class CompactDictionary(Dictionary):
+    """
+    A Dictionary storing its entries in a compact, columnar form.
+
+    The entries, entries_index and entries_index_sorted attributes
+    keep the interface of Dictionary,
+    but entries are views created on demand,
+    entries_index lists are created on demand,
+    and entries_index_sorted is an array.
+
+    Definitions of lazy entries are read when they are added.
+    """
+    def __init__(
+            self,
+            metadata=None
+    ):
+        Dictionary.__init__(self, metadata=metadata)
+        self.clear()
+
+    def clear(self):
+        # create new objects, as views on the old entries might still be in use
+        self.entries = CompactEntries()
+        self.entries_index = CompactEntriesIndex()
+        self.entries_index_sorted = array.array("I")
+        self.has_synonyms = False
+        self.sort_key_cache = None
+
+    def add_synonym(self, synonym, headword_index):
+        if headword_index < len(self):
+            self.entries.add_synonym(synonym, headword_index)
+            self.has_synonyms = True
+
+    def add_entry(self, entry=None, headword=None, definition=None):
+        index = len(self.entries)
+        if entry is None:
+            self.entries.append(headword, definition)
+        else:
+            headword = entry.headword
+            self.entries.append(headword, entry.definition)
+            for synonym in entry.get_synonyms():
+                self.add_synonym(synonym=synonym, headword_index=index)
+        self.entries_index.add(headword, index)
+        self.entries_index_sorted.append(index)
+
+    def create_sorted_index(self, indices=()):
+        return array.array("I", indices)
+
+    def flatten_synonyms(self):
+        """
+        Add a new entry for each synonym,
+        sharing the definition string of the original headword,
+        reading the CSR table directly, without creating views.
+        At the end, reset the current sort order.
+        """
+        if not self.has_synonyms:
+            # nothing to do
+            return
+        entries = self.entries
+        if (entries.csr_offsets is None) or (len(entries.csr_offsets) <= len(entries)):
+            entries.build_csr()
+        offsets = entries.csr_offsets
+        csr_synonyms = entries.csr_synonyms
+        for index in range(len(entries)):
+            definition = entries.definitions[index]
+            for position in csr_synonyms[offsets[index]:offsets[index + 1]]:
+                self.add_entry(headword=entries.synonyms[position], definition=definition)
+        self.sort(False, False, False, False)
+
+    def get_duplicated_headwords(self):
+        return list(self.entries_index.others)
+
+    def merge_entries(self, indices, definition):
+        self.entries.merge(indices, definition)
+
+    def keep_entries(self, kept):
+        self.entries.keep(kept)
+
+    def get_synonyms(self):
+        syn_with_index = []
+        if self.has_synonyms:
+            entries = self.entries
+            if (entries.csr_offsets is None) or (len(entries.csr_offsets) <= len(entries)):
+                entries.build_csr()
+            # read the CSR table directly, without creating views
+            offsets = entries.csr_offsets
+            csr_synonyms = entries.csr_synonyms
+            synonyms = entries.synonyms
+            for index in self.entries_index_sorted:
+                start = offsets[index]
+                end = offsets[index + 1]
+                while start < end:
+                    syn_with_index.append([synonyms[csr_synonyms[start]], index])
+                    start += 1
+        return syn_with_index
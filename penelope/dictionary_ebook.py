@@ -260,6 +260,7 @@ p.groupDefinition {
         self.ebook_format = ebook_format
         self.args = args
         self.root_directory_path = None
+        self.output_file_obj = None
         self.cover = None
         self.files = []
         self.manifest_files = []
@@ -275,8 +276,6 @@ p.groupDefinition {
             delete_directory(self.root_directory_path)
 
     def add_file(self, relative_path, contents, mode=zipfile.ZIP_DEFLATED):
-        file_path = os.path.join(self.root_directory_path, relative_path)
-        file_obj = io.open(file_path, "wb")
         try:
             # Python 2
             if isinstance(contents, unicode):
@@ -288,8 +287,14 @@ p.groupDefinition {
         except:
             # should not occur
             pass
-        file_obj.write(contents)
-        file_obj.close()
+        if self.output_file_obj is not None:
+            # write straight into the output zip file
+            self.output_file_obj.writestr(relative_path, contents, compress_type=mode)
+        else:
+            file_path = os.path.join(self.root_directory_path, relative_path)
+            file_obj = io.open(file_path, "wb")
+            file_obj.write(contents)
+            file_obj.close()
         self.files.append({"path": relative_path, "mode": mode})
 
     def write_cover(self, cover_path_absolute):
@@ -468,7 +473,15 @@ p.groupDefinition {
         ncx_contents = self.NCX_TEMPLATE % (self.args.identifier, self.args.title, ncx_items)
         self.add_file_manifest(u"OEBPS/toc.ncx", u"toc.ncx", ncx_contents, u"application/x-dtbncx+xml")
 
-    def write(self, file_path_absolute, compress=True):
+    def write(self, file_path_absolute, compress=True, stream=False):
+        """
+        Write the ebook files into a new tmp directory,
+        and, if compress is True, compress them into file_path_absolute.
+
+        If stream is True (and compress is True),
+        write the files straight into file_path_absolute instead,
+        without creating the tmp directory.
+        """
         # get cover path
         cover_path_absolute = self.args.cover_path
         if cover_path_absolute is not None:
@@ -479,6 +492,16 @@ p.groupDefinition {
         if custom_css_path_absolute is not None:
             custom_css_path_absolute = os.path.abspath(custom_css_path_absolute)
 
+        if compress and stream:
+            # create output file, mimetype must be its first file
+            self.output_file_obj = zipfile.ZipFile(file_path_absolute, "w", compression=zipfile.ZIP_DEFLATED)
+            try:
+                self.write_files(cover_path_absolute, custom_css_path_absolute)
+            finally:
+                self.output_file_obj.close()
+                self.output_file_obj = None
+            return
+
         # create new tmp directory and cd there
         self.root_directory_path = create_temp_directory()
         cwd = os.getcwd()
@@ -486,6 +509,19 @@ p.groupDefinition {
         os.makedirs(u"META-INF")
         os.makedirs(u"OEBPS")
 
+        self.write_files(cover_path_absolute, custom_css_path_absolute)
+
+        # compress
+        if compress:
+            output_file_obj = zipfile.ZipFile(file_path_absolute, "w", compression=zipfile.ZIP_DEFLATED)
+            for file_to_compress in self.files:
+                output_file_obj.write(file_to_compress["path"], compress_type=file_to_compress["mode"])
+            output_file_obj.close()
+
+        # return to previous cwd
+        os.chdir(cwd)
+
+    def write_files(self, cover_path_absolute, custom_css_path_absolute):
         # add mimetype and container.xml
         if self.ebook_format in [self.EPUB2]:   # add EPUB3 here
             self.add_file(u"mimetype", self.MIMETYPE_CONTENTS, mode=zipfile.ZIP_STORED)
@@ -510,13 +546,3 @@ p.groupDefinition {
 
         # write opf
         self.write_opf()
-
-        # compress
-        if compress:
-            output_file_obj = zipfile.ZipFile(file_path_absolute, "w", compression=zipfile.ZIP_DEFLATED)
-            for file_to_compress in self.files:
-                output_file_obj.write(file_to_compress["path"], compress_type=file_to_compress["mode"])
-            output_file_obj.close()
-
-        # return to previous cwd
-        os.chdir(cwd)
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+The SQLiteDictionary class is a Dictionary
+storing its entries in an on-disk SQLite database,
+so that dictionaries larger than the available memory
+can be read, sorted, merged and written.
+
+Entries are inserted in batches, read with batched cursors,
+and sorted by SQLite itself, which spills to disk if needed.
+"""
+
+from __future__ import absolute_import
+import array
+import atexit
+import os
+import sqlite3
+
+from penelope.dictionary import Dictionary
+from penelope.dictionary import DictionaryGroup
+from penelope.external_sort import get_sortable_key
+from penelope.utilities import create_temp_directory
+from penelope.utilities import delete_directory
+
+__author__ = "Alberto Pettarin"
+__copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__version__ = "3.1.3"
+__email__ = "alberto@albertopettarin.it"
+__status__ = "Production"
+
+DATABASE_FILE_NAME = u"dictionary.sqlite"
+BATCH_SIZE = 10000                          # rows inserted or fetched at once
+
+
+class SQLiteDictionaryEntry(object):
+    """
+    A view on the i-th entry of a SQLiteEntries object,
+    with the same interface of DictionaryEntry.
+
+    Headword and definition are read when the view is created,
+    and assigning them updates the database.
+    """
+    __slots__ = ["entries", "index", "cached_headword", "cached_definition"]
+
+    def __init__(self, entries, index, headword, definition):
+        self.entries = entries
+        self.index = index
+        self.cached_headword = headword
+        self.cached_definition = definition
+
+    @property
+    def headword(self):
+        return self.cached_headword
+
+    @headword.setter
+    def headword(self, value):
+        self.entries.update_entry(self.index, "headword", value)
+        self.cached_headword = value
+
+    @property
+    def definition(self):
+        return self.cached_definition
+
+    @definition.setter
+    def definition(self, value):
+        self.entries.update_entry(self.index, "definition", value)
+        self.cached_definition = value
+
+    def clear_synonyms(self):
+        self.entries.clear_synonyms(self.index)
+
+    def add_synonym(self, synonym):
+        self.entries.add_synonym(synonym, self.index)
+
+    def get_synonyms(self):
+        return self.entries.get_synonyms(self.index)
+
+    def __len__(self):
+        if self.headword is None:
+            return 0
+        return len(self.headword)
+
+    def __str__(self):
+        return u"""DictionaryEntry
+    Headword: '%s'
+    Definition: '%s'""" % (self.headword, self.definition)
+
+    def prefix(self, prefix_length):
+        if len(self) < prefix_length:
+            return self.headword
+        return self.headword[0:prefix_length]
+
+
+class SQLiteEntries(object):
+    """
+    The entries of a SQLiteDictionary,
+    stored in tables whose names end with the given generation number,
+    so that a new set of entries can be created
+    while the old one is still being read.
+
+    The index of an entry is its id in the entries table.
+    Insertions are buffered and executed in batches,
+    and pending insertions are flushed before any query.
+    """
+    def __init__(self, connection, generation):
+        self.connection = connection
+        self.entries_table = "entries_%d" % (generation)
+        self.synonyms_table = "synonyms_%d" % (generation)
+        self.sorted_table = "sorted_%d" % (generation)
+        self.connection.execute("CREATE TABLE %s (id INTEGER PRIMARY KEY, headword TEXT, definition TEXT)" % (self.entries_table))
+        self.connection.execute("CREATE TABLE %s (position INTEGER PRIMARY KEY, entry_id INTEGER, synonym TEXT)" % (self.synonyms_table))
+        self.connection.execute("CREATE TABLE %s (position INTEGER PRIMARY KEY, entry_id INTEGER)" % (self.sorted_table))
+        self.length = 0
+        self.has_headword_index = False
+        self.has_synonyms_index = False
+        # if True, entries_index_sorted is read from the sorted table
+        self.is_sorted = False
+        self.pending_entries = []
+        self.pending_synonyms = []
+        self.pending_sorted = []
+        # entries fetched by the last batch of a sorted iteration
+        self.prefetched = {}
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if (index < 0) or (index >= self.length):
+            raise IndexError("entry index out of range")
+        if index in self.prefetched:
+            headword, definition = self.prefetched[index]
+            return SQLiteDictionaryEntry(self, index, headword, definition)
+        self.flush()
+        row = self.connection.execute("SELECT headword, definition FROM %s WHERE id = ?" % (self.entries_table), (index,)).fetchone()
+        return SQLiteDictionaryEntry(self, index, row[0], row[1])
+
+    def __iter__(self):
+        # fetch by id ranges, as entries might be added meanwhile
+        start = 0
+        while start < self.length:
+            self.flush()
+            rows = self.connection.execute(
+                "SELECT id, headword, definition FROM %s WHERE id >= ? ORDER BY id LIMIT ?" % (self.entries_table),
+                (start, BATCH_SIZE)
+            ).fetchall()
+            if len(rows) == 0:
+                return
+            for index, headword, definition in rows:
+                yield SQLiteDictionaryEntry(self, index, headword, definition)
+            start = rows[-1][0] + 1
+
+    def get_sorted_range(self, start, end):
+        """
+        Yield the entries at the positions in [start, end)
+        of the current sort order, with a single range query.
+        """
+        self.flush()
+        if self.is_sorted:
+            # the positions of the sorted table start from 1
+            query = "SELECT e.id, e.headword, e.definition FROM %s o JOIN %s e ON e.id = o.entry_id WHERE o.position > ? AND o.position <= ? ORDER BY o.position" % (self.sorted_table, self.entries_table)
+        else:
+            query = "SELECT id, headword, definition FROM %s WHERE id >= ? AND id < ? ORDER BY id" % (self.entries_table)
+        cursor = self.connection.cursor()
+        cursor.execute(query, (start, end))
+        try:
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if len(rows) == 0:
+                    return
+                for index, headword, definition in rows:
+                    yield SQLiteDictionaryEntry(self, index, headword, definition)
+        finally:
+            cursor.close()
+
+    def flush(self):
+        if len(self.pending_entries) > 0:
+            self.connection.executemany("INSERT INTO %s (id, headword, definition) VALUES (?, ?, ?)" % (self.entries_table), self.pending_entries)
+            self.pending_entries = []
+        if len(self.pending_synonyms) > 0:
+            self.connection.executemany("INSERT INTO %s (entry_id, synonym) VALUES (?, ?)" % (self.synonyms_table), self.pending_synonyms)
+            self.pending_synonyms = []
+        if len(self.pending_sorted) > 0:
+            self.connection.executemany("INSERT INTO %s (entry_id) VALUES (?)" % (self.sorted_table), self.pending_sorted)
+            self.pending_sorted = []
+
+    def append(self, headword, definition):
+        index = self.length
+        self.pending_entries.append((index, headword, definition))
+        self.length += 1
+        if self.is_sorted:
+            self.pending_sorted.append((index,))
+        if len(self.pending_entries) >= BATCH_SIZE:
+            self.flush()
+        return index
+
+    def update_entry(self, index, column, value):
+        self.flush()
+        self.prefetched.pop(index, None)
+        self.connection.execute("UPDATE %s SET %s = ? WHERE id = ?" % (self.entries_table, column), (value, index))
+
+    def add_synonym(self, synonym, index):
+        self.pending_synonyms.append((index, synonym))
+        if len(self.pending_synonyms) >= BATCH_SIZE:
+            self.flush()
+
+    def clear_synonyms(self, index):
+        self.flush()
+        self.connection.execute("DELETE FROM %s WHERE entry_id = ?" % (self.synonyms_table), (index,))
+
+    def create_synonyms_index(self):
+        if not self.has_synonyms_index:
+            self.connection.execute("CREATE INDEX %s_entry_id ON %s (entry_id)" % (self.synonyms_table, self.synonyms_table))
+            self.has_synonyms_index = True
+
+    def get_synonyms(self, index):
+        self.flush()
+        self.create_synonyms_index()
+        rows = self.connection.execute("SELECT synonym FROM %s WHERE entry_id = ? ORDER BY position" % (self.synonyms_table), (index,))
+        return [row[0] for row in rows]
+
+    def get_all_synonyms(self):
+        """
+        Return a list of [synonym, entry index] pairs,
+        following the order of entries_index_sorted
+        and the order in which the synonyms were added.
+        """
+        self.flush()
+        if self.is_sorted:
+            query = "SELECT s.synonym, s.entry_id FROM %s o JOIN %s s ON s.entry_id = o.entry_id ORDER BY o.position, s.position" % (self.sorted_table, self.synonyms_table)
+        else:
+            query = "SELECT synonym, entry_id FROM %s ORDER BY entry_id, position" % (self.synonyms_table)
+        self.create_synonyms_index()
+        return [[row[0], row[1]] for row in self.connection.execute(query)]
+
+    def create_headword_index(self):
+        if not self.has_headword_index:
+            self.connection.execute("CREATE INDEX %s_headword ON %s (headword)" % (self.entries_table, self.entries_table))
+            self.has_headword_index = True
+
+    def drop(self):
+        self.pending_entries = []
+        self.pending_synonyms = []
+        self.pending_sorted = []
+        self.prefetched = {}
+        for table in [self.entries_table, self.synonyms_table, self.sorted_table]:
+            self.connection.execute("DROP TABLE IF EXISTS %s" % (table))
+
+
+class SQLiteEntriesIndex(object):
+    """
+    Map each headword to the list of the indices of its entries,
+    like the entries_index dict of Dictionary,
+    querying the entries table.
+
+    Headwords are iterated in order of first appearance.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+
+    def query(self, query, parameters=()):
+        self.entries.flush()
+        self.entries.create_headword_index()
+        return self.entries.connection.execute(query % (self.entries.entries_table), parameters)
+
+    def __len__(self):
+        return self.query("SELECT COUNT(DISTINCT headword) FROM %s").fetchone()[0]
+
+    def __contains__(self, headword):
+        return self.query("SELECT 1 FROM %s WHERE headword = ? LIMIT 1", (headword,)).fetchone() is not None
+
+    def __iter__(self):
+        cursor = self.query("SELECT headword FROM %s GROUP BY headword ORDER BY MIN(id)")
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if len(rows) == 0:
+                return
+            for row in rows:
+                yield row[0]
+
+    def __getitem__(self, headword):
+        indices = [row[0] for row in self.query("SELECT id FROM %s WHERE headword = ? ORDER BY id", (headword,))]
+        if len(indices) == 0:
+            raise KeyError(headword)
+        return indices
+
+    def keys(self):
+        return iter(self)
+
+    def get(self, headword, default=None):
+        if headword not in self:
+            return default
+        return self[headword]
+
+
+class SQLiteSortedIndex(object):
+    """
+    The list of the entry indices in the current sort order,
+    like the entries_index_sorted list of Dictionary.
+
+    If the entries are not sorted, the indices are not stored.
+    Iterating over it also prefetches the entries, in batches,
+    so that accessing them by index does not query the database.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self.entries)
+        if (position < 0) or (position >= len(self.entries)):
+            raise IndexError("position out of range")
+        if not self.entries.is_sorted:
+            return position
+        self.entries.flush()
+        return self.entries.connection.execute(
+            "SELECT entry_id FROM %s ORDER BY position LIMIT 1 OFFSET ?" % (self.entries.sorted_table),
+            (position,)
+        ).fetchone()[0]
+
+    def __iter__(self):
+        entries = self.entries
+        entries.flush()
+        if entries.is_sorted:
+            query = "SELECT e.id, e.headword, e.definition FROM %s o JOIN %s e ON e.id = o.entry_id ORDER BY o.position" % (entries.sorted_table, entries.entries_table)
+        else:
+            query = "SELECT id, headword, definition FROM %s ORDER BY id" % (entries.entries_table)
+        cursor = entries.connection.cursor()
+        cursor.execute(query)
+        try:
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if len(rows) == 0:
+                    return
+                entries.prefetched = dict([(row[0], (row[1], row[2])) for row in rows])
+                for row in rows:
+                    yield row[0]
+        finally:
+            entries.prefetched = {}
+            cursor.close()
+
+    def append(self, index):
+        # the storage already records the order of the new entries
+        pass
+
+
+class SQLiteDictionaryGroup(DictionaryGroup):
+    """
+    A DictionaryGroup of a SQLiteDictionary,
+    fetching the entries of each range with a single query.
+    """
+    def get_range(self, start, end):
+        return self.entries.get_sorted_range(start, end)
+
+
+class SQLiteDictionary(Dictionary):
+    """
+    A Dictionary storing its entries in a SQLite database.
+
+    The entries, entries_index and entries_index_sorted attributes
+    keep the interface of Dictionary,
+    but they query the database on demand.
+
+    If database_path is None, the database is created
+    in a temp directory, deleted at exit.
+
+    Definitions of lazy entries are read when they are added.
+    """
+    def __init__(
+            self,
+            metadata=None,
+            database_path=None
+    ):
+        Dictionary.__init__(self, metadata=metadata)
+        self.tmp_path = None
+        if database_path is None:
+            self.tmp_path = create_temp_directory()
+            database_path = os.path.join(self.tmp_path, DATABASE_FILE_NAME)
+            atexit.register(delete_directory, self.tmp_path)
+        self.database_path = database_path
+        self.connection = sqlite3.connect(database_path)
+        # atexit calls are LIFO, close the database before deleting it
+        atexit.register(self.connection.close)
+        # the database is a scratch file, no need to survive crashes
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.generation = 0
+        self.clear()
+
+    def close(self):
+        """
+        Close the sources of lazy entries and the database,
+        deleting it if it was created in a temp directory.
+
+        Processes not running atexit functions,
+        like the workers reading input files in parallel,
+        must call close() to remove the database.
+        """
+        Dictionary.close(self)
+        self.connection.close()
+        if self.tmp_path is not None:
+            delete_directory(self.tmp_path)
+            self.tmp_path = None
+
+    def clear(self):
+        # create new tables, as views on the old entries might still be in use
+        self.generation += 1
+        self.entries = SQLiteEntries(self.connection, self.generation)
+        self.entries_index = SQLiteEntriesIndex(self.entries)
+        self.entries_index_sorted = SQLiteSortedIndex(self.entries)
+        self.has_synonyms = False
+
+    def add_synonym(self, synonym, headword_index):
+        if headword_index < len(self):
+            self.entries.add_synonym(synonym, headword_index)
+            self.has_synonyms = True
+
+    def add_entry(self, entry=None, headword=None, definition=None):
+        if entry is None:
+            self.entries.append(headword, definition)
+        else:
+            index = self.entries.append(entry.headword, entry.definition)
+            for synonym in entry.get_synonyms():
+                self.add_synonym(synonym=synonym, headword_index=index)
+
+    def get_synonyms(self):
+        if not self.has_synonyms:
+            return []
+        return self.entries.get_all_synonyms()
+
+    def sort(self, by_headword=True, by_definition=False, reverse=False, ignore_case=False, key_function=None):
+        """
+        Sort the entries by headword and/or definition,
+        with the same semantics of Dictionary.sort(),
+        letting SQLite sort the rows by the encoded sort keys.
+        """
+        entries = self.entries
+        entries.flush()
+        entries.connection.execute("DELETE FROM %s" % (entries.sorted_table))
+        if (not by_headword) and (not by_definition):
+            entries.is_sorted = False
+            return
+        if key_function is None:
+            if ignore_case:
+                key_function = lambda string: string.lower()
+            else:
+                key_function = lambda string: string
+        self.connection.create_function("penelope_sort_key", 1, lambda string: sqlite3.Binary(get_sortable_key(key_function(string))))
+        direction = " DESC" if reverse else ""
+        order = []
+        if by_headword:
+            order.append("penelope_sort_key(headword)%s" % (direction))
+        if by_definition:
+            order.append("penelope_sort_key(definition)%s" % (direction))
+        order.append("id%s" % (direction))
+        entries.connection.execute("INSERT INTO %s (entry_id) SELECT id FROM %s ORDER BY %s" % (entries.sorted_table, entries.entries_table, ", ".join(order)))
+        entries.is_sorted = True
+
+    def flatten_synonyms(self):
+        """
+        Add a new entry for each synonym,
+        using the definition of the original headword,
+        with a single query.
+        At the end, reset the current sort order.
+        """
+        if not self.has_synonyms:
+            # nothing to do
+            return
+        entries = self.entries
+        entries.flush()
+        # new ids follow the largest one, in the order of the original entries
+        entries.connection.execute(
+            "INSERT INTO %s (headword, definition) SELECT s.synonym, e.definition FROM %s s JOIN %s e ON e.id = s.entry_id ORDER BY e.id, s.position" % (
+                entries.entries_table,
+                entries.synonyms_table,
+                entries.entries_table
+            )
+        )
+        entries.length = entries.connection.execute("SELECT COUNT(*) FROM %s" % (entries.entries_table)).fetchone()[0]
+        self.sort(False, False, False, False)
+
+    def get_sorted_indices(self):
+        # accessing the sorted table by position is slow, hence copy it
+        return array.array("I", self.entries_index_sorted)
+
+    def create_group(self, sorted_indices):
+        return SQLiteDictionaryGroup(self.entries, sorted_indices)
+
+    def get_duplicated_headwords(self):
+        return [row[0] for row in self.entries_index.query("SELECT headword FROM %s GROUP BY headword HAVING COUNT(*) > 1")]
+
+    def remove_entries(self, removed, preserve_sort=False):
+        """
+        Copy the entries not removed, and their synonyms,
+        into new tables, renumbering them,
+        and drop the old tables.
+        """
+        if removed.find(b"\x01") == -1:
+            return
+        new_indices = array.array("i", [-1]) * len(removed)
+        length = 0
+        for i in range(len(removed)):
+            if not removed[i]:
+                new_indices[i] = length
+                length += 1
+        original_entries = self.entries
+        original_entries.flush()
+        has_synonyms = self.has_synonyms
+        self.clear()
+        entries = self.entries
+        self.connection.create_function("penelope_new_index", 1, lambda index: new_indices[index])
+        self.connection.execute(
+            "INSERT INTO %s (id, headword, definition) SELECT penelope_new_index(id), headword, definition FROM %s WHERE penelope_new_index(id) >= 0 ORDER BY id" % (
+                entries.entries_table,
+                original_entries.entries_table
+            )
+        )
+        self.connection.execute(
+            "INSERT INTO %s (entry_id, synonym) SELECT penelope_new_index(entry_id), synonym FROM %s WHERE penelope_new_index(entry_id) >= 0 ORDER BY position" % (
+                entries.synonyms_table,
+                original_entries.synonyms_table
+            )
+        )
+        entries.length = length
+        if preserve_sort and original_entries.is_sorted:
+            self.connection.execute(
+                "INSERT INTO %s (entry_id) SELECT penelope_new_index(entry_id) FROM %s WHERE penelope_new_index(entry_id) >= 0 ORDER BY position" % (
+                    entries.sorted_table,
+                    original_entries.sorted_table
+                )
+            )
+            entries.is_sorted = True
+        original_entries.drop()
+        self.has_synonyms = has_synonyms
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Sort byte strings within a memory budget.
+
+Records are accumulated in memory and, when they exceed the budget,
+sorted and spilled to temporary files (runs),
+which are then merged with heapq.merge().
+
+Sort keys are encoded into byte strings (see get_sortable_key()),
+so that records are compact and compared with memcmp().
+"""
+
+from __future__ import absolute_import
+import heapq
+import struct
+import sys
+import tempfile
+
+__author__ = "Alberto Pettarin"
+__copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__version__ = "3.1.3"
+__email__ = "alberto@albertopettarin.it"
+__status__ = "Production"
+
+if sys.version_info >= (3, 0):
+    TEXT_TYPE = str
+else:
+    TEXT_TYPE = unicode
+
+# inverts each byte, which reverses the order of prefix-free byte strings
+INVERT_TABLE = bytes(bytearray([255 - b for b in range(256)]))
+
+INDEX_STRUCT = struct.Struct(">Q")          # big endian, so that it sorts as the integer
+RECORD_LENGTH_STRUCT = struct.Struct(">I")
+RECORD_OVERHEAD = 64                        # estimated memory used by a record besides its bytes
+RUN_BUFFER_SIZE = 1024 * 1024               # buffer size for reading and writing runs
+MAX_MERGED_RUNS = 64                        # runs merged at once, limiting open files
+
+
+def get_sortable_key(key):
+    """
+    Encode the given sort key into bytes,
+    such that comparing the encoded keys with memcmp()
+    is equivalent to comparing the keys in Python.
+
+    The key can be a string, bytes, or a tuple/list of them.
+    Strings are UTF-8 encoded, which preserves code point order.
+    Each component of a tuple is escaped (\\0 => \\0\\xff)
+    and terminated by \\0\\0, so that the components
+    are compared one after the other,
+    and the encoded tuple is prefix-free.
+
+    :param key: the sort key
+    :type  key: unicode or bytes or tuple
+    :rtype: bytes
+    """
+    if isinstance(key, (tuple, list)):
+        return b"".join([get_sortable_component(component) for component in key])
+    if isinstance(key, TEXT_TYPE):
+        return key.encode("utf-8", "surrogatepass")
+    if isinstance(key, bytes):
+        return key
+    raise TypeError("Unsupported sort key type: %s" % type(key))
+
+
+def get_sortable_component(key):
+    """
+    Encode the given sort key as a component of a tuple,
+    see get_sortable_key().
+    Concatenating the encoded components of a tuple
+    gives the encoded tuple.
+
+    :param key: the sort key
+    :type  key: unicode or bytes or tuple
+    :rtype: bytes
+    """
+    if isinstance(key, TEXT_TYPE):
+        key = key.encode("utf-8", "surrogatepass")
+    elif not isinstance(key, bytes):
+        key = get_sortable_key(key)
+    return key.replace(b"\0", b"\0\xff") + b"\0\0"
+
+
+def get_index_record(sortable_key, index, reverse=False):
+    """
+    Return the record for sorting the given index by the given key,
+    ties being broken by the index itself.
+
+    :param sortable_key: the encoded sort key, which must be prefix-free,
+                         see get_sortable_key()
+    :type  sortable_key: bytes
+    :param index: the index
+    :type  index: int
+    :param reverse: if True, the records sort in reverse order
+    :type  reverse: bool
+    :rtype: bytes
+    """
+    record = sortable_key + INDEX_STRUCT.pack(index)
+    if reverse:
+        record = record.translate(INVERT_TABLE)
+    return record
+
+
+def get_index(record, reverse=False):
+    """
+    Return the index stored in the given record,
+    see get_index_record().
+
+    :param record: the record
+    :type  record: bytes
+    :param reverse: if True, the record was created with reverse=True
+    :type  reverse: bool
+    :rtype: int
+    """
+    suffix = record[-INDEX_STRUCT.size:]
+    if reverse:
+        suffix = suffix.translate(INVERT_TABLE)
+    return INDEX_STRUCT.unpack(suffix)[0]
+
+
+def write_run(records):
+    """
+    Write the given sorted records to a temporary file,
+    returning the latter, rewound.
+    """
+    run_file_obj = tempfile.TemporaryFile(buffering=RUN_BUFFER_SIZE)
+    pack = RECORD_LENGTH_STRUCT.pack
+    for record in records:
+        run_file_obj.write(pack(len(record)))
+        run_file_obj.write(record)
+    run_file_obj.seek(0)
+    return run_file_obj
+
+
+def read_run(run_file_obj):
+    """
+    Yield the records stored in the given run file,
+    closing it at the end.
+    """
+    unpack = RECORD_LENGTH_STRUCT.unpack
+    length_size = RECORD_LENGTH_STRUCT.size
+    read = run_file_obj.read
+    try:
+        while True:
+            length = read(length_size)
+            if len(length) < length_size:
+                return
+            yield read(unpack(length)[0])
+    finally:
+        run_file_obj.close()
+
+
+def add_run(levels, run_file_obj):
+    """
+    Add the given run to the first level,
+    merging the runs of a level into one run of the next level
+    when MAX_MERGED_RUNS of them are available.
+    """
+    level = 0
+    while True:
+        if len(levels) == level:
+            levels.append([])
+        levels[level].append(run_file_obj)
+        if len(levels[level]) < MAX_MERGED_RUNS:
+            return
+        run_file_obj = write_run(heapq.merge(*[read_run(run) for run in levels[level]]))
+        levels[level] = []
+        level += 1
+
+
+def external_sort(records, memory_budget=None):
+    """
+    Yield the given byte strings in sorted order.
+
+    If memory_budget is not None, and the records take more
+    than memory_budget bytes, sorted runs are spilled
+    to temporary files and merged at the end.
+
+    :param records: the records
+    :type  records: iterable of bytes
+    :param memory_budget: the maximum number of bytes held in memory, or None
+    :type  memory_budget: int
+    :rtype: generator of bytes
+    """
+    levels = []
+    buffered = []
+    buffered_size = 0
+    for record in records:
+        buffered.append(record)
+        if memory_budget is not None:
+            buffered_size += len(record) + RECORD_OVERHEAD
+            if buffered_size >= memory_budget:
+                buffered.sort()
+                add_run(levels, write_run(buffered))
+                buffered = []
+                buffered_size = 0
+    buffered.sort()
+    if len(levels) == 0:
+        # everything fits in memory
+        for record in buffered:
+            yield record
+        return
+    runs = [read_run(run_file_obj) for level in levels for run_file_obj in level]
+    runs.append(iter(buffered))
+    for record in heapq.merge(*runs):
+        yield record
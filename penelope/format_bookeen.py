@@ -6,13 +6,19 @@ Read/write Bookeen dictionaries.
 """
 
 from __future__ import absolute_import
+import functools
 import imp
 import io
 import os
+import shutil
 import sqlite3
+import time
 import zipfile
 
 from penelope.collation_default import collate_function as collate_function_default
+from penelope.collation_default import sort_key as sort_key_default
+from penelope.collation_keys import MemoizedCollation
+from penelope.parallel_zip import ParallelZipWriter
 from penelope.utilities import print_debug
 from penelope.utilities import print_error
 from penelope.utilities import print_info
@@ -29,36 +35,42 @@ __status__ = "Production"
 
 CHUNK_FILE_PREFIX = "c_"
 CHUNK_SIZE = 262144     # 262144 = 2^18
+INSERT_BATCH_SIZE = 10000               # index rows inserted at once
+INDEX_CACHE_SIZE = -65536               # cache size of the index while building it (negative = KiB)
+WORD_INDEX_SQL = "CREATE INDEX F_WordIndex ON T_DictIndex(F_Word COLLATE IcuNoCase)"   # as in res/empty.idx
 EMPTY_FILE_PATH = os.path.join(os.path.split(os.path.abspath(__file__))[0], "res/empty.idx")
 HEADER = "<!DOCTYPE html PUBLIC \"-//W3C//DTD XHTML 1.0 Strict//EN\"  \"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd\" [<!ENTITY ns \"&#8226;\">]><html xml:lang=\"%s\" xmlns=\"http://www.w3.org/1999/xhtml\"><head><title></title></head><body>"
 
 
 def read(dictionary, args, input_file_string):
     def read_single_dict(dictionary, args, single_dict):
-        # create tmp directory
-        tmp_path = create_temp_directory()
-        print_debug("Working in temp dir '%s'" % (tmp_path), args.debug)
-
+        tmp_path = None
         if len(single_dict) == 1:
+            # create tmp directory, as SQLite needs the .dict.idx file on disk,
+            # while the .dict file is read from the .install file in memory
+            tmp_path = create_temp_directory()
+            print_debug("Working in temp dir '%s'" % (tmp_path), args.debug)
             print_debug("Unzipping .install file...", args.debug)
             zip_file_path = single_dict[0]
             idx_file_path = os.path.join(tmp_path, "d.dict.idx")
-            dict_file_path = os.path.join(tmp_path, "d.dict")
+            dict_file_obj = None
             zip_file_obj = zipfile.ZipFile(zip_file_path, "r")
             for entry in zip_file_obj.namelist():
                 if entry.endswith(".dict.idx"):
                     zip_entry = zip_file_obj.open(entry)
-                    idx_file_obj = io.open(idx_file_path, "wb")
-                    idx_file_obj.write(zip_entry.read())
-                    idx_file_obj.close()
+                    entry_file_obj = io.open(idx_file_path, "wb")
+                    shutil.copyfileobj(zip_entry, entry_file_obj)
+                    entry_file_obj.close()
                     zip_entry.close()
                 elif entry.endswith(".dict"):
-                    zip_entry = zip_file_obj.open(entry)
-                    dict_file_obj = io.open(dict_file_path, "wb")
-                    dict_file_obj.write(zip_entry.read())
-                    dict_file_obj.close()
-                    zip_entry.close()
+                    # the .dict file is a zip file of compressed c_* files,
+                    # hence keep its bytes in memory instead of extracting it
+                    dict_file_obj = io.BytesIO(zip_file_obj.read(entry))
             zip_file_obj.close()
+            if dict_file_obj is None:
+                print_error("File '%s' does not contain a .dict file" % (zip_file_path))
+                delete_directory(tmp_path)
+                return False
             print_debug("Unzipping .install file... done", args.debug)
         else:
             print_debug("Files .dict.idx and .dict already uncompressed...", args.debug)
@@ -68,70 +80,41 @@ def read(dictionary, args, input_file_string):
                 if not os.path.exists(file_path):
                     print_error("File '%s' does not exist" % file_path)
                     return False
+            dict_file_obj = dict_file_path
             print_debug("Files .dict.idx and .dict already uncompressed... done", args.debug)
 
-        # unzip .dict file into tmp_path
-        print_debug("Unzipping .dict file...", args.debug)
-        zip_file_obj = zipfile.ZipFile(dict_file_path, "r")
-        for entry in zip_file_obj.namelist():
-            if not entry.endswith("/"):
-                zip_entry = zip_file_obj.open(entry)
-                entry_file_path = os.path.join(tmp_path, os.path.basename(entry))
-                entry_file_obj = io.open(entry_file_path, "wb")
-                entry_file_obj.write(zip_entry.read())
-                entry_file_obj.close()
-                zip_entry.close()
-        zip_file_obj.close()
-        print_debug("Unzipping .dict file... done", args.debug)
-
-        # read .dict.idx
-        print_debug("Reading .dict.idx file...", args.debug)
+        # read .dict.idx, streaming the rows in chunk and offset order,
+        # and read each c_* file from the .dict file when its first row is reached
+        print_debug("Reading .dict.idx and c_* files...", args.debug)
+        zip_file_obj = zipfile.ZipFile(dict_file_obj, "r")
+        chunk_names = dict([(os.path.basename(entry), entry) for entry in zip_file_obj.namelist() if not entry.endswith("/")])
         sql_connection = sqlite3.connect(idx_file_path)
         sql_cursor = sql_connection.cursor()
-        sql_cursor.execute("select * from T_DictIndex")
-        index_data = sql_cursor.fetchall()
-        chunk_index_to_entries = {}
-        max_chunk_index = 1
-        for index_entry in index_data:
-            headword = index_entry[1]
+        sql_cursor.execute("select F_Word, F_Offset, F_Size, F_ChunckNum from T_DictIndex order by F_ChunckNum, F_Offset, rowid")
+        current_chunk_index = None
+        chunk_view = None
+        for headword, offset, size, chunk_index in sql_cursor:
+            if chunk_index != current_chunk_index:
+                print_debug("  Reading c_%d file..." % (chunk_index), args.debug)
+                chunk_view = memoryview(zip_file_obj.read(chunk_names["%s%d" % (CHUNK_FILE_PREFIX, chunk_index)]))
+                current_chunk_index = chunk_index
             if args.ignore_case:
                 headword = headword.lower()
-            offset = index_entry[2]
-            size = index_entry[3]
-            chunk_index = index_entry[4]
-            if chunk_index not in chunk_index_to_entries:
-                chunk_index_to_entries[chunk_index] = []
-            if chunk_index > max_chunk_index:
-                max_chunk_index = chunk_index
-            chunk_index_to_entries[chunk_index].append([headword, offset, size])
+            definition_unicode = chunk_view[offset:(offset + size)].tobytes().decode(args.input_file_encoding)
+            dictionary.add_entry(headword=headword, definition=definition_unicode)
+        chunk_view = None
         sql_cursor.close()
         sql_connection.close()
-        print_debug("Reading .dict.idx file... done", args.debug)
-
-        # read c_* files
-        print_debug("Reading c_* files...", args.debug)
-        for chunk_index in range(1, max_chunk_index + 1):
-            print_debug("  Reading c_%d file..." % (chunk_index), args.debug)
-            chunk_file_path = os.path.join(tmp_path, "%s%d" % (CHUNK_FILE_PREFIX, chunk_index))
-            chunk_file_obj = io.open(chunk_file_path, "rb")
-            for entry in chunk_index_to_entries[chunk_index]:
-                headword = entry[0]
-                offset = entry[1]
-                size = entry[2]
-                chunk_file_obj.seek(offset)
-                definition_bytes = chunk_file_obj.read(size)
-                definition_unicode = definition_bytes.decode(args.input_file_encoding)
-                dictionary.add_entry(headword=headword, definition=definition_unicode)
-            chunk_file_obj.close()
-            print_debug("  Reading c_%d file... done" % (chunk_index), args.debug)
-        print_debug("Reading c_* files... done", args.debug)
+        zip_file_obj.close()
+        print_debug("Reading .dict.idx and c_* files... done", args.debug)
 
         # delete tmp directory
-        if args.keep:
-            print_info("Not deleting temp dir '%s'" % (tmp_path))
-        else:
-            delete_directory(tmp_path)
-            print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
+        if tmp_path is not None:
+            if args.keep:
+                print_info("Not deleting temp dir '%s'" % (tmp_path))
+            else:
+                delete_directory(tmp_path)
+                print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
         return True
 
     single_dicts = []
@@ -164,6 +147,22 @@ def read(dictionary, args, input_file_string):
     return dictionary
 
 
+def insert_index_rows(sql_cursor, sql_tuples):
+    """
+    Insert the given rows into the T_DictIndex table,
+    returning the time it took, in seconds.
+
+    :param sql_cursor: the cursor of the index
+    :type  sql_cursor: sqlite3.Cursor
+    :param sql_tuples: the rows to be inserted
+    :type  sql_tuples: list of tuples
+    :rtype: float
+    """
+    start = time.time()
+    sql_cursor.executemany("insert into T_DictIndex values (?,?,?,?,?)", sql_tuples)
+    return time.time() - start
+
+
 def write(dictionary, args, output_file_path):
     # result to be returned
     result = None
@@ -195,64 +194,103 @@ def write(dictionary, args, output_file_path):
     # open index
     sql_connection = sqlite3.connect(idx_file_path)
 
-    # install collation in the index
+    # install collation in the index:
+    # if the collation file provides a sort_key function,
+    # compare memoized sort keys, otherwise call its collate_function
     collation_function = collate_function_default
+    sort_key_function = sort_key_default
     if bookeen_collation_function_path is not None:
         try:
-            collation_function = imp.load_source("", bookeen_collation_function_path).collate_function
+            collation_module = imp.load_source("", bookeen_collation_function_path)
+            collation_function = collation_module.collate_function
+            sort_key_function = getattr(collation_module, "sort_key", None)
             print_debug("Using collation function from '%s'" % (bookeen_collation_function_path), args.debug)
         except:
             print_error("Unable to load collation function from '%s'. Using the default collation function instead." % (bookeen_collation_function_path))
+    if sort_key_function is not None:
+        collation = MemoizedCollation(sort_key_function)
+        collation_function = collation.collate_function
+        get_sort_key = collation.get_key
+    else:
+        get_sort_key = functools.cmp_to_key(collation_function)
     sql_connection.create_collation("IcuNoCase", collation_function)
     sql_connection.text_factory = str
 
-    # get a cursor and delete any data from the index file
+    # manage transactions explicitly, and
+    # do not journal or sync, as the index is a temp file until it is complete
+    sql_connection.isolation_level = None
     sql_cursor = sql_connection.cursor()
+    sql_cursor.execute("pragma journal_mode = OFF")
+    sql_cursor.execute("pragma synchronous = OFF")
+    sql_cursor.execute("pragma cache_size = %d" % (INDEX_CACHE_SIZE))
+
+    # delete any data from the index file, and
+    # drop the word index, which is faster to create once all the rows are inserted
+    sql_cursor.execute("begin")
     sql_cursor.execute("delete from T_DictIndex")
+    sql_cursor.execute("drop index F_WordIndex")
 
-    # write c_* files
+    # write c_* files into the .dict file, compressing them in parallel
     # each c_* file has MAX_CHUNK_SIZE < size <= (MAX_CHUNK_SIZE * 2) bytes (tentatively)
-    print_debug("Writing c_* files...", args.debug)
-    files_to_compress = []
+    print_debug("Writing and compressing c_* files with %d jobs..." % (int(args.jobs)), args.debug)
     current_offset = 0
     chunk_index = 1
-    chunk_file_path = "%s%d" % (CHUNK_FILE_PREFIX, chunk_index)
-    files_to_compress.append(chunk_file_path)
-    chunk_file_obj = io.open(chunk_file_path, "wb")
-    for entry_index in dictionary.entries_index_sorted:
-        entry = dictionary.entries[entry_index]
-        definition_bytes = entry.definition.encode("utf-8")
-        definition_size = len(definition_bytes)
-        chunk_file_obj.write(definition_bytes)
-        # insert headword into index file
-        sql_tuple = (0, entry.headword, current_offset, definition_size, chunk_index)
-        sql_cursor.execute("insert into T_DictIndex values (?,?,?,?,?)", sql_tuple)
-        # insert synonyms into index file
-        if not args.ignore_synonyms:
-            for synonym in entry.get_synonyms():
-                sql_tuple = (0, synonym[0], current_offset, definition_size, chunk_index)
-                sql_cursor.execute("insert into T_DictIndex values (?,?,?,?,?)", sql_tuple)
-        # update offset
-        current_offset += definition_size
-        # if we reached CHUNK_SIZE, open the next c_* file
-        if current_offset > CHUNK_SIZE:
-            chunk_file_obj.close()
-            chunk_index += 1
-            chunk_file_path = "%s%d" % (CHUNK_FILE_PREFIX, chunk_index)
-            files_to_compress.append(chunk_file_path)
-            chunk_file_obj = io.open(chunk_file_path, "wb")
-            current_offset = 0
-    chunk_file_obj.close()
-    print_debug("Writing c_* files... done", args.debug)
-
-    # compress
-    print_debug("Compressing c_* files...", args.debug)
-    file_zip_obj = zipfile.ZipFile(dict_file_path, "w", zipfile.ZIP_DEFLATED)
-    for file_to_compress in files_to_compress:
-        file_to_compress = os.path.basename(file_to_compress)
-        file_zip_obj.write(file_to_compress)
-    file_zip_obj.close()
-    print_debug("Compressing c_* files... done", args.debug)
+    chunk_contents = []
+    # index rows are inserted at the end, sorted
+    sql_tuples = []
+    try:
+        with ParallelZipWriter(dict_file_path, jobs=args.jobs) as dict_zip_obj:
+            for entry_index in dictionary.entries_index_sorted:
+                entry = dictionary.entries[entry_index]
+                definition_bytes = entry.definition.encode("utf-8")
+                definition_size = len(definition_bytes)
+                chunk_contents.append(definition_bytes)
+                # insert headword into index file
+                sql_tuples.append((0, entry.headword, current_offset, definition_size, chunk_index))
+                # insert synonyms into index file
+                if not args.ignore_synonyms:
+                    for synonym in entry.get_synonyms():
+                        sql_tuples.append((0, synonym, current_offset, definition_size, chunk_index))
+                # update offset
+                current_offset += definition_size
+                # if we reached CHUNK_SIZE, start the next c_* file
+                if current_offset > CHUNK_SIZE:
+                    dict_zip_obj.add("%s%d" % (CHUNK_FILE_PREFIX, chunk_index), b"".join(chunk_contents))
+                    chunk_index += 1
+                    chunk_contents = []
+                    current_offset = 0
+            dict_zip_obj.add("%s%d" % (CHUNK_FILE_PREFIX, chunk_index), b"".join(chunk_contents))
+    except:
+        print_error("Writing to file '%s'... failure" % (output_file_path_absolute))
+        sql_cursor.close()
+        sql_connection.close()
+        os.chdir(cwd)
+        if args.keep:
+            print_info("Not deleting temp dir '%s'" % (tmp_path))
+        else:
+            delete_directory(tmp_path)
+            print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
+        return None
+    chunk_contents = None
+    print_debug("Writing and compressing c_* files with %d jobs... done" % (int(args.jobs)), args.debug)
+
+    # insert the rows in collation order, so that
+    # the word index is built from sorted rows,
+    # whose sort keys are already memoized
+    start = time.time()
+    sql_tuples.sort(key=lambda sql_tuple: get_sort_key(sql_tuple[1]))
+    print_debug("Sorted %d index rows in %.3f s" % (len(sql_tuples), time.time() - start), args.debug)
+    sql_time = 0.0
+    for batch_start in range(0, len(sql_tuples), INSERT_BATCH_SIZE):
+        sql_time += insert_index_rows(sql_cursor, sql_tuples[batch_start:(batch_start + INSERT_BATCH_SIZE)])
+    print_debug("Inserted %d index rows in %.3f s (%.0f rows/s)" % (len(sql_tuples), sql_time, len(sql_tuples) / max(sql_time, 0.001)), args.debug)
+    sql_tuples = None
+
+    # create the word index
+    print_debug("Creating word index...", args.debug)
+    start = time.time()
+    sql_cursor.execute(WORD_INDEX_SQL)
+    print_debug("Creating word index... done (%.3f s)" % (time.time() - start), args.debug)
 
     # update index metadata
     print_debug("Updating index metadata...", args.debug)
@@ -270,9 +308,10 @@ def write(dictionary, args, output_file_path):
     sql_cursor.execute("update T_DictInfo set F_CollationLevel=?", ("1",))
     sql_cursor.execute("update T_DictVersion set F_DictType=?", ("stardict",))
     sql_cursor.execute("update T_DictVersion set F_Version=?", ("11",))
+    sql_cursor.execute("commit")
     print_debug("Updating index metadata... done", args.debug)
 
-    # compact and close
+    # compact (outside of any transaction) and close
     sql_cursor.execute("vacuum")
     sql_cursor.close()
     sql_connection.close()
@@ -12,6 +12,7 @@ import io
 import os
 import zipfile
 
+from penelope.collation_keys import get_collation_key_function
 from penelope.dictionary_ebook import DictionaryEbook
 from penelope.utilities import create_temp_directory
 from penelope.utilities import delete_directory
@@ -40,14 +41,19 @@ def write(dictionary, args, output_file_path):
     output_file_path_absolute = os.path.abspath(output_file_path)
 
     # sort by headword, optionally ignoring case
-    dictionary.sort(by_headword=True, ignore_case=args.sort_ignore_case)
+    dictionary.sort(
+        by_headword=True,
+        ignore_case=args.sort_ignore_case,
+        key_function=get_collation_key_function(args.sort_collation)
+    )
 
     # create groups
     special_group, group_keys, group_dict = dictionary.group(
         prefix_function_path=args.group_by_prefix_function,
         prefix_length=int(args.group_by_prefix_length),
         merge_min_size=int(args.group_by_prefix_merge_min_size),
-        merge_across_first=args.group_by_prefix_merge_across_first
+        merge_across_first=args.group_by_prefix_merge_across_first,
+        merge_min_bytes=int(args.group_by_prefix_merge_min_bytes)
     )
     all_group_keys = group_keys
     if special_group is not None:
@@ -70,7 +76,9 @@ def write(dictionary, args, output_file_path):
         epub.write(output_file_path_absolute, compress=False)
     else:
         print_debug("Writing to file '%s'..." % (output_file_path_absolute), args.debug)
-        epub.write(output_file_path_absolute, compress=True)
+        # write the files straight into the output file,
+        # unless the tmp directory must be kept
+        epub.write(output_file_path_absolute, compress=True, stream=(not args.keep))
         result = [output_file_path]
         print_debug("Writing to file '%s'... done" % (output_file_path_absolute), args.debug)
 
@@ -83,7 +91,7 @@ def write(dictionary, args, output_file_path):
         print_info("Not deleting temp dir '%s'" % (tmp_path))
         if result is None:
             result = [tmp_path]
-    else:
+    elif epub.root_directory_path is not None:
         epub.delete()
         print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
 
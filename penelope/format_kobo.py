@@ -4,37 +4,46 @@
 """
 Read/write Kobo dictionaries.
 
-The read function only acquires the index,
-as the definition files of the original Kobo dictionaries
-are obfuscated/encrypted.
+The read function acquires the index and,
+for the dictionaries output by the write function,
+the definitions, as the definition files
+of the original Kobo dictionaries are obfuscated/encrypted.
 
 The write function, however, is able to output
 fully functional Kobo dictionaries
 (provided that their file names match one of the official ones,
 probably because they are hard-coded in the Kobo firmware).
 
-The MARISA executables marisa-build and marisa-reverse-lookup
-must be installed as the Python module marisa_trie or
-as executables in your $PATH.
+The MARISA index (words) is read and written with
+the Python module marisa_trie, if installed, or
+with the MARISA executables marisa-build and marisa-reverse-lookup,
+found in the directory specified with --marisa-bin-path or on $PATH.
+If neither is available, the built-in pure Python reader and writer
+are used instead.
 """
 
 from __future__ import absolute_import
-import gzip
 import imp
 import io
 import os
+import struct
 import subprocess
 import zipfile
 
+from penelope.marisa_pure import LABEL_ORDER as MARISA_LABEL_ORDER
+from penelope.marisa_pure import build_trie as build_marisa_trie
+from penelope.marisa_pure import read_keys as read_marisa_keys
+from penelope.parallel_zip import ParallelZipWriter
+from penelope.parallel_zip import read_members
 from penelope.prefix_kobo import get_prefix as get_prefix_kobo
 from penelope.utilities import create_temp_directory
 from penelope.utilities import create_temp_file
 from penelope.utilities import delete_directory
 from penelope.utilities import delete_file
+from penelope.utilities import find_executable
 from penelope.utilities import print_debug
 from penelope.utilities import print_error
 from penelope.utilities import print_info
-from penelope.utilities import rename_file
 
 __author__ = "Alberto Pettarin"
 __copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
@@ -46,45 +55,187 @@ __status__ = "Production"
 WORDS_FILE_NAME = u"words"
 MARISA_BUILD = u"marisa-build"
 MARISA_REVERSE_LOOKUP = u"marisa-reverse-lookup"
+GROUP_START = u"<?xml version=\"1.0\" encoding=\"utf-8\"?><html>"
+GROUP_END = u"</html>"
+ENTRY_START = u"<w><a name=\""
+ENTRY_HEADWORD = u"\"/><div><b>"
+ENTRY_DEFINITION = u"</b><br/>"
+ENTRY_END = u"</div></w>"
 
 
-def read(dictionary, args, input_file_paths):
-    def read_single_file(dictionary, args, input_file_path):
-        # result flag
-        result = False
+def escape_attribute(value):
+    """
+    Escape the given string to be used as the value
+    of a double-quoted html attribute.
 
-        # create a tmp file
-        tmp_handler, tmp_path = create_temp_file()
+    :param value: the attribute value
+    :type  value: unicode
+    :rtype: unicode
+    """
+    return value.replace(u"&", u"&amp;").replace(u"\"", u"&quot;")
 
-        # copy the index file from the zip to the tmp file
-        input_file_obj = zipfile.ZipFile(input_file_path)
-        tmp_file_obj = io.open(tmp_path, "wb")
-        tmp_file_obj.write(input_file_obj.read(WORDS_FILE_NAME))
-        tmp_file_obj.close()
-        input_file_obj.close()
+
+def unescape_attribute(value):
+    """
+    Revert escape_attribute() on the given string.
+
+    :param value: the escaped attribute value
+    :type  value: unicode
+    :rtype: unicode
+    """
+    return value.replace(u"&quot;", u"\"").replace(u"&amp;", u"&")
+
+
+def parse_html_group(html):
+    """
+    Return the (headword, definition) pairs
+    of the given (decompressed) html group file,
+    locating the entry tags with find(),
+    without building the DOM.
+
+    The group is parsed anchoring on the exact
+    structure output by write(). If it does not match,
+    e.g. for files written by older versions
+    that did not escape the headwords in the name attribute,
+    the entries are located by their <w><a name=" tags only.
+
+    :param html: the html group file
+    :type  html: unicode
+    :rtype: list of (unicode, unicode)
+    """
+    entries = parse_html_group_strict(html)
+    if entries is None:
+        entries = list(parse_html_group_lenient(html))
+    return entries
+
+
+def parse_entry_start(html, position):
+    """
+    Parse the <w><a name="..."/><div><b>...</b><br/> tags
+    of the entry starting at the given position.
+
+    Return (headword, position of the definition),
+    or None if the tags do not match the ones output by write().
+    """
+    if not html.startswith(ENTRY_START, position):
+        return None
+    headword_start = position + len(ENTRY_START)
+    # the escaped attribute value does not contain double quotes
+    headword_end = html.find(u"\"", headword_start)
+    if (headword_end == -1) or (not html.startswith(ENTRY_HEADWORD, headword_end)):
+        return None
+    headword = unescape_attribute(html[headword_start:headword_end])
+    position = headword_end + len(ENTRY_HEADWORD)
+    if not html.startswith(headword + ENTRY_DEFINITION, position):
+        return None
+    return (headword, position + len(headword) + len(ENTRY_DEFINITION))
+
+
+def parse_html_group_strict(html):
+    """
+    Parse the given html group file,
+    as output by write(), returning None if it does not match.
+
+    A definition ends at the first </div></w> tags
+    followed by the end of the group or by a valid entry,
+    so definitions containing html tags like the entry ones
+    are not split.
+    """
+    if (not html.startswith(GROUP_START)) or (not html.endswith(GROUP_END)):
+        return None
+    entries = []
+    group_end = len(html) - len(GROUP_END)
+    position = len(GROUP_START)
+    parsed = parse_entry_start(html, position) if position < group_end else None
+    while position < group_end:
+        if parsed is None:
+            return None
+        headword, definition_start = parsed
+        definition_end = html.find(ENTRY_END, definition_start)
+        parsed = None
+        while definition_end > -1:
+            position = definition_end + len(ENTRY_END)
+            if position == group_end:
+                break
+            if position < group_end:
+                parsed = parse_entry_start(html, position)
+                if parsed is not None:
+                    break
+            definition_end = html.find(ENTRY_END, definition_end + 1)
+        if definition_end == -1:
+            return None
+        entries.append((headword, html[definition_start:definition_end]))
+    return entries
+
+
+def parse_html_group_lenient(html):
+    """
+    Yield the (headword, definition) pairs
+    of the given html group file,
+    locating the entries by their <w><a name=" tags only.
+    """
+    position = html.find(ENTRY_START)
+    while position > -1:
+        headword_start = position + len(ENTRY_START)
+        headword_end = html.find(u"\"", headword_start)
+        if headword_end == -1:
+            return
+        headword = html[headword_start:headword_end]
+        body_start = html.find(u">", headword_end) + 1
+        position = html.find(ENTRY_START, body_start)
+        if position == -1:
+            body_end = html.rfind(u"</w>", body_start)
+        else:
+            body_end = html.rfind(u"</w>", body_start, position)
+        if body_end < body_start:
+            body_end = body_start
+        body = html[body_start:body_end]
+        # strip the <div><b>headword</b><br/> ... </div> wrapper
+        prefix = u"<div><b>%s</b><br/>" % (headword)
+        if body.startswith(prefix) and body.endswith(u"</div>"):
+            body = body[len(prefix):-len(u"</div>")]
+        yield (headword, body)
+
+
+def read(dictionary, args, input_file_paths):
+    def read_words(args, input_file_path, words_bytes):
+        # result, the list of keys
+        result = None
 
         # read index with MARISA
         try:
             # call MARISA with marisa_trie module
             import marisa_trie
             trie = marisa_trie.Trie()
-            trie.load(tmp_path)
-            for pair in trie.items():
-                dictionary.add_entry(headword=pair[0], definition=u"")
-            result = True
+            trie.frombytes(words_bytes)
+            result = [pair[0] for pair in trie.items()]
         except ImportError as exc:
-            # call MARISA with subprocess
             print_info("  MARISA cannot be imported as Python module. You might want to install it with:")
             print_info("  $ [sudo] pip install marisa_trie")
-            marisa_reverse_lookup_path = MARISA_REVERSE_LOOKUP
             if args.marisa_bin_path is None:
-                print_info("  Running '%s' from $PATH" % MARISA_REVERSE_LOOKUP)
+                marisa_reverse_lookup_path = find_executable(MARISA_REVERSE_LOOKUP)
+                if marisa_reverse_lookup_path is None:
+                    # read all the keys in pure Python
+                    print_info("  '%s' not found on $PATH, using the built-in MARISA reader" % (MARISA_REVERSE_LOOKUP))
+                    try:
+                        result = read_marisa_keys(words_bytes)
+                    except (ValueError, IndexError, OverflowError, struct.error) as exc:
+                        print_error("  Unable to read the MARISA index with the built-in reader: %s" % (exc))
+                    return result
+                print_info("  Running '%s' from $PATH" % (MARISA_REVERSE_LOOKUP))
             else:
                 marisa_reverse_lookup_path = os.path.join(args.marisa_bin_path, MARISA_REVERSE_LOOKUP)
                 print_info("  Running '%s' from '%s'" % (MARISA_REVERSE_LOOKUP, args.marisa_bin_path))
+
+            # call MARISA with subprocess
             # TODO this is ugly, but it works
             query = (u"\n".join([str(x) for x in range(int(args.marisa_index_size))]) + u"\n").encode("utf-8")
 
+            # copy the index file to a tmp file
+            tmp_handler, tmp_path = create_temp_file()
+            tmp_file_obj = io.open(tmp_path, "wb")
+            tmp_file_obj.write(words_bytes)
+            tmp_file_obj.close()
             try:
                 proc = subprocess.Popen(
                     [marisa_reverse_lookup_path, tmp_path],
@@ -93,27 +244,60 @@ def read(dictionary, args, input_file_paths):
                     stderr=subprocess.PIPE
                 )
                 stdout = proc.communicate(input=query)[0].decode("utf-8")
+                result = []
                 for line in stdout.splitlines():
                     array = line.split("\t")
                     if len(array) >= 2:
-                        key = array[1]
-                        if args.ignore_case:
-                            key = key.lower()
-                        dictionary.add_entry(headword=key, definition=u"")
-                result = True
+                        result.append(array[1])
             except OSError as exc:
                 print_error("  Unable to run '%s' as '%s'" % (MARISA_REVERSE_LOOKUP, marisa_reverse_lookup_path))
                 print_error("  Please make sure '%s':" % MARISA_REVERSE_LOOKUP)
                 print_error("    1. is available on your $PATH or")
                 print_error("    2. specify its path with --marisa-bin-path or")
                 print_error("    3. install the marisa_trie Python module")
+
+            # delete the tmp file
+            delete_file(tmp_handler, tmp_path)
         except:
             print_debug("Reading from file '%s'... failed" % (input_file_path))
 
-        # delete the tmp file
-        delete_file(tmp_handler, tmp_path)
         return result
 
+    def read_single_file(dictionary, args, input_file_path):
+        # read the index file from the zip
+        input_file_obj = zipfile.ZipFile(input_file_path)
+        words_bytes = input_file_obj.read(WORDS_FILE_NAME)
+        html_file_names = [name for name in input_file_obj.namelist() if name.endswith(u".html")]
+        input_file_obj.close()
+
+        keys = read_words(args, input_file_path, words_bytes)
+        if keys is None:
+            return False
+        if args.ignore_case:
+            keys = [key.lower() for key in keys]
+
+        # the html files written by write() are just gzipped,
+        # while the ones of the original Kobo dictionaries are obfuscated:
+        # recover the definitions from the former,
+        # decompressing them in parallel
+        headwords = set()
+        num_html_files = 0
+        for name, html_bytes in read_members(input_file_path, html_file_names, jobs=args.jobs, gunzip=True):
+            if html_bytes is not None:
+                num_html_files += 1
+                for headword, definition in parse_html_group(html_bytes.decode("utf-8")):
+                    if args.ignore_case:
+                        headword = headword.lower()
+                    dictionary.add_entry(headword=headword, definition=definition)
+                    headwords.add(headword)
+        print_debug("Read definitions from %d html files out of %d" % (num_html_files, len(html_file_names)), args.debug)
+
+        # add the headwords without definitions
+        for key in keys:
+            if key not in headwords:
+                dictionary.add_entry(headword=key, definition=u"")
+        return True
+
     for input_file_path in input_file_paths:
         print_debug("Reading from file '%s'..." % (input_file_path), args.debug)
         result = read_single_file(dictionary, args, input_file_path)
@@ -132,77 +316,57 @@ def write(dictionary, args, output_file_path):
     # get absolute path
     output_file_path_absolute = os.path.abspath(output_file_path)
 
-    # create tmp directory
-    cwd = os.getcwd()
-    tmp_path = create_temp_directory()
-    print_debug("Working in temp dir '%s'" % (tmp_path), args.debug)
-    os.chdir(tmp_path)
-
     # sort by headword
     dictionary.sort(by_headword=True)
 
     # group by prefix
-    files_to_compress = []
     prefix_length = int(args.group_by_prefix_length)
     special_group, group_keys, group_dict = dictionary.group(
         prefix_function=get_prefix_kobo,
         prefix_length=prefix_length,
         merge_min_size=int(args.group_by_prefix_merge_min_size),
-        merge_across_first=args.group_by_prefix_merge_across_first
+        merge_across_first=args.group_by_prefix_merge_across_first,
+        merge_min_bytes=int(args.group_by_prefix_merge_min_bytes)
     )
     if special_group is not None:
         special_group_key = u"1" * prefix_length
         group_dict[special_group_key] = special_group
         group_keys = [special_group_key] + group_keys
 
-    # write files
-    for key in group_keys:
-        # write html file
-        file_html_path = key + u".html"
-        file_html_obj = io.open(file_html_path, "wb")
-        file_html_obj.write(u"<?xml version=\"1.0\" encoding=\"utf-8\"?><html>".encode("utf-8"))
-        for entry in group_dict[key]:
-            headword = entry.headword
-            definition = entry.definition
-            file_html_obj.write((u"<w><a name=\"%s\"/><div><b>%s</b><br/>%s</div></w>" % (headword, headword, definition)).encode("utf-8"))
-        file_html_obj.write((u"</html>").encode("utf-8"))
-        file_html_obj.close()
-
-        # compress in gz format
-        file_html_obj = io.open(file_html_path, "rb")
-        file_gz_path = file_html_path + u".gz"
-        file_gz_obj = gzip.open(file_gz_path, "wb")
-        file_gz_obj.writelines(file_html_obj)
-        file_gz_obj.close()
-        file_html_obj.close()
-
-        # delete .html file
-        delete_file(None, file_html_path)
-        # rename .html.gz file into .html
-        rename_file(file_gz_path, file_html_path)
-        files_to_compress.append(file_html_path)
-
-    # write words
+    # create words in memory, or in a tmp directory if MARISA is called with subprocess
     file_words_path = WORDS_FILE_NAME
+    words_bytes = None
     keys = sorted(dictionary.entries_index.keys())
     try:
         import marisa_trie
         trie = marisa_trie.Trie(keys)
-        trie.save(file_words_path)
-        result = [file_words_path]
+        words_bytes = trie.tobytes()
     except ImportError as exc:
-        # call MARISA with subprocess
         print_info("  MARISA cannot be imported as Python module. You might want to install it with:")
         print_info("  $ [sudo] pip install marisa_trie")
-        marisa_build_path = MARISA_BUILD
+    marisa_build_path = None
+    if words_bytes is None:
         if args.marisa_bin_path is None:
-            print_info("  Running '%s' from $PATH" % MARISA_BUILD)
+            marisa_build_path = find_executable(MARISA_BUILD)
+            if marisa_build_path is None:
+                # build the trie in pure Python, with the same node order of marisa-build -l
+                print_info("  '%s' not found on $PATH, using the built-in MARISA writer" % (MARISA_BUILD))
+                words_bytes = build_marisa_trie(keys, node_order=MARISA_LABEL_ORDER)
+            else:
+                print_info("  Running '%s' from $PATH" % (MARISA_BUILD))
         else:
             marisa_build_path = os.path.join(args.marisa_bin_path, MARISA_BUILD)
             print_info("  Running '%s' from '%s'" % (MARISA_BUILD, args.marisa_bin_path))
+    if marisa_build_path is not None:
+        # call MARISA with subprocess
         # TODO this is ugly, but it works
         query = (u"\n".join([x for x in keys]) + u"\n").encode("utf-8")
 
+        # create tmp directory
+        cwd = os.getcwd()
+        tmp_path = create_temp_directory()
+        print_debug("Working in temp dir '%s'" % (tmp_path), args.debug)
+        os.chdir(tmp_path)
         try:
             proc = subprocess.Popen(
                 [marisa_build_path, "-l", "-o", file_words_path],
@@ -211,37 +375,48 @@ def write(dictionary, args, output_file_path):
                 stderr=subprocess.PIPE
             )
             proc.communicate(input=query)[0].decode("utf-8")
-            result = [file_words_path]
-        except OSError as exc:
+            file_words_obj = io.open(file_words_path, "rb")
+            words_bytes = file_words_obj.read()
+            file_words_obj.close()
+        except (OSError, IOError) as exc:
             print_error("  Unable to run '%s' as '%s'" % (MARISA_BUILD, marisa_build_path))
             print_error("  Please make sure '%s':" % MARISA_BUILD)
             print_error("    1. is available on your $PATH or")
             print_error("    2. specify its path with --marisa-bin-path or")
             print_error("    3. install the marisa_trie Python module")
-            result = None
 
-    if result is not None:
-        # add file_words_path to files to compress
-        files_to_compress.append(file_words_path)
-        # create output zip file
-        try:
-            print_debug("Writing to file '%s'..." % (output_file_path_absolute), args.debug)
-            file_zip_obj = zipfile.ZipFile(output_file_path_absolute, "w", zipfile.ZIP_DEFLATED)
-            for file_to_compress in files_to_compress:
-                file_to_compress = os.path.basename(file_to_compress)
-                file_zip_obj.write(file_to_compress)
-            file_zip_obj.close()
-            result = [output_file_path]
-            print_debug("Writing to file '%s'... success" % (output_file_path_absolute), args.debug)
-        except:
-            print_error("Writing to file '%s'... failure" % (output_file_path_absolute))
-
-    # delete tmp directory
-    os.chdir(cwd)
-    if args.keep:
-        print_info("Not deleting temp dir '%s'" % (tmp_path))
-    else:
-        delete_directory(tmp_path)
-        print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
+        # delete tmp directory
+        os.chdir(cwd)
+        if args.keep:
+            print_info("Not deleting temp dir '%s'" % (tmp_path))
+        else:
+            delete_directory(tmp_path)
+            print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
+
+    if words_bytes is None:
+        print_error("Writing to file '%s'... failure" % (output_file_path_absolute))
+        return None
+
+    # create the html files in memory, and
+    # gzip them in parallel and store them in the output zip file,
+    # then add words as the last member;
+    # if anything fails, the incomplete output zip file is deleted
+    print_debug("Writing to file '%s'..." % (output_file_path_absolute), args.debug)
+    try:
+        with ParallelZipWriter(output_file_path_absolute, jobs=args.jobs) as file_zip_obj:
+            for key in group_keys:
+                file_html_path = key + u".html"
+                html_contents = [GROUP_START]
+                for entry in group_dict[key]:
+                    headword = entry.headword
+                    definition = entry.definition
+                    html_contents.append(u"<w><a name=\"%s\"/><div><b>%s</b><br/>%s</div></w>" % (escape_attribute(headword), headword, definition))
+                html_contents.append(GROUP_END)
+                file_zip_obj.add(file_html_path, u"".join(html_contents).encode("utf-8"), gzip_file_name=file_html_path)
+            file_zip_obj.add(file_words_path, words_bytes)
+        result = [output_file_path]
+        print_debug("Writing to file '%s'... success" % (output_file_path_absolute), args.debug)
+    except:
+        print_error("Writing to file '%s'... failure" % (output_file_path_absolute))
 
     return result
@@ -11,6 +11,7 @@ from __future__ import absolute_import
 import os
 import subprocess
 
+from penelope.collation_keys import get_collation_key_function
 from penelope.dictionary_ebook import DictionaryEbook
 from penelope.utilities import print_debug
 from penelope.utilities import print_error
@@ -42,14 +43,19 @@ def write(dictionary, args, output_file_path):
     output_file_path_absolute = os.path.abspath(output_file_path)
 
     # sort by headword, optionally ignoring case
-    dictionary.sort(by_headword=True, ignore_case=args.sort_ignore_case)
+    dictionary.sort(
+        by_headword=True,
+        ignore_case=args.sort_ignore_case,
+        key_function=get_collation_key_function(args.sort_collation)
+    )
 
     # create groups
     special_group, group_keys, group_dict = dictionary.group(
         prefix_function_path=args.group_by_prefix_function,
         prefix_length=int(args.group_by_prefix_length),
         merge_min_size=int(args.group_by_prefix_merge_min_size),
-        merge_across_first=args.group_by_prefix_merge_across_first
+        merge_across_first=args.group_by_prefix_merge_across_first,
+        merge_min_bytes=int(args.group_by_prefix_merge_min_bytes)
     )
     all_group_keys = group_keys
     if special_group is not None:
@@ -4,22 +4,38 @@
 """
 Read/write StarDict dictionaries.
 
-To write a StarDict file, the dictzip executable is required.
+The .dict file is compressed with the dictzip executable,
+specified with --dictzip-path or found on $PATH,
+or with a built-in dictzip compressor, if there is none.
 """
 
 from __future__ import absolute_import
+import array
+import collections
+import functools
 import gzip
 import io
+import mmap
 import os
+import shutil
 import subprocess
 import struct
+import sys
+import tempfile
+import time
 import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
 
+from penelope.dictionary import LazyDictionaryEntry
 from penelope.utilities import create_temp_directory
 from penelope.utilities import delete_directory
+from penelope.utilities import delete_file
+from penelope.utilities import find_executable
 from penelope.utilities import print_debug
 from penelope.utilities import print_error
 from penelope.utilities import print_info
+from penelope.utilities import print_warning
 
 __author__ = "Alberto Pettarin"
 __copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
@@ -42,6 +58,644 @@ SAMETYPESEQUENCE_SUPPORTED_VALUES = [
     u"h"    # HTML markup
 ]           # all the above are UTF-8 encoded (except "l") and terminated by \0
 
+# maps ASCII uppercase letters to lowercase, leaving all other bytes unchanged
+ASCII_LOWERCASE_TABLE = bytes(bytearray([(b + 32) if (65 <= b <= 90) else b for b in range(256)]))
+
+IDX_RECORD_STRUCT = struct.Struct(">II")    # word_data_offset, word_data_size
+IDX_RECORD_64_STRUCT = struct.Struct(">QI")  # same, with idxoffsetbits=64
+IDX_OFFSET_32_MAX_DICT_SIZE = 2 ** 31       # larger .dict files are written with idxoffsetbits=64
+SYN_RECORD_STRUCT = struct.Struct(">I")     # original_word_index
+
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_FHCRC = 2
+GZIP_FEXTRA = 4
+GZIP_FNAME = 8
+GZIP_FCOMMENT = 16
+DICTZIP_SUBFIELD_ID = b"RA"
+DICTZIP_CACHE_SIZE = 32                     # decompressed chunks kept in memory
+DICTZIP_CHUNK_LENGTH = 58315                # same as dictzip, compressed chunks fit 16 bits
+DICTZIP_MAX_CHUNKS = (65535 - 10) // 2      # the RA subfield must fit the gzip extra field
+DICTZIP_COMPRESSION_LEVEL = 9
+DICTZIP_MAX_FILE_SIZE = DICTZIP_MAX_CHUNKS * (DICTZIP_CHUNK_LENGTH + 64) + 2 * 65536    # compressed chunks are a few bytes larger at most
+
+# zipfile can write a member from a stream only on Python 3.6+
+ZIP_OPEN_WRITE_SUPPORTED = (sys.version_info >= (3, 6))
+
+# array supports the "Q" typecode only on Python 3.3+
+try:
+    array.array("Q")
+    IDX_OFFSETS_TYPECODE = "Q"
+except ValueError:
+    IDX_OFFSETS_TYPECODE = "L"
+
+IDX_CACHE_MAGIC = b"PENIDXO1"
+IDX_CACHE_HEADER_STRUCT = struct.Struct("<8s8sQQQ")  # magic, array_format, idx_file_size, idx_file_mtime, record_count
+
+
+def stardict_sort_key(string):
+    """
+    Return the sort key of the given string,
+    such that comparing the keys is equivalent to
+    calling the stardict_strcmp() function of the spec
+    on the UTF-8 encoded strings, that is,
+    g_ascii_strcasecmp() (lowercase ASCII letters only,
+    compare unsigned bytes) and then strcmp() to break ties.
+
+    :param string: the string
+    :type  string: unicode
+    :rtype: (bytes, bytes)
+    """
+    return stardict_bytes_sort_key(string.encode("utf-8"))
+
+
+def stardict_bytes_sort_key(string_bytes):
+    """
+    Return the sort key of the given UTF-8 encoded string,
+    see stardict_sort_key().
+
+    :param string_bytes: the UTF-8 encoded string
+    :type  string_bytes: bytes
+    :rtype: (bytes, bytes)
+    """
+    return (string_bytes.translate(ASCII_LOWERCASE_TABLE), string_bytes)
+
+
+def parse_idx(idx_bytes, idx_offset_bits=32):
+    """
+    Parse the contents of a .idx file,
+    yielding a (headword, offset, size) triple for each record.
+
+    The whole file is scanned in memory:
+    each headword is located by searching for its \\0 terminator,
+    and the fixed-size tail of the record is unpacked in place,
+    instead of reading the file one byte at a time.
+
+    :param idx_bytes: the contents of the .idx file
+    :type  idx_bytes: bytes
+    :param idx_offset_bits: the size of the offset field, 32 or 64
+    :type  idx_offset_bits: int
+    :rtype: generator of (bytes, int, int)
+    """
+    if idx_offset_bits == 64:
+        idx_record_struct = IDX_RECORD_64_STRUCT
+    else:
+        idx_record_struct = IDX_RECORD_STRUCT
+    unpack_from = idx_record_struct.unpack_from
+    record_size = idx_record_struct.size
+    find = idx_bytes.find
+    end = len(idx_bytes)
+    start = 0
+    while start < end:
+        terminator = find(b"\0", start)
+        if (terminator < 0) or (terminator + 1 + record_size > end):
+            # truncated record, ignore it
+            return
+        offset, size = unpack_from(idx_bytes, terminator + 1)
+        yield (idx_bytes[start:terminator], offset, size)
+        start = terminator + 1 + record_size
+
+
+def parse_syn(syn_bytes):
+    """
+    Parse the contents of a .syn file,
+    yielding a (synonym, index) pair for each record.
+
+    :param syn_bytes: the contents of the .syn file
+    :type  syn_bytes: bytes
+    :rtype: generator of (bytes, int)
+    """
+    unpack_from = SYN_RECORD_STRUCT.unpack_from
+    record_size = SYN_RECORD_STRUCT.size
+    find = syn_bytes.find
+    end = len(syn_bytes)
+    start = 0
+    while start < end:
+        terminator = find(b"\0", start)
+        if (terminator < 0) or (terminator + 1 + record_size > end):
+            # truncated record, ignore it
+            return
+        index = unpack_from(syn_bytes, terminator + 1)[0]
+        yield (syn_bytes[start:terminator], index)
+        start = terminator + 1 + record_size
+
+
+class DictFile(object):
+    """
+    Random access to the definitions stored
+    in an uncompressed .dict file.
+
+    The file is memory-mapped, so that reading a definition
+    does not require loading the whole file in memory.
+    """
+    def __init__(self, file_path):
+        self.file_obj = io.open(file_path, "rb")
+        self.data = b""
+        if os.fstat(self.file_obj.fileno()).st_size > 0:
+            # mmap does not support empty files
+            self.data = mmap.mmap(self.file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, size):
+        """
+        Return the given number of bytes,
+        starting at the given offset.
+
+        :param offset: the offset of the first byte
+        :type  offset: int
+        :param size: the number of bytes to read
+        :type  size: int
+        :rtype: bytes
+        """
+        return self.data[offset:(offset + size)]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file_obj.close()
+
+
+class DictzipFile(object):
+    """
+    Random access to the definitions stored
+    in a dictzip-compressed .dict.dz file.
+
+    A dictzip file is a gzip file whose deflate stream
+    is split into chunks that can be inflated independently,
+    listed in the "RA" subfield of the gzip extra field.
+    Reading a definition inflates only the chunks covering it,
+    and the most recently used chunks are cached.
+
+    If the file is not a dictzip file, ValueError is raised.
+    """
+    def __init__(self, file_path, cache_size=DICTZIP_CACHE_SIZE):
+        self.file_obj = io.open(file_path, "rb")
+        try:
+            self.chunk_length, self.chunk_offsets, self.chunk_sizes = self.read_header()
+        except:
+            self.file_obj.close()
+            raise
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    def read_header(self):
+        def read_exactly(size):
+            data = self.file_obj.read(size)
+            if len(data) != size:
+                raise ValueError("Truncated gzip header")
+            return data
+
+        def skip_zero_terminated():
+            while read_exactly(1) != b"\0":
+                pass
+
+        magic, method, flags = struct.unpack("<2sBB", read_exactly(4))
+        if (magic != GZIP_MAGIC) or (method != 8):
+            raise ValueError("Not a gzip file")
+        if not (flags & GZIP_FEXTRA):
+            raise ValueError("Not a dictzip file (no extra field)")
+        # skip mtime, xfl, os
+        read_exactly(6)
+        extra_length = struct.unpack("<H", read_exactly(2))[0]
+        extra = read_exactly(extra_length)
+        chunk_length = None
+        chunk_sizes = None
+        position = 0
+        while position + 4 <= extra_length:
+            subfield_id = extra[position:(position + 2)]
+            subfield_length = struct.unpack("<H", extra[(position + 2):(position + 4)])[0]
+            subfield = extra[(position + 4):(position + 4 + subfield_length)]
+            if (subfield_id == DICTZIP_SUBFIELD_ID) and (subfield_length >= 6):
+                version, chunk_length, chunk_count = struct.unpack("<HHH", subfield[0:6])
+                if (version != 1) or (subfield_length < 6 + 2 * chunk_count):
+                    raise ValueError("Unsupported dictzip subfield")
+                chunk_sizes = struct.unpack("<%dH" % chunk_count, subfield[6:(6 + 2 * chunk_count)])
+            position += 4 + subfield_length
+        if chunk_sizes is None:
+            raise ValueError("Not a dictzip file (no RA subfield)")
+        if flags & GZIP_FNAME:
+            skip_zero_terminated()
+        if flags & GZIP_FCOMMENT:
+            skip_zero_terminated()
+        if flags & GZIP_FHCRC:
+            read_exactly(2)
+        chunk_offsets = []
+        offset = self.file_obj.tell()
+        for chunk_size in chunk_sizes:
+            chunk_offsets.append(offset)
+            offset += chunk_size
+        return (chunk_length, chunk_offsets, chunk_sizes)
+
+    def get_chunk(self, chunk_index):
+        """
+        Return the inflated contents of the given chunk.
+
+        :param chunk_index: the index of the chunk
+        :type  chunk_index: int
+        :rtype: bytes
+        """
+        chunk = self.cache.pop(chunk_index, None)
+        if chunk is None:
+            self.file_obj.seek(self.chunk_offsets[chunk_index])
+            compressed = self.file_obj.read(self.chunk_sizes[chunk_index])
+            chunk = zlib.decompressobj(-zlib.MAX_WBITS).decompress(compressed)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        # (re)insert as the most recently used one
+        self.cache[chunk_index] = chunk
+        return chunk
+
+    def read(self, offset, size):
+        """
+        Return the given number of (uncompressed) bytes,
+        starting at the given (uncompressed) offset.
+
+        :param offset: the offset of the first byte
+        :type  offset: int
+        :param size: the number of bytes to read
+        :type  size: int
+        :rtype: bytes
+        """
+        if size <= 0:
+            return b""
+        first = offset // self.chunk_length
+        last = min((offset + size - 1) // self.chunk_length, len(self.chunk_sizes) - 1)
+        start = offset - first * self.chunk_length
+        if first == last:
+            return self.get_chunk(first)[start:(start + size)]
+        data = b"".join([self.get_chunk(i) for i in range(first, last + 1)])
+        return data[start:(start + size)]
+
+    def close(self):
+        self.cache.clear()
+        self.file_obj.close()
+
+
+class DictzipWriter(object):
+    """
+    Write a dictzip file, that is, a gzip file whose deflate stream
+    is split into chunks that can be inflated independently,
+    listed in the "RA" subfield of the gzip extra field.
+
+    Each chunk is deflated on its own and byte-aligned
+    with a full flush, hence chunks are compressed
+    in parallel, using the given number of threads.
+
+    Since the chunk table precedes the compressed data,
+    the latter is spooled to an anonymous temporary file
+    until close() is called.
+    """
+    def __init__(
+            self,
+            file_obj,
+            file_name=None,
+            jobs=1,
+            chunk_length=DICTZIP_CHUNK_LENGTH,
+            compression_level=DICTZIP_COMPRESSION_LEVEL
+    ):
+        self.file_obj = file_obj
+        self.file_name = file_name
+        self.chunk_length = chunk_length
+        self.compression_level = compression_level
+        self.pool = None
+        if jobs > 1:
+            self.pool = ThreadPool(jobs)
+        self.batch_size = max(jobs, 1) * 4
+        self.buffer = bytearray()
+        self.pending = []
+        self.chunk_sizes = []
+        self.spool = tempfile.TemporaryFile()
+        self.crc = 0
+        self.size = 0
+
+    def compress_chunk(self, chunk):
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(chunk) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+    def compress_pending(self):
+        if self.pool is None:
+            compressed_chunks = [self.compress_chunk(chunk) for chunk in self.pending]
+        else:
+            compressed_chunks = self.pool.map(self.compress_chunk, self.pending)
+        for compressed_chunk in compressed_chunks:
+            self.spool.write(compressed_chunk)
+            self.chunk_sizes.append(len(compressed_chunk))
+        self.pending = []
+
+    def write(self, data):
+        """
+        Append the given bytes to the (uncompressed) contents.
+
+        Raise ValueError if the contents become too large
+        to be indexed by the chunk table.
+
+        :param data: the bytes to write
+        :type  data: bytes
+        """
+        self.size += len(data)
+        if self.size > DICTZIP_MAX_CHUNKS * self.chunk_length:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+            self.spool.close()
+            raise ValueError("Too much data for a dictzip file")
+        self.crc = zlib.crc32(data, self.crc)
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_length:
+            self.pending.append(bytes(self.buffer[0:self.chunk_length]))
+            del self.buffer[0:self.chunk_length]
+        if len(self.pending) >= self.batch_size:
+            self.compress_pending()
+
+    def close(self):
+        """
+        Compress the remaining data and write the dictzip file.
+        Note that the underlying file object is not closed.
+        """
+        if (len(self.buffer) > 0) or (self.size == 0):
+            self.pending.append(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.compress_pending()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        # terminate the deflate stream with an empty final block,
+        # which belongs to the last chunk
+        trailer = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+        self.spool.write(trailer)
+        self.chunk_sizes[-1] += len(trailer)
+
+        # header
+        chunk_count = len(self.chunk_sizes)
+        subfield = struct.pack("<HHH", 1, self.chunk_length, chunk_count)
+        subfield += struct.pack("<%dH" % chunk_count, *self.chunk_sizes)
+        extra = DICTZIP_SUBFIELD_ID + struct.pack("<H", len(subfield)) + subfield
+        flags = GZIP_FEXTRA
+        if self.file_name is not None:
+            flags |= GZIP_FNAME
+        self.file_obj.write(GZIP_MAGIC + struct.pack("<BBIBB", 8, flags, int(time.time()), 2, 3))
+        self.file_obj.write(struct.pack("<H", len(extra)) + extra)
+        if self.file_name is not None:
+            self.file_obj.write(self.file_name.encode("latin-1", "replace") + b"\0")
+
+        # compressed data and gzip trailer
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.file_obj)
+        self.spool.close()
+        self.file_obj.write(struct.pack("<II", self.crc & 0xFFFFFFFF, self.size & 0xFFFFFFFF))
+
+
+def compress_dictzip(input_file_path, output_file_path, jobs=1):
+    """
+    Compress the given file into a dictzip file.
+
+    Raise ValueError if the file is too large.
+
+    :param input_file_path: the path of the file to be compressed
+    :type  input_file_path: string (path)
+    :param output_file_path: the path of the dictzip file
+    :type  output_file_path: string (path)
+    :param jobs: the number of compression threads
+    :type  jobs: int
+    """
+    input_file_obj = io.open(input_file_path, "rb")
+    output_file_obj = io.open(output_file_path, "wb")
+    try:
+        writer = DictzipWriter(output_file_obj, file_name=os.path.basename(input_file_path), jobs=jobs)
+        data = input_file_obj.read(DICTZIP_CHUNK_LENGTH * 16)
+        while data:
+            writer.write(data)
+            data = input_file_obj.read(DICTZIP_CHUNK_LENGTH * 16)
+        writer.close()
+    finally:
+        input_file_obj.close()
+        output_file_obj.close()
+
+
+def open_dict_file(file_path):
+    """
+    Open the given .dict or .dict.dz file for random access,
+    returning a DictFile or DictzipFile object.
+
+    If a .dz file is not a dictzip file, ValueError is raised.
+
+    :param file_path: the path of the .dict or .dict.dz file
+    :type  file_path: str
+    :rtype: DictFile or DictzipFile
+    """
+    if file_path.endswith(".dz"):
+        return DictzipFile(file_path)
+    return DictFile(file_path)
+
+
+class StarDictIndex(object):
+    """
+    Query a StarDict dictionary without loading it in memory.
+
+    The .idx file is memory-mapped, and the offsets
+    of its records are stored in a compact array,
+    built by scanning the .idx file once,
+    or loaded from the given cache file, if still valid.
+    Since the .idx file is sorted using stardict_strcmp(),
+    headwords are found with a binary search,
+    and only the requested definitions are read
+    from the (possibly dictzip-compressed) .dict file.
+
+    The .idx file must be uncompressed.
+    """
+    def __init__(self, idx_file_path, dict_file_path, idx_offset_bits=32, cache_file_path=None, encoding="utf-8"):
+        if idx_offset_bits == 64:
+            self.record_struct = IDX_RECORD_64_STRUCT
+        else:
+            self.record_struct = IDX_RECORD_STRUCT
+        self.encoding = encoding
+        self.idx_file_obj = io.open(idx_file_path, "rb")
+        self.idx_data = b""
+        idx_stat = os.fstat(self.idx_file_obj.fileno())
+        if idx_stat.st_size > 0:
+            # mmap does not support empty files
+            self.idx_data = mmap.mmap(self.idx_file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.record_offsets = None
+        if cache_file_path is not None:
+            self.record_offsets = self.load_record_offsets(cache_file_path, idx_stat)
+        if self.record_offsets is None:
+            self.record_offsets = self.build_record_offsets()
+            if cache_file_path is not None:
+                self.save_record_offsets(cache_file_path, idx_stat)
+        self.dict_file = open_dict_file(dict_file_path)
+
+    def __len__(self):
+        return len(self.record_offsets)
+
+    def build_record_offsets(self):
+        """
+        Scan the .idx file, returning the offsets of its records.
+
+        :rtype: array
+        """
+        record_offsets = array.array(IDX_OFFSETS_TYPECODE)
+        append = record_offsets.append
+        find = self.idx_data.find
+        record_size = self.record_struct.size
+        end = len(self.idx_data)
+        start = 0
+        while start < end:
+            terminator = find(b"\0", start)
+            if (terminator < 0) or (terminator + 1 + record_size > end):
+                # truncated record, ignore it
+                break
+            append(start)
+            start = terminator + 1 + record_size
+        return record_offsets
+
+    def get_array_format(self):
+        # the cache file stores the array as it is in memory
+        return (u"%s%s%d" % (IDX_OFFSETS_TYPECODE, sys.byteorder[0], array.array(IDX_OFFSETS_TYPECODE).itemsize)).encode("ascii").ljust(8, b"\0")
+
+    def load_record_offsets(self, cache_file_path, idx_stat):
+        """
+        Load the offsets of the records from the given cache file,
+        returning None if the latter does not exist
+        or it was not created for this .idx file.
+
+        :param cache_file_path: the path of the cache file
+        :type  cache_file_path: str
+        :param idx_stat: the stat of the .idx file
+        :type  idx_stat: os.stat_result
+        :rtype: array
+        """
+        if not os.path.isfile(cache_file_path):
+            return None
+        cache_file_obj = io.open(cache_file_path, "rb")
+        try:
+            header = cache_file_obj.read(IDX_CACHE_HEADER_STRUCT.size)
+            if len(header) != IDX_CACHE_HEADER_STRUCT.size:
+                return None
+            magic, array_format, idx_file_size, idx_file_mtime, record_count = IDX_CACHE_HEADER_STRUCT.unpack(header)
+            if (
+                (magic != IDX_CACHE_MAGIC) or
+                (array_format != self.get_array_format()) or
+                (idx_file_size != idx_stat.st_size) or
+                (idx_file_mtime != int(idx_stat.st_mtime))
+            ):
+                return None
+            record_offsets = array.array(IDX_OFFSETS_TYPECODE)
+            try:
+                record_offsets.fromfile(cache_file_obj, record_count)
+            except EOFError:
+                return None
+            return record_offsets
+        finally:
+            cache_file_obj.close()
+
+    def save_record_offsets(self, cache_file_path, idx_stat):
+        """
+        Save the offsets of the records to the given cache file.
+
+        :param cache_file_path: the path of the cache file
+        :type  cache_file_path: str
+        :param idx_stat: the stat of the .idx file
+        :type  idx_stat: os.stat_result
+        """
+        cache_file_obj = io.open(cache_file_path, "wb")
+        cache_file_obj.write(IDX_CACHE_HEADER_STRUCT.pack(
+            IDX_CACHE_MAGIC,
+            self.get_array_format(),
+            idx_stat.st_size,
+            int(idx_stat.st_mtime),
+            len(self.record_offsets)
+        ))
+        self.record_offsets.tofile(cache_file_obj)
+        cache_file_obj.close()
+
+    def get_headword_bytes(self, position):
+        """
+        Return the UTF-8 encoded headword of the given record.
+
+        :param position: the position of the record in the .idx file
+        :type  position: int
+        :rtype: bytes
+        """
+        start = self.record_offsets[position]
+        return self.idx_data[start:self.idx_data.find(b"\0", start)]
+
+    def get_definition(self, position):
+        """
+        Return the definition of the given record.
+
+        :param position: the position of the record in the .idx file
+        :type  position: int
+        :rtype: unicode
+        """
+        start = self.record_offsets[position]
+        terminator = self.idx_data.find(b"\0", start)
+        offset, size = self.record_struct.unpack_from(self.idx_data, terminator + 1)
+        return self.dict_file.read(offset, size).decode(self.encoding)
+
+    def bisect(self, key):
+        """
+        Return the position of the first record
+        whose headword sort key is not less than the given one.
+
+        :param key: the sort key, see stardict_sort_key()
+        :type  key: (bytes, bytes)
+        :rtype: int
+        """
+        low = 0
+        high = len(self.record_offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if stardict_bytes_sort_key(self.get_headword_bytes(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, headword):
+        """
+        Return the definitions of the given headword,
+        or an empty list if the headword is not in the index.
+
+        :param headword: the headword
+        :type  headword: unicode
+        :rtype: list of unicode
+        """
+        headword_bytes = headword.encode("utf-8")
+        definitions = []
+        position = self.bisect(stardict_bytes_sort_key(headword_bytes))
+        while (position < len(self.record_offsets)) and (self.get_headword_bytes(position) == headword_bytes):
+            definitions.append(self.get_definition(position))
+            position += 1
+        return definitions
+
+    def prefix(self, headword, limit=None):
+        """
+        Return the headwords starting with the given prefix,
+        ignoring the case of ASCII letters as stardict_strcmp() does,
+        in index order.
+
+        :param headword: the prefix
+        :type  headword: unicode
+        :param limit: return at most this number of headwords (None: no limit)
+        :type  limit: int
+        :rtype: list of unicode
+        """
+        prefix_key = stardict_sort_key(headword)[0]
+        headwords = []
+        position = self.bisect((prefix_key, b""))
+        while (position < len(self.record_offsets)) and ((limit is None) or (len(headwords) < limit)):
+            headword_bytes = self.get_headword_bytes(position)
+            if not headword_bytes.translate(ASCII_LOWERCASE_TABLE).startswith(prefix_key):
+                break
+            headwords.append(headword_bytes.decode("utf-8"))
+            position += 1
+        return headwords
+
+    def close(self):
+        if isinstance(self.idx_data, mmap.mmap):
+            self.idx_data.close()
+        self.idx_file_obj.close()
+        self.dict_file.close()
+
 
 def read(dictionary, args, input_file_paths):
     def find_files(entries):
@@ -79,15 +733,21 @@ def read(dictionary, args, input_file_paths):
             return {}
         # syn is optional
         tentative_syn = base + ".syn"
+        tentative_syn_dz = base + ".syn.dz"
+        tentative_syn_gz = base + ".syn.gz"
         if tentative_syn in entries:
             found["d.syn"] = tentative_syn
+        if tentative_syn_dz in entries:
+            found["d.syn.dz"] = tentative_syn_dz
+        if tentative_syn_gz in entries:
+            found["d.syn.gz"] = tentative_syn_gz
         return found
 
     def uncompress_file(compressed_path, tmp_path, key):
         uncompressed_path = os.path.join(tmp_path, key)
         u_obj = io.open(uncompressed_path, "wb")
         c_obj = gzip.open(compressed_path, "rb")
-        u_obj.write(c_obj.read())
+        shutil.copyfileobj(c_obj, u_obj)
         c_obj.close()
         u_obj.close()
         print_debug("Uncompressed %s" % (uncompressed_path), args.debug)
@@ -116,9 +776,6 @@ def read(dictionary, args, input_file_paths):
         required_keys = ["bookname", "wordcount", "idxfilesize"]
         if has_syn:
             required_keys.append("synwordcount")
-        # TODO not used => disabling this
-        # if ifo_dict["version"] == "3.0.0":
-        #     required_keys.append("idxoffsetbits")
         for key in required_keys:
             if key not in ifo_dict:
                 print_error("No '%s' found in the .ifo file (see StarDict spec)" % key)
@@ -128,9 +785,14 @@ def read(dictionary, args, input_file_paths):
         ifo_dict["idxfilesize"] = int(ifo_dict["idxfilesize"])
         if has_syn:
             ifo_dict["synwordcount"] = int(ifo_dict["synwordcount"])
-        # TODO not used => disabling this
-        # if ifo_dict["version"] == "3.0.0":
-        #     ifo_dict["idxoffsetbits"] = int(ifo_dict["idxoffsetbits"])
+        # idxoffsetbits is optional and parsed only by version 3.0.0
+        if (ifo_dict["version"] == "3.0.0") and ("idxoffsetbits" in ifo_dict):
+            if ifo_dict["idxoffsetbits"] not in ["32", "64"]:
+                print_error("The .ifo file must have an 'idxoffsetbits' value equal to '32' or '64' (see StarDict spec)")
+                return None
+            ifo_dict["idxoffsetbits"] = int(ifo_dict["idxoffsetbits"])
+        else:
+            ifo_dict["idxoffsetbits"] = 32
 
         if args.sd_ignore_sametypesequence:
             print_debug("Ignoring sametypesequence value", args.debug)
@@ -146,6 +808,16 @@ def read(dictionary, args, input_file_paths):
 
         return ifo_dict
 
+    def close_dict_file(dict_file, tmp_path, args):
+        if dict_file is not None:
+            dict_file.close()
+        # delete tmp directory
+        if args.keep:
+            print_info("Not deleting temp dir '%s'" % (tmp_path))
+        else:
+            delete_directory(tmp_path)
+            print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
+
     def read_single_file(dictionary, args, input_file_path):
         # result flag
         result = False
@@ -165,7 +837,7 @@ def read(dictionary, args, input_file_paths):
                 ext_file_path = os.path.join(tmp_path, key)
                 ext_file_obj = io.open(ext_file_path, "wb")
                 zip_entry = input_file_obj.open(entry)
-                ext_file_obj.write(zip_entry.read())
+                shutil.copyfileobj(zip_entry, ext_file_obj)
                 zip_entry.close()
                 ext_file_obj.close()
                 print_debug("Extracted %s" % (ext_file_path), args.debug)
@@ -173,12 +845,12 @@ def read(dictionary, args, input_file_paths):
                 # extract from compressed file, but only if ".idx" is not present as well
                 if (key == "d.idx.gz") and ("d.idx" not in found_files):
                     extracted_files["d.idx"] = uncompress_file(ext_file_path, tmp_path, "d.idx")
-                # extract from compressed file, but only if ".dict" is not present as well
-                if ((key == "d.dict.dz") or (key == "d.dz")) and ("d.dict" not in found_files):
-                    extracted_files["d.dict"] = uncompress_file(ext_file_path, tmp_path, "d.dict")
+                # same for ".syn"
+                if (key in ["d.syn.dz", "d.syn.gz"]) and ("d.syn" not in found_files) and ("d.syn" not in extracted_files):
+                    extracted_files["d.syn"] = uncompress_file(ext_file_path, tmp_path, "d.syn")
         input_file_obj.close()
 
-        # here we have d.ifo, d.idx and d.dict (all uncompressed) and possibly d.syn
+        # here we have d.ifo, d.idx (uncompressed), d.dict (possibly compressed) and possibly d.syn (uncompressed)
 
         has_syn = "d.syn" in extracted_files
         if (has_syn) and (args.ignore_synonyms):
@@ -186,34 +858,40 @@ def read(dictionary, args, input_file_paths):
             print_debug("Dictionary has synonyms, but ignoring them (--ignore-synonym)", args.debug)
         ifo_dict = read_ifo(extracted_files["d.ifo"], has_syn, args)
         print_debug("Read .ifo file with values:\n%s" % (str(ifo_dict)), args.debug)
+        if ifo_dict is None:
+            close_dict_file(None, tmp_path, args)
+            return False
 
-        # read dict file
-        dict_file_obj = io.open(extracted_files["d.dict"], "rb")
-        dict_file_bytes = dict_file_obj.read()
-        dict_file_obj.close()
+        # open dict file, using the compressed one only if ".dict" is not present
+        if "d.dict" in extracted_files:
+            dict_file = DictFile(extracted_files["d.dict"])
+        else:
+            dz_file_path = extracted_files.get("d.dict.dz", extracted_files.get("d.dz"))
+            try:
+                dict_file = DictzipFile(dz_file_path)
+                print_debug("Reading definitions from dictzip chunks", args.debug)
+            except ValueError:
+                # plain gzip file, no random access
+                dict_file = DictFile(uncompress_file(dz_file_path, tmp_path, "d.dict"))
+        if args.sd_lazy_definitions:
+            print_debug("Reading definitions from the .dict file on demand", args.debug)
 
         # read idx file
         idx_file_obj = io.open(extracted_files["d.idx"], "rb")
-        byte_read = idx_file_obj.read(1)
-        headword = b""
-        while byte_read:
-            if byte_read == b"\0":
-                # end of current word: read offset and size
-                offset_bytes = idx_file_obj.read(4)
-                offset_int = int((struct.unpack('>i', offset_bytes))[0])
-                size_bytes = idx_file_obj.read(4)
-                size_int = int((struct.unpack('>i', size_bytes))[0])
-                definition = dict_file_bytes[offset_int:(offset_int + size_int)].decode(args.input_file_encoding)
-                headword = headword.decode("utf-8")
-                if args.ignore_case:
-                    headword = headword.lower()
-                dictionary.add_entry(headword=headword, definition=definition)
-                headword = b""
-            else:
-                # read next byte
-                headword += byte_read
-            byte_read = idx_file_obj.read(1)
+        idx_file_bytes = idx_file_obj.read()
         idx_file_obj.close()
+        # synonyms refer to the position of the headword in this .idx file
+        first_index = len(dictionary)
+        for headword, offset_int, size_int in parse_idx(idx_file_bytes, ifo_dict["idxoffsetbits"]):
+            headword = headword.decode("utf-8")
+            if args.ignore_case:
+                headword = headword.lower()
+            if args.sd_lazy_definitions:
+                entry = LazyDictionaryEntry(headword, dict_file, offset_int, size_int, args.input_file_encoding)
+                dictionary.add_entry(entry=entry)
+            else:
+                definition = dict_file.read(offset_int, size_int).decode(args.input_file_encoding)
+                dictionary.add_entry(headword=headword, definition=definition)
         result = True
 
         # read syn file, if present
@@ -221,36 +899,26 @@ def read(dictionary, args, input_file_paths):
             print_debug("The input StarDict file contains a .syn file, parsing it...", args.debug)
             result = False
             syn_file_obj = io.open(extracted_files["d.syn"], "rb")
-            byte_read = syn_file_obj.read(1)
-            synonym = b""
-            while byte_read:
-                if byte_read == b"\0":
-                    # end of current synonym: read index of original word
-                    index_bytes = syn_file_obj.read(4)
-                    index_int = int((struct.unpack('>i', index_bytes))[0])
-                    synonym = synonym.decode("utf-8")
-                    if index_int < len(dictionary):
-                        dictionary.add_synonym(synonym=synonym, headword_index=index_int)
-                    else:
-                        # emit a warning?
-                        print_debug("Synonym '%s' points to index %d >= len(dictionary), skipping it" % (index_int, synonym), args.debug)
-                    synonym = b""
-                else:
-                    # read next byte
-                    synonym += byte_read
-                byte_read = syn_file_obj.read(1)
+            syn_file_bytes = syn_file_obj.read()
             syn_file_obj.close()
+            for synonym, index_int in parse_syn(syn_file_bytes):
+                synonym = synonym.decode("utf-8")
+                if first_index + index_int < len(dictionary):
+                    dictionary.add_synonym(synonym=synonym, headword_index=(first_index + index_int))
+                else:
+                    # emit a warning?
+                    print_debug("Synonym '%s' points to index %d >= len(dictionary), skipping it" % (synonym, index_int), args.debug)
             result = True
             print_debug("The input StarDict file contains a .syn file, parsing it... done", args.debug)
         else:
             print_debug("The input StarDict file does not contain a .syn file", args.debug)
 
-        # delete tmp directory
-        if args.keep:
-            print_info("Not deleting temp dir '%s'" % (tmp_path))
+        if args.sd_lazy_definitions:
+            # the entries still refer to the .dict file,
+            # hence close it and delete tmp directory when the dictionary is closed
+            dictionary.add_source(functools.partial(close_dict_file, dict_file, tmp_path, args))
         else:
-            delete_directory(tmp_path)
-            print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
+            close_dict_file(dict_file, tmp_path, args)
 
         return result
 
@@ -266,19 +934,271 @@ def read(dictionary, args, input_file_paths):
 
 
 def write(dictionary, args, output_file_path):
+    def write_dict(dict_file_obj):
+        """
+        Write the .dict file, returning the sizes of the definitions
+        and the size of the .dict file.
+        """
+        definition_sizes = array.array("I")
+        dict_file_size = 0
+        for entry_index in dictionary.entries_index_sorted:
+            definition_bytes = dictionary.entries[entry_index].definition.encode("utf-8")
+            dict_file_obj.write(definition_bytes)
+            definition_sizes.append(len(definition_bytes))
+            dict_file_size += len(definition_bytes)
+        return (definition_sizes, dict_file_size)
+
+    def write_idx(idx_file_obj, definition_sizes, idx_offset_bits):
+        """
+        Write the .idx file, returning its size.
+        """
+        if idx_offset_bits == 64:
+            idx_record_struct = IDX_RECORD_64_STRUCT
+        else:
+            idx_record_struct = IDX_RECORD_STRUCT
+        current_offset = 0
+        current_idx_size = 0
+        for position, entry_index in enumerate(dictionary.entries_index_sorted):
+            headword_bytes = dictionary.entries[entry_index].headword.encode("utf-8")
+            definition_size = definition_sizes[position]
+            idx_file_obj.write(headword_bytes)
+            idx_file_obj.write(b"\0")
+            idx_file_obj.write(idx_record_struct.pack(current_offset, definition_size))
+            current_idx_size += (len(headword_bytes) + 1 + idx_record_struct.size)
+            current_offset += definition_size
+        return current_idx_size
+
+    def get_idx_offset_bits(dict_file_size):
+        if dict_file_size > IDX_OFFSET_32_MAX_DICT_SIZE:
+            print_debug("The .dict file is larger than %d bytes, using 64-bit offsets" % (IDX_OFFSET_32_MAX_DICT_SIZE), args.debug)
+            return 64
+        return 32
+
+    def write_syn(syn_file_obj):
+        """
+        Write the .syn file, returning the number of synonyms.
+
+        By spec, synonyms must be sorted using stardict_strcmp(),
+        and they refer to the position of the headword in the .idx file.
+        """
+        idx_positions = [0] * len(dictionary)
+        for position, entry_index in enumerate(dictionary.entries_index_sorted):
+            idx_positions[entry_index] = position
+        dict_syns = sorted([(stardict_sort_key(synonym), idx_positions[index]) for synonym, index in dictionary.get_synonyms()])
+        for key, position in dict_syns:
+            # the second component of the key is the UTF-8 encoded synonym
+            syn_file_obj.write(key[1])
+            syn_file_obj.write(b"\0")
+            syn_file_obj.write(SYN_RECORD_STRUCT.pack(position))
+        return len(dict_syns)
+
+    def get_ifo_bytes(idx_file_size, idx_offset_bits, dict_syns_len):
+        ifo = u"StarDict's dict ifo file\n"
+        if idx_offset_bits == 64:
+            # idxoffsetbits is parsed only by version 3.0.0
+            ifo += u"version=3.0.0\n"
+        else:
+            ifo += u"version=2.4.2\n"
+        ifo += u"wordcount=%d\n" % (len(dictionary))
+        ifo += u"idxfilesize=%d\n" % (idx_file_size)
+        ifo += u"bookname=%s\n" % (args.title)
+        ifo += u"date=%s\n" % (args.year)
+        ifo += u"sametypesequence=m\n"
+        ifo += u"description=%s\n" % (args.description)
+        ifo += u"author=%s\n" % (args.author)
+        ifo += u"email=%s\n" % (args.email)
+        ifo += u"website=%s\n" % (args.website)
+        if dict_syns_len > 0:
+            ifo += u"synwordcount=%d\n" % (dict_syns_len)
+        if idx_offset_bits == 64:
+            ifo += u"idxoffsetbits=64\n"
+        return ifo.encode("utf-8")
+
+    def open_gzip_writer(file_obj, file_name):
+        """
+        Wrap the given file object with a streaming gzip compressor,
+        if the .idx and .syn files must be compressed.
+        """
+        if args.sd_gzip_index:
+            return gzip.GzipFile(filename=file_name, mode="wb", fileobj=file_obj)
+        return file_obj
+
+    def write_syn_requested():
+        if dictionary.has_synonyms:
+            if args.ignore_synonyms:
+                print_debug("Dictionary has synonyms, but ignoring them", args.debug)
+            else:
+                return True
+        return False
+
+    def write_zip_members(dictzip):
+        """
+        Write each file directly into the output zip file.
+
+        Raise ValueError if the .dict file is too large for dictzip.
+        """
+        def open_member(member_path, max_size=None):
+            """
+            Open the given member for writing,
+            with the current time as its timestamp, and
+            with the ZIP64 extensions if its size is not known in advance,
+            otherwise only if max_size requires them.
+            """
+            zip_info = zipfile.ZipInfo(member_path, date_time=time.localtime(time.time())[:6])
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            zip_info.external_attr = 0o600 << 16
+            if max_size is None:
+                return file_zip_obj.open(zip_info, "w", force_zip64=True)
+            zip_info.file_size = max_size
+            return file_zip_obj.open(zip_info, "w")
+
+        file_zip_obj = zipfile.ZipFile(output_file_path_absolute, "w", zipfile.ZIP_DEFLATED)
+        try:
+            # write .dict file first, as the .idx offsets depend on its size
+            print_debug("Writing .idx and .dict files...", args.debug)
+            if dictzip:
+                dict_member_obj = open_member(dict_dz_file_path, max_size=DICTZIP_MAX_FILE_SIZE)
+                dict_file_obj = DictzipWriter(dict_member_obj, file_name=dict_file_path, jobs=int(args.jobs))
+            else:
+                dict_member_obj = open_member(dict_file_path)
+                dict_file_obj = dict_member_obj
+            try:
+                definition_sizes, dict_file_size = write_dict(dict_file_obj)
+                if dictzip:
+                    dict_file_obj.close()
+            finally:
+                dict_member_obj.close()
+            idx_offset_bits = get_idx_offset_bits(dict_file_size)
+            idx_member_obj = open_member(idx_member_path)
+            idx_file_obj = open_gzip_writer(idx_member_obj, idx_file_path)
+            idx_file_size = write_idx(idx_file_obj, definition_sizes, idx_offset_bits)
+            idx_file_obj.close()
+            idx_member_obj.close()
+            print_debug("Writing .idx and .dict files... done", args.debug)
+
+            # write .syn file
+            dict_syns_len = 0
+            if write_syn_requested():
+                print_debug("Dictionary has synonyms, writing .syn file...", args.debug)
+                syn_member_obj = open_member(syn_member_path)
+                syn_file_obj = open_gzip_writer(syn_member_obj, syn_file_path)
+                dict_syns_len = write_syn(syn_file_obj)
+                syn_file_obj.close()
+                syn_member_obj.close()
+                print_debug("Dictionary has synonyms, writing .syn file... done", args.debug)
+
+            # write .ifo file
+            file_zip_obj.writestr(ifo_file_path, get_ifo_bytes(idx_file_size, idx_offset_bits, dict_syns_len))
+        finally:
+            file_zip_obj.close()
+
+    def write_files(tmp_path):
+        """
+        Write the files into the given directory, and then zip them.
+        """
+        # result to be returned
+        result = None
+
+        # write .idx and .dict files
+        print_debug("Writing .idx and .dict files...", args.debug)
+        dict_file_obj = io.open(os.path.join(tmp_path, dict_file_path), "wb")
+        definition_sizes, dict_file_size = write_dict(dict_file_obj)
+        dict_file_obj.close()
+        idx_offset_bits = get_idx_offset_bits(dict_file_size)
+        idx_member_obj = io.open(os.path.join(tmp_path, idx_member_path), "wb")
+        idx_file_obj = open_gzip_writer(idx_member_obj, idx_file_path)
+        idx_file_size = write_idx(idx_file_obj, definition_sizes, idx_offset_bits)
+        idx_file_obj.close()
+        idx_member_obj.close()
+        print_debug("Writing .idx and .dict files... done", args.debug)
+
+        # list files to compress
+        files_to_compress = []
+        files_to_compress.append(ifo_file_path)
+        files_to_compress.append(idx_member_path)
+
+        # write .syn file
+        dict_syns_len = 0
+        if write_syn_requested():
+            print_debug("Dictionary has synonyms, writing .syn file...", args.debug)
+            syn_member_obj = io.open(os.path.join(tmp_path, syn_member_path), "wb")
+            syn_file_obj = open_gzip_writer(syn_member_obj, syn_file_path)
+            dict_syns_len = write_syn(syn_file_obj)
+            syn_file_obj.close()
+            syn_member_obj.close()
+            files_to_compress.append(syn_member_path)
+            print_debug("Dictionary has synonyms, writing .syn file... done", args.debug)
+
+        # compress .dict file
+        if args.sd_no_dictzip:
+            print_debug("Not compressing .dict file with dictzip", args.debug)
+            files_to_compress.append(dict_file_path)
+            result = [dict_file_path]
+        elif dictzip_path is None:
+            try:
+                print_debug("Compressing .dict file with built-in dictzip...", args.debug)
+                compress_dictzip(
+                    os.path.join(tmp_path, dict_file_path),
+                    os.path.join(tmp_path, dict_dz_file_path),
+                    jobs=int(args.jobs)
+                )
+                result = [dict_dz_file_path]
+                files_to_compress.append(dict_dz_file_path)
+                print_debug("Compressing .dict file with built-in dictzip... done", args.debug)
+            except ValueError:
+                print_warning("The .dict file is too large to be compressed with dictzip, not compressing it")
+                files_to_compress.append(dict_file_path)
+                result = [dict_file_path]
+        else:
+            try:
+                print_debug("Compressing .dict file with dictzip...", args.debug)
+                print_info("  Running '%s' from '%s'" % (DICTZIP, dictzip_path))
+                proc = subprocess.Popen(
+                    [dictzip_path, "-k", os.path.join(tmp_path, dict_file_path)],
+                    stdout=subprocess.PIPE,
+                    stdin=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+                proc.communicate()
+                result = [dict_dz_file_path]
+                files_to_compress.append(dict_dz_file_path)
+                print_debug("Compressing .dict file with dictzip... done", args.debug)
+            except OSError as exc:
+                print_error("  Unable to run '%s' as '%s'" % (DICTZIP, dictzip_path))
+                print_error("  Please make sure '%s':" % DICTZIP)
+                print_error("    1. is available on your $PATH or")
+                print_error("    2. specify its path with --dictzip-path or")
+                print_error("    3. specify --sd-no-dictzip to avoid compressing the .dict file")
+                result = None
+
+        if result is not None:
+            # create ifo file
+            ifo_file_obj = io.open(os.path.join(tmp_path, ifo_file_path), "wb")
+            ifo_file_obj.write(get_ifo_bytes(idx_file_size, idx_offset_bits, dict_syns_len))
+            ifo_file_obj.close()
+
+            # create output zip file
+            try:
+                print_debug("Writing to file '%s'..." % (output_file_path_absolute), args.debug)
+                file_zip_obj = zipfile.ZipFile(output_file_path_absolute, "w", zipfile.ZIP_DEFLATED)
+                for file_to_compress in files_to_compress:
+                    file_zip_obj.write(os.path.join(tmp_path, file_to_compress), file_to_compress)
+                    print_debug("Written %s" % (file_to_compress), args.debug)
+                file_zip_obj.close()
+                result = [output_file_path]
+                print_debug("Writing to file '%s'... success" % (output_file_path_absolute), args.debug)
+            except:
+                print_error("Writing to file '%s'... failure" % (output_file_path_absolute))
+                result = None
+        return result
+
     # result to be returned
     result = None
 
     # get absolute path
     output_file_path_absolute = os.path.abspath(output_file_path)
 
-    # create tmp directory
-    cwd = os.getcwd()
-    tmp_path = create_temp_directory()
-    print_debug("Working in temp dir '%s'" % (tmp_path), args.debug)
-    os.chdir(tmp_path)
-
-    # get the basename and compute output file paths
+    # get the basename and compute output file names
     base = os.path.basename(output_file_path)
     if base.endswith(".zip"):
         base = base[:-4]
@@ -287,142 +1207,52 @@ def write(dictionary, args, output_file_path):
     dict_file_path = base + ".dict"
     dict_dz_file_path = base + ".dict.dz"
     syn_file_path = base + ".syn"
+    idx_member_path = idx_file_path
+    syn_member_path = syn_file_path
+    if args.sd_gzip_index:
+        # the .ifo file still records the size of the uncompressed .idx file
+        idx_member_path = base + ".idx.gz"
+        syn_member_path = base + ".syn.dz"
 
-    # TODO by spec, the index should be sorted
-    # TODO using the comparator stardict_strcmp() defined in the spec
-    # TODO (it calls g_ascii_strcasecmp() and/or strcmp() ),
-    # TODO or with a user-defined collation function
-    #
-    # From https://developer.gnome.org/glib/2.28/glib-String-Utility-Functions.html#g-ascii-strcasecmp
-    # gint g_ascii_strcasecmp (const gchar *s1, const gchar *s2);
-    # Compare two strings, ignoring the case of ASCII characters.
-    # Unlike the BSD strcasecmp() function, this only recognizes standard ASCII letters and ignores the locale, treating all non-ASCII bytes as if they are not letters.
-    # This function should be used only on strings that are known to be in encodings where the bytes corresponding to ASCII letters always represent themselves. This includes UTF-8 and the ISO-8859-* charsets, but not for instance double-byte encodings like the Windows Codepage 932, where the trailing bytes of double-byte characters include all ASCII letters. If you compare two CP932 strings using this function, you will get false matches.
-    #
-    # using Python's builtin lower() and sort() by headword
-    # should be equivalent for UTF-8 encoded dictionaries (and it is fast)
-    #
-    dictionary.sort(by_headword=True, ignore_case=True)
-
-    # write .idx and .dict files
-    print_debug("Writing .idx and .dict files...", args.debug)
-    idx_file_obj = io.open(idx_file_path, "wb")
-    dict_file_obj = io.open(dict_file_path, "wb")
-    current_offset = 0
-    current_idx_size = 0
-    for entry_index in dictionary.entries_index_sorted:
-        entry = dictionary.entries[entry_index]
-        headword_bytes = entry.headword.encode("utf-8")
-        definition_bytes = entry.definition.encode("utf-8")
-        definition_size = len(definition_bytes)
-        # write .idx
-        idx_file_obj.write(headword_bytes)
-        idx_file_obj.write(b"\0")
-        idx_file_obj.write(struct.pack('>i', current_offset))
-        idx_file_obj.write(struct.pack('>i', definition_size))
-        current_idx_size += (len(headword_bytes) + 1 + 4 + 4)
-        # write .dict
-        dict_file_obj.write(definition_bytes)
-        current_offset += definition_size
-    idx_file_obj.close()
-    dict_file_obj.close()
-    print_debug("Writing .idx and .dict files... done", args.debug)
-
-    # list files to compress
-    files_to_compress = []
-    files_to_compress.append(ifo_file_path)
-    files_to_compress.append(idx_file_path)
-
-    # write .syn file
-    dict_syns_len = 0
-    if dictionary.has_synonyms:
-        if args.ignore_synonyms:
-            print_debug("Dictionary has synonyms, but ignoring them", args.debug)
-        else:
-            print_debug("Dictionary has synonyms, writing .syn file...", args.debug)
-            syn_file_obj = io.open(syn_file_path, "wb")
-            dict_syns = dictionary.get_synonyms()
-            dict_syns_len = len(dict_syns)
-            for pair in dict_syns:
-                synonym_bytes = pair[0].encode("utf-8")
-                index = pair[1]
-                syn_file_obj.write(synonym_bytes)
-                syn_file_obj.write(b"\0")
-                syn_file_obj.write(struct.pack('>i', index))
-            syn_file_obj.close()
-            files_to_compress.append(syn_file_path)
-            print_debug("Dictionary has synonyms, writing .syn file... done", args.debug)
-
-    # compress .dict file
-    if args.sd_no_dictzip:
-        print_debug("Not compressing .dict file with dictzip", args.debug)
-        files_to_compress.append(dict_file_path)
-        result = [dict_file_path]
-    else:
-        try:
-            print_debug("Compressing .dict file with dictzip...", args.debug)
-            dictzip_path = DICTZIP
-            if args.dictzip_path is None:
-                print_info("  Running '%s' from $PATH" % DICTZIP)
-            else:
-                dictzip_path = args.dictzip_path
-                print_info("  Running '%s' from '%s'" % (DICTZIP, dictzip_path))
-            proc = subprocess.Popen(
-                [dictzip_path, "-k", dict_file_path],
-                stdout=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            proc.communicate()
-            result = [dict_dz_file_path]
-            files_to_compress.append(dict_dz_file_path)
-            print_debug("Compressing .dict file with dictzip... done", args.debug)
-        except OSError as exc:
-            print_error("  Unable to run '%s' as '%s'" % (DICTZIP, dictzip_path))
-            print_error("  Please make sure '%s':" % DICTZIP)
-            print_error("    1. is available on your $PATH or")
-            print_error("    2. specify its path with --dictzip-path or")
-            print_error("    3. specify --no-dictzip to avoid compressing the .dict file")
-            result = None
+    # by spec, the index must be sorted using stardict_strcmp()
+    dictionary.sort(by_headword=True, key_function=stardict_sort_key)
 
-    if result is not None:
-        # create ifo file
-        ifo_file_obj = io.open(ifo_file_path, "wb")
-        ifo_file_obj.write((u"StarDict's dict ifo file\n").encode("utf-8"))
-        ifo_file_obj.write((u"version=2.4.2\n").encode("utf-8"))
-        ifo_file_obj.write((u"wordcount=%d\n" % (len(dictionary))).encode("utf-8"))
-        ifo_file_obj.write((u"idxfilesize=%d\n" % (current_idx_size)).encode("utf-8"))
-        ifo_file_obj.write((u"bookname=%s\n" % (args.title)).encode("utf-8"))
-        ifo_file_obj.write((u"date=%s\n" % (args.year)).encode("utf-8"))
-        ifo_file_obj.write((u"sametypesequence=m\n").encode("utf-8"))
-        ifo_file_obj.write((u"description=%s\n" % (args.description)).encode("utf-8"))
-        ifo_file_obj.write((u"author=%s\n" % (args.author)).encode("utf-8"))
-        ifo_file_obj.write((u"email=%s\n" % (args.email)).encode("utf-8"))
-        ifo_file_obj.write((u"website=%s\n" % (args.website)).encode("utf-8"))
-        if dict_syns_len > 0:
-            ifo_file_obj.write((u"synwordcount=%d\n" % (dict_syns_len)).encode("utf-8"))
-        ifo_file_obj.close()
+    # use the dictzip executable specified with --dictzip-path or found on $PATH,
+    # and the built-in dictzip compressor only if there is none
+    dictzip_path = None
+    if not args.sd_no_dictzip:
+        dictzip_path = args.dictzip_path
+        if dictzip_path is None:
+            dictzip_path = find_executable(DICTZIP)
 
-        # create output zip file
+    if (ZIP_OPEN_WRITE_SUPPORTED) and (dictzip_path is None) and (not args.keep):
+        # write directly into the output zip file, no tmp directory needed
+        print_debug("Writing to file '%s'..." % (output_file_path_absolute), args.debug)
         try:
-            print_debug("Writing to file '%s'..." % (output_file_path_absolute), args.debug)
-            file_zip_obj = zipfile.ZipFile(output_file_path_absolute, "w", zipfile.ZIP_DEFLATED)
-            for file_to_compress in files_to_compress:
-                file_to_compress = os.path.basename(file_to_compress)
-                file_zip_obj.write(file_to_compress)
-                print_debug("Written %s" % (file_to_compress), args.debug)
-            file_zip_obj.close()
+            try:
+                write_zip_members(dictzip=(not args.sd_no_dictzip))
+            except ValueError:
+                print_warning("The .dict file is too large to be compressed with dictzip, not compressing it")
+                write_zip_members(dictzip=False)
             result = [output_file_path]
             print_debug("Writing to file '%s'... success" % (output_file_path_absolute), args.debug)
         except:
             print_error("Writing to file '%s'... failure" % (output_file_path_absolute))
-
-    # delete tmp directory
-    os.chdir(cwd)
-    if args.keep:
-        print_info("Not deleting temp dir '%s'" % (tmp_path))
+            # do not leave an incomplete output zip file behind
+            delete_file(None, output_file_path_absolute)
+            result = None
     else:
-        delete_directory(tmp_path)
-        print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
+        # create tmp directory
+        tmp_path = create_temp_directory()
+        print_debug("Working in temp dir '%s'" % (tmp_path), args.debug)
+
+        result = write_files(tmp_path)
+
+        # delete tmp directory
+        if args.keep:
+            print_info("Not deleting temp dir '%s'" % (tmp_path))
+        else:
+            delete_directory(tmp_path)
+            print_debug("Deleted temp dir '%s'" % (tmp_path), args.debug)
 
     return result
@@ -0,0 +1,589 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Read and write MARISA tries (as used by Kobo dictionaries)
+in pure Python, for when the marisa_trie module is not available.
+
+The binary format is the one written by libmarisa 0.2.x
+(marisa-build and the marisa_trie module):
+a header, followed by a LOUDS trie, whose edges with multiple labels
+(links) point to the nodes of the next, reversed, trie,
+and the last trie to a tail of suffix-merged strings.
+
+The reader enumerates all the keys in one pass over the LOUDS bits,
+in key id order, without querying keys by id.
+
+The writer replicates the build algorithm of libmarisa
+(with the normal cache level), so that its output is identical
+to the one of marisa-build and of the marisa_trie module
+with the same number of tries and node order.
+"""
+
+from __future__ import absolute_import
+from collections import deque
+import struct
+
+__author__ = "Alberto Pettarin"
+__copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__version__ = "3.1.3"
+__email__ = "alberto@albertopettarin.it"
+__status__ = "Production"
+
+HEADER = b"We love Marisa.\0"
+
+DEFAULT_NUM_TRIES = 3
+TEXT_TAIL = 0x01000
+BINARY_TAIL = 0x02000
+LABEL_ORDER = 0x10000
+WEIGHT_ORDER = 0x20000
+NORMAL_CACHE = 0x00200
+
+INVALID_EXTRA = 0xFFFFFFFF >> 8
+UINT32_MAX = 0xFFFFFFFF
+FLT_MIN_BITS = 0x00800000           # bits of FLT_MIN, the weight of empty cache entries
+
+UINT32_STRUCT = struct.Struct("<I")
+UINT64_STRUCT = struct.Struct("<Q")
+RANK_INDEX_STRUCT = struct.Struct("<3I")
+CACHE_STRUCT = struct.Struct("<3I")
+FLOAT_STRUCT = struct.Struct("<f")
+
+
+# reading
+
+
+def read_vector(data, offset):
+    """
+    Read a Vector at the given offset of data,
+    returning its raw bytes and the offset after it.
+    """
+    size = UINT64_STRUCT.unpack_from(data, offset)[0]
+    offset += UINT64_STRUCT.size
+    return data[offset:offset + size], offset + size + ((8 - (size % 8)) % 8)
+
+
+def read_bit_vector(data, offset):
+    """
+    Read a BitVector at the given offset of data,
+    returning its bits (as a bytearray, least significant bit first),
+    its size, its number of 1s and the offset after it.
+
+    The rank and select indices are skipped.
+    """
+    units, offset = read_vector(data, offset)
+    size = UINT32_STRUCT.unpack_from(data, offset)[0]
+    num_1s = UINT32_STRUCT.unpack_from(data, offset + 4)[0]
+    offset += 8
+    for i in range(3):
+        # ranks, select0s, select1s
+        offset = read_vector(data, offset)[1]
+    return bytearray(units), size, num_1s, offset
+
+
+def get_bit(bits, index):
+    return (bits[index >> 3] >> (index & 7)) & 1
+
+
+class TrieReader(object):
+    """
+    A trie of a MARISA file, read starting at the given offset.
+
+    The trie following it, if any, is read as next_trie,
+    and end_offset is the offset after the last trie.
+    """
+    def __init__(self, data, offset):
+        self.louds, self.louds_size, num_1s, offset = read_bit_vector(data, offset)
+        self.terminal_flags, size, num_1s, offset = read_bit_vector(data, offset)
+        self.link_flags, size, num_links, offset = read_bit_vector(data, offset)
+        self.bases, offset = read_vector(data, offset)
+        extras, offset = read_vector(data, offset)
+        # pad, so that each value can be read with a single unpack
+        self.extras = extras + b"\0" * UINT64_STRUCT.size
+        self.extras_value_size, self.extras_mask = struct.unpack_from("<2I", data, offset)
+        offset += 8 + UINT64_STRUCT.size
+        self.tail, offset = read_vector(data, offset)
+        self.tail_end_flags, size, num_1s, offset = read_bit_vector(data, offset)
+        self.next_trie = None
+        if (num_links > 0) and (len(self.tail) == 0):
+            self.next_trie = TrieReader(data, offset)
+            offset = self.next_trie.end_offset
+        offset = read_vector(data, offset)[1]
+        self.num_l1_nodes = UINT32_STRUCT.unpack_from(data, offset)[0]
+        self.end_offset = offset + 8
+        self.parents = None
+        self.links = None
+
+    def get_extra(self, index):
+        position = index * self.extras_value_size
+        unit = UINT64_STRUCT.unpack_from(self.extras, position >> 3)[0]
+        return (unit >> (position & 7)) & self.extras_mask
+
+    def get_link(self, node_id, link_index):
+        return ord(self.bases[node_id:node_id + 1]) | (self.get_extra(link_index) << 8)
+
+    def restore_link(self, link):
+        """
+        Return the string pointed by the given link,
+        stored in the next trie or in the tail.
+        """
+        if self.next_trie is not None:
+            return self.next_trie.restore(link)
+        if len(self.tail_end_flags) == 0:
+            # text tail, strings are terminated by \0
+            return self.tail[link:self.tail.index(b"\0", link)]
+        end = link
+        while not get_bit(self.tail_end_flags, end):
+            end += 1
+        return self.tail[link:end + 1]
+
+    def iter_nodes(self):
+        """
+        Yield (node_id, parent_id, link_index) for each node but the root,
+        in node id order, link_index being None if the node is not a link.
+        """
+        louds = self.louds
+        link_flags = self.link_flags
+        parent_id = 0
+        node_id = 0
+        link_index = 0
+        # skip the super root, 10
+        for position in range(2, self.louds_size):
+            if (louds[position >> 3] >> (position & 7)) & 1:
+                node_id += 1
+                if get_bit(link_flags, node_id):
+                    yield (node_id, parent_id, link_index)
+                    link_index += 1
+                else:
+                    yield (node_id, parent_id, None)
+            else:
+                parent_id += 1
+
+    def restore(self, node_id):
+        """
+        Return the string from the given node up to the root,
+        used by the next tries, which store reversed strings.
+        """
+        if self.parents is None:
+            # parent and link of each node
+            self.parents = [0]
+            self.links = {}
+            for child_id, parent_id, link_index in self.iter_nodes():
+                self.parents.append(parent_id)
+                if link_index is not None:
+                    self.links[child_id] = self.get_link(child_id, link_index)
+        pieces = []
+        while True:
+            if node_id in self.links:
+                pieces.append(self.restore_link(self.links[node_id]))
+            else:
+                pieces.append(self.bases[node_id:node_id + 1])
+            if node_id <= self.num_l1_nodes:
+                return b"".join(pieces)
+            node_id = self.parents[node_id]
+
+    def iter_keys(self):
+        """
+        Yield the keys of the (first) trie, in key id order,
+        as byte strings.
+
+        The string of each node is kept
+        until the children of the node are visited.
+        """
+        terminal_flags = self.terminal_flags
+        if get_bit(terminal_flags, 0):
+            yield b""
+        pending = deque([b""])
+        current_parent_id = -1
+        parent_string = None
+        for node_id, parent_id, link_index in self.iter_nodes():
+            while current_parent_id < parent_id:
+                parent_string = pending.popleft()
+                current_parent_id += 1
+            if link_index is None:
+                string = parent_string + self.bases[node_id:node_id + 1]
+            else:
+                string = parent_string + self.restore_link(self.get_link(node_id, link_index))
+            pending.append(string)
+            if get_bit(terminal_flags, node_id):
+                yield string
+
+
+def read_keys(data):
+    """
+    Return the keys of the MARISA trie stored in data,
+    in key id order.
+
+    :param data: the contents of a MARISA file
+    :type  data: bytes
+    :rtype: list of unicode
+    """
+    if data[0:len(HEADER)] != HEADER:
+        raise ValueError("Not a MARISA trie")
+    trie = TrieReader(data, len(HEADER))
+    return [key.decode("utf-8") for key in trie.iter_keys()]
+
+
+# writing
+
+
+def to_float(value):
+    """
+    Round the given value to a C float.
+    """
+    return FLOAT_STRUCT.unpack(FLOAT_STRUCT.pack(value))[0]
+
+
+def pack_vector(raw):
+    return UINT64_STRUCT.pack(len(raw)) + bytes(raw) + b"\0" * ((8 - (len(raw) % 8)) % 8)
+
+
+def pack_bit_vector(bits, enables_select0=False, enables_select1=False, builds_index=True):
+    """
+    Pack the given bits (a list of 0/1) as a BitVector,
+    with its rank and select indices, unless builds_index is False.
+
+    If bits is None, pack an empty BitVector.
+    """
+    if bits is None:
+        bits = []
+        builds_index = False
+    size = len(bits)
+    num_units = (size + 63) // 64
+    units = bytearray(num_units * 8)
+    for position, bit in enumerate(bits):
+        if bit:
+            units[position >> 3] |= 1 << (position & 7)
+    if not builds_index:
+        return pack_vector(units) + struct.pack("<2I", size, sum(bits)) + pack_vector(b"") * 3
+
+    # each rank index covers 512 bits, in 8 units of 64 bits:
+    # abs is the number of 1s before the index,
+    # rel1, ..., rel7 the number of 1s before each unit, relative to abs
+    num_ranks = (size // 512) + (1 if (size % 512) != 0 else 0) + 1
+    ranks_abs = [0] * num_ranks
+    ranks_rel = [[0] * 8 for i in range(num_ranks)]
+    select0s = []
+    select1s = []
+    num_0s = 0
+    num_1s = 0
+    for unit_id in range(num_units):
+        rank_id = unit_id // 8
+        if (unit_id % 8) == 0:
+            ranks_abs[rank_id] = num_1s
+        else:
+            ranks_rel[rank_id][unit_id % 8] = num_1s - ranks_abs[rank_id]
+        start = unit_id * 64
+        end = min(start + 64, size)
+        if enables_select0 or enables_select1:
+            for position in range(start, end):
+                if bits[position]:
+                    if enables_select1 and ((num_1s % 512) == 0):
+                        select1s.append(position)
+                    num_1s += 1
+                else:
+                    if enables_select0 and ((num_0s % 512) == 0):
+                        select0s.append(position)
+                    num_0s += 1
+        else:
+            num_1s += sum(bits[start:end])
+    if (size % 512) != 0:
+        rank_id = (size - 1) // 512
+        for rel in range((((size - 1) // 64) % 8) + 1, 8):
+            ranks_rel[rank_id][rel] = num_1s - ranks_abs[rank_id]
+    ranks_abs[-1] = num_1s
+    if enables_select0:
+        select0s.append(size)
+    if enables_select1:
+        select1s.append(size)
+
+    ranks = []
+    for rank_id in range(num_ranks):
+        rel = ranks_rel[rank_id]
+        rel_lo = (rel[1] & 0x7F) | ((rel[2] & 0xFF) << 7) | ((rel[3] & 0xFF) << 15) | ((rel[4] & 0x1FF) << 23)
+        rel_hi = (rel[5] & 0x1FF) | ((rel[6] & 0x1FF) << 9) | ((rel[7] & 0x1FF) << 18)
+        ranks.append(RANK_INDEX_STRUCT.pack(ranks_abs[rank_id], rel_lo, rel_hi))
+    return b"".join([
+        pack_vector(units),
+        struct.pack("<2I", size, num_1s),
+        pack_vector(b"".join(ranks)),
+        pack_vector(b"".join([UINT32_STRUCT.pack(s) for s in select0s])),
+        pack_vector(b"".join([UINT32_STRUCT.pack(s) for s in select1s])),
+    ])
+
+
+def pack_flat_vector(values):
+    """
+    Pack the given values as a FlatVector,
+    each value taking as many bits as the largest one.
+    """
+    max_value = max(values) if len(values) > 0 else 0
+    value_size = 0
+    while max_value != 0:
+        value_size += 1
+        max_value >>= 1
+    if len(values) == 0:
+        num_units = 0
+    elif value_size == 0:
+        num_units = 1
+    else:
+        num_units = ((value_size * len(values)) + 63) // 64
+    mask = (UINT32_MAX >> (32 - value_size)) if value_size > 0 else 0
+    units = bytearray(num_units * 8)
+    if value_size > 0:
+        for index, value in enumerate(values):
+            position = index * value_size
+            byte_index = position >> 3
+            value <<= position & 7
+            while value != 0:
+                units[byte_index] |= value & 0xFF
+                value >>= 8
+                byte_index += 1
+    return pack_vector(units) + struct.pack("<2I", value_size, mask) + UINT64_STRUCT.pack(len(values))
+
+
+class TrieBuilder(object):
+    """
+    A trie of a MARISA file, built as libmarisa does.
+
+    Keys are bytearray objects, already reversed for the next tries,
+    so that the i-th label of a key is always key[i].
+    """
+    def __init__(self, num_tries, node_order):
+        self.config_num_tries = num_tries
+        self.config_node_order = node_order
+        self.louds = []
+        self.louds_select0 = False
+        self.terminal_flags = None
+        self.link_flags = []
+        self.bases = bytearray()
+        self.extras = []
+        self.tail = bytearray()
+        self.tail_end_flags = None
+        self.next_trie = None
+        self.cache_parents = []
+        self.cache_children = []
+        self.cache_weights = []
+        self.cache_links = []
+        self.cache_by_child = False
+        self.num_l1_nodes = 0
+        self.num_tries = 1
+        self.tail_mode = TEXT_TAIL
+
+    def build_trie(self, keys, weights, trie_id):
+        """
+        Build the trie (and the next ones) from the given keys,
+        returning the terminal node (or tail offset) of each key.
+        """
+        terminals, next_keys, next_weights = self.build_current_trie(keys, weights, trie_id)
+        next_terminals = []
+        if len(next_keys) > 0:
+            next_terminals = self.build_next_trie(next_keys, next_weights, trie_id)
+        if self.next_trie is not None:
+            self.num_tries = self.next_trie.num_tries + 1
+            self.tail_mode = self.next_trie.tail_mode
+
+        # the lowest 8 bits of a link are stored in bases, the others in extras
+        link_nodes = [node_id for node_id, link_flag in enumerate(self.link_flags) if link_flag]
+        for node_id, terminal in zip(link_nodes, next_terminals):
+            self.bases[node_id] = terminal % 256
+        self.extras = [terminal // 256 for terminal in next_terminals]
+        self.fill_cache(dict([(node_id, link_index) for link_index, node_id in enumerate(link_nodes)]))
+        return terminals
+
+    def build_current_trie(self, keys, weights, trie_id):
+        """
+        Build the LOUDS trie of the given keys, in breadth-first order,
+        returning the terminal node of each key,
+        and the keys (and weights) of the multiple labels of the links,
+        from which the next trie is built.
+        """
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        sorted_keys = [keys[index] for index in order]
+        sorted_weights = [weights[index] for index in order]
+        num_keys = len([i for i in range(len(sorted_keys)) if (i == 0) or (sorted_keys[i - 1] != sorted_keys[i])])
+        self.reserve_cache(trie_id, num_keys)
+        self.cache_by_child = (trie_id > 1)
+
+        louds = self.louds
+        bases = self.bases
+        link_flags = self.link_flags
+        louds.extend([1, 0])
+        bases.append(0)
+        link_flags.append(0)
+
+        sorted_terminals = [0] * len(sorted_keys)
+        next_keys = []
+        next_weights = []
+        queue = deque([(0, len(sorted_keys), 0)])
+        while len(queue) > 0:
+            node_id = len(link_flags) - len(queue)
+            begin, end, key_pos = queue.popleft()
+            while (begin < end) and (len(sorted_keys[begin]) == key_pos):
+                sorted_terminals[begin] = node_id
+                begin += 1
+            if begin == end:
+                louds.append(0)
+                continue
+
+            # split the range by the label at key_pos
+            w_ranges = []
+            weight = sorted_weights[begin]
+            for i in range(begin + 1, end):
+                if sorted_keys[i - 1][key_pos] != sorted_keys[i][key_pos]:
+                    w_ranges.append((begin, i, to_float(weight)))
+                    begin = i
+                    weight = 0.0
+                weight += sorted_weights[i]
+            w_ranges.append((begin, end, to_float(weight)))
+            if self.config_node_order == WEIGHT_ORDER:
+                w_ranges.sort(key=lambda w_range: -w_range[2])
+            if node_id == 0:
+                self.num_l1_nodes = len(w_ranges)
+
+            for begin, end, weight in w_ranges:
+                # the keys in the range are sorted and longer than key_pos,
+                # so they share the label at next_key_pos
+                # iff the first and the last do
+                first = sorted_keys[begin]
+                last = sorted_keys[end - 1]
+                next_key_pos = key_pos + 1
+                while (next_key_pos < len(first)) and (first[next_key_pos] == last[next_key_pos]):
+                    next_key_pos += 1
+                self.cache(node_id, len(bases), weight, first[key_pos])
+                if next_key_pos == key_pos + 1:
+                    bases.append(first[key_pos])
+                    link_flags.append(0)
+                else:
+                    bases.append(0)
+                    link_flags.append(1)
+                    next_keys.append(first[key_pos:next_key_pos])
+                    next_weights.append(weight)
+                queue.append((begin, end, next_key_pos))
+                louds.append(1)
+            louds.append(0)
+        louds.append(0)
+        self.louds_select0 = (trie_id == 1)
+
+        terminals = [0] * len(keys)
+        for position, index in enumerate(order):
+            terminals[index] = sorted_terminals[position]
+        return terminals, next_keys, next_weights
+
+    def build_next_trie(self, keys, weights, trie_id):
+        if trie_id == self.config_num_tries:
+            # the tail stores strings in their original order
+            if trie_id > 1:
+                keys = [key[::-1] for key in keys]
+            return self.build_tail(keys)
+        if trie_id == 1:
+            # the next tries store reversed strings
+            keys = [key[::-1] for key in keys]
+        self.next_trie = TrieBuilder(self.config_num_tries, self.config_node_order)
+        return self.next_trie.build_trie(keys, weights, trie_id + 1)
+
+    def build_tail(self, strings):
+        """
+        Store the given strings in the tail,
+        merging the ones which are suffixes of others,
+        returning the offset of each string.
+        """
+        for string in strings:
+            if 0 in string:
+                self.tail_mode = BINARY_TAIL
+                self.tail_end_flags = []
+                break
+        reversed_strings = [string[::-1] for string in strings]
+        order = sorted(range(len(strings)), key=reversed_strings.__getitem__)
+        offsets = [0] * len(strings)
+        last = None
+        for index in reversed(order):
+            current = reversed_strings[index]
+            if (last is not None) and (len(current) <= len(reversed_strings[last])) and (reversed_strings[last][0:len(current)] == current):
+                offsets[index] = offsets[last] + (len(reversed_strings[last]) - len(current))
+            else:
+                offsets[index] = len(self.tail)
+                self.tail.extend(strings[index])
+                if self.tail_end_flags is None:
+                    self.tail.append(0)
+                else:
+                    self.tail_end_flags.extend([0] * (len(current) - 1) + [1])
+            last = index
+        return offsets
+
+    def reserve_cache(self, trie_id, num_keys):
+        cache_size = 256 if trie_id == 1 else 1
+        while cache_size < (num_keys // NORMAL_CACHE):
+            cache_size *= 2
+        self.cache_parents = [0] * cache_size
+        self.cache_children = [0] * cache_size
+        self.cache_weights = [FLOAT_STRUCT.unpack(UINT32_STRUCT.pack(FLT_MIN_BITS))[0]] * cache_size
+        self.cache_links = [FLT_MIN_BITS] * cache_size
+
+    def cache(self, parent, child, weight, label):
+        if self.cache_by_child:
+            # the next tries are walked from a node up to the root
+            cache_id = child & (len(self.cache_parents) - 1)
+        else:
+            cache_id = (parent ^ (parent << 5) ^ label) & (len(self.cache_parents) - 1)
+        if weight > self.cache_weights[cache_id]:
+            self.cache_parents[cache_id] = parent
+            self.cache_children[cache_id] = child
+            self.cache_weights[cache_id] = weight
+
+    def fill_cache(self, link_indices):
+        for cache_id, child in enumerate(self.cache_children):
+            if child != 0:
+                extra = INVALID_EXTRA
+                if self.link_flags[child]:
+                    extra = self.extras[link_indices[child]]
+                self.cache_links[cache_id] = self.bases[child] | ((extra << 8) & UINT32_MAX)
+            else:
+                self.cache_parents[cache_id] = UINT32_MAX
+                self.cache_children[cache_id] = UINT32_MAX
+
+    def set_terminal_flags(self, terminals):
+        terminal_nodes = set(terminals)
+        self.terminal_flags = [1 if node_id in terminal_nodes else 0 for node_id in range(len(self.bases))] + [0]
+
+    def pack(self):
+        parts = [
+            pack_bit_vector(self.louds, self.louds_select0, True),
+            pack_bit_vector(self.terminal_flags, False, True),
+            pack_bit_vector(self.link_flags),
+            pack_vector(self.bases),
+            pack_flat_vector(self.extras),
+            pack_vector(self.tail),
+            pack_bit_vector(self.tail_end_flags, builds_index=False),
+        ]
+        if self.next_trie is not None:
+            parts.append(self.next_trie.pack())
+        parts.append(pack_vector(b"".join([
+            CACHE_STRUCT.pack(parent, child, link)
+            for parent, child, link in zip(self.cache_parents, self.cache_children, self.cache_links)
+        ])))
+        flags = self.num_tries | self.tail_mode | self.config_node_order
+        parts.append(struct.pack("<2I", self.num_l1_nodes, flags))
+        return b"".join(parts)
+
+
+def build_trie(keys, num_tries=DEFAULT_NUM_TRIES, node_order=WEIGHT_ORDER):
+    """
+    Build a MARISA trie of the given keys,
+    returning the contents of the MARISA file.
+
+    :param keys: the keys
+    :type  keys: list of unicode
+    :param num_tries: the maximum number of tries
+    :type  num_tries: int
+    :param node_order: the order of the children of each node,
+                       WEIGHT_ORDER or LABEL_ORDER
+    :type  node_order: int
+    :rtype: bytes
+    """
+    keys = [bytearray(key.encode("utf-8")) for key in keys]
+    trie = TrieBuilder(num_tries, node_order)
+    terminals = trie.build_trie(keys, [1.0] * len(keys), 1)
+    trie.set_terminal_flags(terminals)
+    return HEADER + trie.pack()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Write zip files whose members are compressed in parallel,
+and read zip files whose gzipped members are decompressed in parallel.
+
+The members are gzipped (and stored) or deflated
+by a pool of threads, as zlib releases the GIL while compressing,
+while the caller keeps generating the next members.
+The compressed members are then written through zipfile,
+in the order they were added.
+"""
+
+from __future__ import absolute_import
+import gzip
+import io
+import sys
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from penelope.utilities import delete_file
+
+__author__ = "Alberto Pettarin"
+__copyright__ = "Copyright 2012-2016, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__version__ = "3.1.3"
+__email__ = "alberto@albertopettarin.it"
+__status__ = "Production"
+
+GZIP_MAGIC = b"\037\213"
+GZIP_COMPRESSION_LEVEL = 9          # as gzip.open()
+ZIP_COMPRESSION_LEVEL = 6           # as zipfile
+ZIP_EXTERNAL_ATTR = 0o600 << 16     # as for the members written by zipfile.writestr()
+PENDING_PER_JOB = 4                 # members being compressed at once, per job
+
+
+def gzip_member(data, gzip_file_name):
+    """
+    Return the given member data, gzipped,
+    storing gzip_file_name in the gzip header.
+
+    :param data: the member data
+    :type  data: bytes
+    :param gzip_file_name: the file name stored in the gzip header
+    :type  gzip_file_name: str
+    :rtype: bytes
+    """
+    gzip_buffer = io.BytesIO()
+    gzip_file_obj = gzip.GzipFile(filename=gzip_file_name, mode="wb", compresslevel=GZIP_COMPRESSION_LEVEL, fileobj=gzip_buffer)
+    gzip_file_obj.write(data)
+    gzip_file_obj.close()
+    return gzip_buffer.getvalue()
+
+
+def deflate_member(data):
+    """
+    Deflate the given member data,
+    returning a (crc32, size, compressed_data) tuple,
+    where compressed_data is the raw deflate stream.
+
+    :param data: the member data
+    :type  data: bytes
+    :rtype: (int, int, bytes)
+    """
+    compressor = zlib.compressobj(ZIP_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    return (zlib.crc32(data) & 0xFFFFFFFF, len(data), compressed_data)
+
+
+class PrecompressedZipFile(zipfile.ZipFile):
+    """
+    A ZipFile which can also write members deflated beforehand,
+    see write_deflated().
+
+    zipfile has no public API for this, hence write_deflated()
+    repeats the steps of ZipFile.writestr() after it deflates the data:
+    this is the only place relying on zipfile internals, and
+    it must be used only if PRECOMPRESSED_WRITE_SUPPORTED is True.
+    """
+    def write_deflated(self, zip_info, deflated_member):
+        """
+        Write a member whose data is already deflated,
+        so that close() writes it in the central directory
+        (with the ZIP64 extensions, if needed).
+
+        :param zip_info: the member info
+        :type  zip_info: zipfile.ZipInfo
+        :param deflated_member: the member, as returned by deflate_member()
+        :type  deflated_member: (int, int, bytes)
+        """
+        crc, size, compressed_data = deflated_member
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        zip_info.file_size = size
+        zip_info.compress_size = len(compressed_data)
+        zip_info.CRC = crc
+        zip_info.header_offset = self.fp.tell()
+        self._writecheck(zip_info)
+        self._didModify = True
+        zip64 = (zip_info.file_size > zipfile.ZIP64_LIMIT) or (zip_info.compress_size > zipfile.ZIP64_LIMIT)
+        self.fp.write(zip_info.FileHeader(zip64))
+        self.fp.write(compressed_data)
+        self.filelist.append(zip_info)
+        self.NameToInfo[zip_info.filename] = zip_info
+        if sys.version_info >= (3, 0):
+            # Python 3 writes the central directory at start_dir
+            self.start_dir = self.fp.tell()
+
+
+def is_precompressed_write_supported():
+    """
+    Return True if PrecompressedZipFile.write_deflated() can be used,
+    that is, if the Python version is one it was checked against,
+    and a zip file written with it in memory
+    reads back correctly with the public zipfile API.
+
+    :rtype: bool
+    """
+    version = sys.version_info[:2]
+    if (version != (2, 7)) and ((version < (3, 6)) or (version > (3, 13))):
+        return False
+    try:
+        members = [(u"a", b"precompressed " * 64), (u"b", b"")]
+        zip_buffer = io.BytesIO()
+        zip_file_obj = PrecompressedZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        for name, data in members:
+            zip_file_obj.write_deflated(zipfile.ZipInfo(name), deflate_member(data))
+        zip_file_obj.writestr(zipfile.ZipInfo(u"c"), b"c")
+        zip_file_obj.close()
+        zip_file_obj = zipfile.ZipFile(io.BytesIO(zip_buffer.getvalue()))
+        result = (zip_file_obj.testzip() is None) and (zip_file_obj.namelist() == [u"a", u"b", u"c"])
+        for name, data in members:
+            result = result and (zip_file_obj.read(name) == data)
+        zip_file_obj.close()
+        return result
+    except Exception:
+        return False
+
+
+# if False, the members are deflated by zipfile, when written
+PRECOMPRESSED_WRITE_SUPPORTED = is_precompressed_write_supported()
+
+
+class ParallelZipWriter(object):
+    """
+    A zip file, whose members are compressed by a pool of jobs threads.
+
+    Members added with a gzip_file_name are gzipped by the pool,
+    and stored, as deflating them again would gain nothing.
+    The other members are deflated by the pool,
+    if PRECOMPRESSED_WRITE_SUPPORTED is True,
+    otherwise by zipfile, when they are written.
+
+    Members are written in the order they are added:
+    at most PENDING_PER_JOB * jobs members are compressed at once,
+    after which add() waits for the oldest one and writes it.
+
+    If jobs is 1, members are compressed when added.
+
+    If used as a context manager, the zip file is closed on exit,
+    or deleted if an exception was raised (see abort()).
+    """
+    def __init__(self, file_path, jobs=1):
+        self.file_path = file_path
+        self.jobs = max(int(jobs), 1)
+        self.file_obj = io.open(file_path, "wb")
+        self.zip_file_obj = PrecompressedZipFile(self.file_obj, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.pool = None
+        if self.jobs > 1:
+            self.pool = ThreadPool(self.jobs)
+        self.pending = []
+        self.date_time = time.localtime(time.time())[:6]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def add(self, name, data, gzip_file_name=None):
+        """
+        Add a member with the given name and data.
+
+        :param name: the member name
+        :type  name: str
+        :param data: the member data
+        :type  data: bytes
+        :param gzip_file_name: if not None, gzip the data first,
+                               storing this name in the gzip header
+        :type  gzip_file_name: str
+        """
+        zip_info = zipfile.ZipInfo(name, date_time=self.date_time)
+        zip_info.external_attr = ZIP_EXTERNAL_ATTR
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        deflated = False
+        if gzip_file_name is not None:
+            zip_info.compress_type = zipfile.ZIP_STORED
+            function, arguments = gzip_member, (data, gzip_file_name)
+        elif (self.pool is not None) and PRECOMPRESSED_WRITE_SUPPORTED:
+            function, arguments = deflate_member, (data,)
+            deflated = True
+        else:
+            # zipfile deflates the data
+            function, arguments = None, None
+        if (self.pool is None) or (function is None):
+            while len(self.pending) > 0:
+                self.write_pending()
+            if function is not None:
+                data = function(*arguments)
+            self.write_member(zip_info, deflated, data)
+            return
+        self.pending.append((zip_info, deflated, self.pool.apply_async(function, arguments)))
+        while len(self.pending) >= PENDING_PER_JOB * self.jobs:
+            self.write_pending()
+
+    def write_pending(self):
+        zip_info, deflated, async_result = self.pending.pop(0)
+        self.write_member(zip_info, deflated, async_result.get())
+
+    def write_member(self, zip_info, deflated, data):
+        if deflated:
+            self.zip_file_obj.write_deflated(zip_info, data)
+        else:
+            self.zip_file_obj.writestr(zip_info, data)
+
+    def terminate_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def close(self):
+        """
+        Write the pending members and the central directory,
+        and close the zip file.
+        If writing fails, the zip file is deleted (see abort()).
+        Calling close() again has no effect.
+        """
+        if self.file_obj.closed:
+            return
+        try:
+            while len(self.pending) > 0:
+                self.write_pending()
+            self.zip_file_obj.close()
+        except:
+            self.abort()
+            raise
+        self.file_obj.close()
+        self.terminate_pool()
+
+    def abort(self):
+        """
+        Discard the pending members, close the zip file
+        and delete it, as it is incomplete.
+        Calling abort() after close() has no effect.
+        """
+        if self.file_obj.closed:
+            return
+        self.terminate_pool()
+        self.pending = []
+        try:
+            # release the zip file, whose contents are discarded anyway
+            self.zip_file_obj.close()
+        except:
+            pass
+        self.file_obj.close()
+        delete_file(None, self.file_path)
+
+
+def gunzip_member(data):
+    """
+    Return the gunzipped member data,
+    or None if the data is not gzipped.
+
+    :param data: the member data
+    :type  data: bytes
+    :rtype: bytes
+    """
+    if data[0:2] != GZIP_MAGIC:
+        return None
+    try:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    except zlib.error:
+        return None
+
+
+def read_members(file_path, names, jobs=1, gunzip=False):
+    """
+    Yield the (name, data) pairs of the given members of a zip file,
+    in the given order.
+
+    If gunzip is True, each member is gunzipped by a pool of jobs threads,
+    while the next ones are read, and its data is None
+    if it is not gzipped (see gunzip_member()).
+    At most PENDING_PER_JOB * jobs members are held at once.
+
+    :param file_path: the zip file path
+    :type  file_path: str
+    :param names: the names of the members
+    :type  names: list of str
+    :param jobs: the number of threads
+    :type  jobs: int
+    :param gunzip: if True, gunzip the members
+    :type  gunzip: bool
+    :rtype: generator of (str, bytes)
+    """
+    jobs = max(int(jobs), 1)
+    file_zip_obj = zipfile.ZipFile(file_path)
+    pool = None
+    if gunzip and (jobs > 1):
+        pool = ThreadPool(jobs)
+    try:
+        pending = []
+        for name in names:
+            data = file_zip_obj.read(name)
+            if not gunzip:
+                yield (name, data)
+            elif pool is None:
+                yield (name, gunzip_member(data))
+            else:
+                pending.append((name, pool.apply_async(gunzip_member, (data,))))
+                while len(pending) >= PENDING_PER_JOB * jobs:
+                    name, async_result = pending.pop(0)
+                    yield (name, async_result.get())
+        for name, async_result in pending:
+            yield (name, async_result.get())
+    finally:
+        file_zip_obj.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
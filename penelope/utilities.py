@@ -8,6 +8,7 @@ This file contains a collection of miscellaneous utility functions.
 from __future__ import absolute_import
 from __future__ import print_function
 import imp
+import multiprocessing
 import os
 import shutil
 import stat
@@ -47,6 +48,13 @@ def get_uuid():
     return str(uuid.uuid4()).replace("-", "")
 
 
+def get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
 def load_input_parser(parser_file_path):
     parser = None
     if os.path.exists(parser_file_path):
@@ -65,6 +73,25 @@ def load_input_parser(parser_file_path):
     return parser
 
 
+def find_executable(name):
+    """
+    Return the path of the given executable,
+    if found in one of the directories listed in $PATH,
+    or None otherwise.
+
+    :param name: the executable name
+    :type  name: str
+    :rtype: str
+    """
+    if hasattr(shutil, "which"):
+        return shutil.which(name)
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
 def create_temp_file():
     tmp_handler, tmp_path = tempfile.mkstemp()
     return (tmp_handler, tmp_path)